@@ -0,0 +1,384 @@
+"""
+Benchmark de punta a punta: técnicos simulados recorren el flujo completo TICKET → RESUMEN_FINAL.
+
+Cada técnico envía Updates sintéticos (comandos, texto, ubicación, fotos y callback queries)
+a la Application real de `crear_aplicacion()` —ConversationHandler, persistencia SQLite,
+procesador por usuario, outbox, planificador de salida—, pero con dobles locales para la
+Bot API de Telegram, Google Sheets, Google Drive y la Geocoding API, cada uno con latencia
+inyectada configurable. Reporta registros/s y p50/p95/p99 por paso para cada nivel de
+concurrencia.
+
+    python benchmarks/bench_e2e.py --tecnicos 1,50,500 --lat-telegram 40 --lat-sheets 300
+
+No necesita credenciales reales: si no están definidos, BOT_TOKEN, GCP_SA_PATH y DATA_DIR
+toman valores de prueba (DATA_DIR en un directorio temporal) antes de importar main.
+Los límites de Telegram (DIFUSION_TASA_GLOBAL, cubos por chat) y UPDATES_CONCURRENTES
+se respetan tal cual: se configuran con sus variables de entorno de siempre.
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("GCP_SA_PATH", "{}")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_e2e_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import main  # noqa: E402
+
+CAJAS_FALSAS = [f"CTO-{i:04d}" for i in range(1, 501)]
+
+
+def _espera(base_ms: float) -> float:
+    """Latencia inyectada en segundos, con ±20 % de variación."""
+    return base_ms / 1000 * random.uniform(0.8, 1.2) if base_ms > 0 else 0
+
+
+# ---------- Telegram Bot API falsa ----------
+class TelegramFalso(BaseRequest):
+    """Responde la Bot API en memoria: mensajes con ids crecientes, getFile y descargas."""
+
+    def __init__(self, latencia_ms: float, foto: bytes):
+        self.latencia_ms = latencia_ms
+        self.foto = foto
+        self.llamadas = Counter()
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _mensaje(self, parametros):
+        self._message_id += 1
+        chat_id = int(parametros.get("chat_id", 0))
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "text": parametros.get("text", ""),
+        }
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        await asyncio.sleep(_espera(self.latencia_ms))
+        if "/file/bot" in url:
+            self.llamadas["descarga"] += 1
+            return 200, self.foto
+
+        metodo = url.rsplit("/", 1)[-1]
+        self.llamadas[metodo] += 1
+        parametros = request_data.parameters if request_data else {}
+        if metodo == "getMe":
+            resultado = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif metodo == "getFile":
+            file_id = parametros["file_id"]
+            resultado = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.foto),
+                         "file_path": f"fotos/{file_id}.jpg"}
+        elif metodo.startswith(("send", "edit")):
+            resultado = self._mensaje(parametros)
+        else:
+            resultado = True
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+
+# ---------- Google Sheets / Drive falsos (se llaman desde hilos) ----------
+class _Ejecutable:
+    def __init__(self, latencia_ms, resultado):
+        self._latencia_ms = latencia_ms
+        self._resultado = resultado
+
+    def execute(self):
+        time.sleep(_espera(self._latencia_ms))
+        return self._resultado
+
+
+class DriveFalso:
+    def __init__(self, latencia_ms):
+        self.latencia_ms = latencia_ms
+        self.subidas = 0
+        self._lock = threading.Lock()
+
+    def files(self):
+        return self
+
+    def permissions(self):
+        return self
+
+    def get(self, fileId=None, **kwargs):
+        return _Ejecutable(self.latencia_ms, {"id": fileId, "name": "IMAGENES", "modifiedTime": "2024-01-01T00:00:00Z"})
+
+    def list(self, **kwargs):
+        return _Ejecutable(self.latencia_ms, {"files": [{"id": "carpeta-falsa", "name": "IMAGENES"}]})
+
+    def create(self, body=None, media_body=None, **kwargs):
+        if media_body is None:  # carpeta o permiso
+            return _Ejecutable(self.latencia_ms, {"id": "carpeta-falsa"})
+        with self._lock:
+            self.subidas += 1
+            file_id = f"foto-{self.subidas}"
+        return _Ejecutable(self.latencia_ms, {"id": file_id, "webViewLink": f"https://drive.falso/{file_id}"})
+
+
+class HojaFalsa:
+    def __init__(self, latencia_ms, id_, valores=None):
+        self.latencia_ms = latencia_ms
+        self.id = id_
+        self.valores = valores or []
+        self._lock = threading.Lock()
+
+    def _esperar(self):
+        time.sleep(_espera(self.latencia_ms))
+
+    def row_values(self, fila):
+        self._esperar()
+        return list(self.valores[fila - 1]) if len(self.valores) >= fila else []
+
+    def col_values(self, col):
+        self._esperar()
+        return [f[col - 1] if len(f) >= col else "" for f in self.valores]
+
+    def update(self, valores, rango):
+        self._esperar()
+        with self._lock:
+            if self.valores:
+                self.valores[0] = valores[0]
+            else:
+                self.valores.append(valores[0])
+
+    def hide_columns(self, *args):
+        self._esperar()
+
+    def append_rows(self, filas, **kwargs):
+        self._esperar()
+        with self._lock:  # como Sheets con USER_ENTERED: el "'" inicial fuerza texto y no se guarda
+            self.valores.extend([c[1:] if isinstance(c, str) and c.startswith("'") else c for c in f] for f in filas)
+
+    def get_all_values(self):
+        self._esperar()
+        return [list(f) for f in self.valores]
+
+
+class LibroFalso:
+    def __init__(self, id_, hoja):
+        self.id = id_
+        self.sheet1 = hoja
+
+    def worksheet(self, nombre):
+        return self.sheet1
+
+
+class ClientesGoogleFalsos:
+    """Misma interfaz que main.ClientesGoogle, con la hoja principal, CAJAS_NODOS y Drive en memoria."""
+
+    def __init__(self, lat_sheets, lat_drive):
+        self.principal = HojaFalsa(lat_sheets, "hoja-principal")
+        cajas = HojaFalsa(lat_sheets, "cajas-nodos", [["CODIGO_CAJA", "NODO"]] + [[c, f"NODO-{i % 20}"] for i, c in enumerate(CAJAS_FALSAS)])
+        self._libros = {"principal": LibroFalso(main.SPREADSHEET_ID, self.principal), "cajas": LibroFalso("cajas-nodos", cajas)}
+        self._drive = DriveFalso(lat_drive)
+        self.construcciones = Counter()
+
+    def gspread(self):
+        return self
+
+    def open_by_key(self, clave):
+        return self._libros["principal" if clave == main.SPREADSHEET_ID else "cajas"]
+
+    def open(self, nombre):
+        return self._libros["cajas"]
+
+    def hoja(self):
+        return self.principal
+
+    def drive(self):
+        return self._drive
+
+    def invalidar_hoja(self):
+        pass
+
+    def filas_escritas(self) -> int:
+        return max(0, len(self.principal.valores) - 1)
+
+
+def _geocoding_falso(latencia_ms):
+    async def responder(request):
+        await asyncio.sleep(_espera(latencia_ms))
+        return httpx.Response(200, json={"status": "OK", "results": [{"address_components": [
+            {"long_name": "Lima", "types": ["administrative_area_level_1"]},
+            {"long_name": "Lima", "types": ["administrative_area_level_2"]},
+            {"long_name": "Miraflores", "types": ["locality"]},
+        ]}]})
+    return responder
+
+
+def _foto_jpeg(ancho=2000, alto=1500) -> bytes:
+    from PIL import Image
+    img = Image.linear_gradient("L").resize((ancho, alto)).convert("RGB")
+    salida = io.BytesIO()
+    img.save(salida, "JPEG", quality=90)
+    return salida.getvalue()
+
+
+# ---------- guion de un técnico ----------
+def guion(codigo: str, lat: float, lng: float):
+    """(etiqueta, tipo, dato) en el orden del flujo; la etiqueta agrupa las latencias por paso."""
+    pasos = [("registro", "comando", "/registro")]
+    for paso, valor in (("TICKET", "INC123456"), ("DNI", "44556677"), ("NOMBRE_CLIENTE", "Cliente Prueba"), ("PARTNER", "Partner Bench")):
+        pasos += [(paso, "texto", valor), (f"CONFIRMAR_{paso}", "callback", f"CONFIRMAR_{paso}")]
+    pasos += [
+        ("TIPO_CUADRILLA", "callback", "SET_TC_POSTVENTA LIMA"),
+        ("CONFIRMAR_TIPO_CUADRILLA", "callback", "CONFIRMAR_TIPO_CUADRILLA"),
+        ("CUADRILLA", "texto", "CQ-01 BENCH"),
+        ("CONFIRMAR_CUADRILLA", "callback", "CONFIRMAR_CUADRILLA"),
+        ("CODIGO_CAJA", "texto", codigo),
+        ("CONFIRMAR_CODIGO_CAJA", "callback", "CONFIRMAR_CODIGO_CAJA"),
+        ("UBICACION_CTO", "ubicacion", (lat, lng)),
+        ("CONFIRMAR_UBICACION_CTO", "callback", "CONFIRMAR_UBICACION_CTO"),
+    ]
+    for paso in ("FOTO_CAJA", "FOTO_CAJA_ABIERTA", "FOTO_MEDICION"):
+        pasos += [(paso, "foto", paso), (f"CONFIRMAR_{paso}", "callback", f"CONFIRMAR_{paso}")]
+    pasos += [
+        ("OBS_TIPO", "callback", "OBS_TIPO_CTO"),
+        ("OBS_SELECCION", "callback", "OBS_SET_0"),              # "CTO sin potencia" → pide puerto
+        ("CONFIRMAR_OBS", "callback", "CONFIRMAR_OBS"),
+        ("CANTIDAD_PUERTOS", "callback", "SET_CANT_PTO_1"),
+        ("PUERTO_REPORTADO", "callback", "SET_PTO_3"),
+        ("CONFIRMAR_PUERTO_REPORTADO", "callback", "CONFIRMAR_PUERTO_REPORTADO"),
+        ("FOTO_PUERTO", "foto", "FOTO_PUERTO"),
+        ("CONFIRMAR_FOTO_PUERTO", "callback", "CONFIRMAR_FOTO_PUERTO"),
+        ("FINAL_GUARDAR", "callback", "FINAL_GUARDAR"),
+    ]
+    return pasos
+
+
+class Simulador:
+    def __init__(self, app):
+        self.app = app
+        self._update_id = 0
+        self.muestras: dict[str, list] = {}
+
+    def _update(self, user_id, tipo, dato) -> Update:
+        self._update_id += 1
+        usuario = {"id": user_id, "is_bot": False, "first_name": f"Tecnico {user_id}"}
+        mensaje = {"message_id": self._update_id, "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": usuario}
+        if tipo == "callback":
+            mensaje["from"] = {"id": 1, "is_bot": True, "first_name": "Bench"}
+            return Update.de_json({"update_id": self._update_id, "callback_query": {
+                "id": str(self._update_id), "from": usuario, "chat_instance": str(user_id),
+                "message": mensaje, "data": dato}}, self.app.bot)
+        if tipo == "comando":
+            mensaje.update(text=dato, entities=[{"type": "bot_command", "offset": 0, "length": len(dato)}])
+        elif tipo == "texto":
+            mensaje["text"] = dato
+        elif tipo == "ubicacion":
+            mensaje["location"] = {"latitude": dato[0], "longitude": dato[1]}
+        elif tipo == "foto":
+            file_id = f"{dato}-{user_id}-{self._update_id}"
+            mensaje["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 2000, "height": 1500}]
+        return Update.de_json({"update_id": self._update_id, "message": mensaje}, self.app.bot)
+
+    async def enviar(self, update):
+        """Mismo camino que un update real: procesador por usuario → Application.process_update."""
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+
+    async def tecnico(self, user_id: int, registros: int) -> int:
+        completos = 0
+        for _ in range(registros):
+            lat, lng = -12.12 + random.uniform(-0.05, 0.05), -77.03 + random.uniform(-0.05, 0.05)
+            for etiqueta, tipo, dato in guion(random.choice(CAJAS_FALSAS), lat, lng):
+                inicio = time.perf_counter()
+                await self.enviar(self._update(user_id, tipo, dato))
+                self.muestras.setdefault(etiqueta, []).append(time.perf_counter() - inicio)
+            ud = self.app.user_data.get(user_id, {})
+            completos += not ud.get("registro", {}).get("ACTIVO")
+        return completos
+
+
+def _percentiles(datos):
+    if len(datos) == 1:
+        return datos[0], datos[0], datos[0]
+    q = statistics.quantiles(datos, n=100, method="inclusive")
+    return q[49], q[94], q[98]
+
+
+async def correr_nivel(tecnicos: int, args, foto: bytes, base_usuario: int):
+    google = ClientesGoogleFalsos(args.lat_sheets, args.lat_drive)
+    main.clientes_google = google
+    main.invalidar_encabezados()
+    telegram = TelegramFalso(args.lat_telegram, foto)
+    app = main.crear_aplicacion(webhook=True, request=telegram)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    loop = asyncio.get_running_loop()
+    main._geo_http = (loop, httpx.AsyncClient(transport=httpx.MockTransport(_geocoding_falso(args.lat_geo))),
+                      asyncio.Semaphore(main.GEO_MAX_CONCURRENCIA))
+
+    sim = Simulador(app)
+    inicio = time.perf_counter()
+    completos = await asyncio.gather(*(sim.tecnico(base_usuario + i, args.registros) for i in range(tecnicos)))
+    duracion = time.perf_counter() - inicio
+
+    await main.difusor.drenar(timeout=0.1)   # los avisos a supervisión no cuentan en el throughput
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)              # vacía la cola de Sheets antes de contar filas
+
+    total = sum(completos)
+    print(f"\n👷 {tecnicos} técnico(s) · {total}/{tecnicos * args.registros} registros en {duracion:.2f}s "
+          f"→ {total / duracion:.2f} registros/s · filas en Sheets: {google.filas_escritas()} · "
+          f"fotos en Drive: {google._drive.subidas}")
+    llamadas = sum(telegram.llamadas.values())
+    print(f"   Bot API: {llamadas} llamadas ({llamadas / max(total, 1):.1f}/registro) · "
+          + ", ".join(f"{m} {n}" for m, n in telegram.llamadas.most_common(6)))
+    print(f"   {'paso':<28} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for etiqueta, _, _ in guion("", 0, 0):
+        datos = sim.muestras.get(etiqueta)
+        if datos:
+            p50, p95, p99 = _percentiles(datos)
+            print(f"   {etiqueta:<28} {len(datos):>6} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {p99 * 1000:>9.1f}")
+
+
+async def correr(args):
+    foto = _foto_jpeg()
+    main.GOOGLE_MAPS_API_KEY = main.GOOGLE_MAPS_API_KEY or "clave-falsa"
+    print(f"⚙️  Latencias inyectadas (ms): telegram={args.lat_telegram} sheets={args.lat_sheets} "
+          f"drive={args.lat_drive} geocoding={args.lat_geo} · DATA_DIR={main.DATA_DIR}")
+    for n, tecnicos in enumerate(args.tecnicos):
+        await correr_nivel(tecnicos, args, foto, base_usuario=1_000_000 * (n + 1))
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tecnicos", type=lambda s: [int(x) for x in s.split(",")], default=[1, 50, 500],
+                        help="niveles de concurrencia separados por comas")
+    parser.add_argument("--registros", type=int, default=1, help="registros seguidos por técnico")
+    parser.add_argument("--lat-telegram", type=float, default=40)
+    parser.add_argument("--lat-sheets", type=float, default=300)
+    parser.add_argument("--lat-drive", type=float, default=400)
+    parser.add_argument("--lat-geo", type=float, default=150)
+    parser.add_argument("--verbose", action="store_true", help="conserva los logs INFO del bot")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(correr(args))
+
+
+if __name__ == "__main__":
+    main_bench()
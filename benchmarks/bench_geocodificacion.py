@@ -0,0 +1,109 @@
+"""
+Benchmark de geocodificación: límites locales (GEO_LIMITES_PATH) vs Google Maps API.
+
+Usa coordenadas históricas: un CSV exportado de la hoja de incidencias (columnas
+LAT_CAJA y LNG_CAJA) o, con --desde-sheet, las filas de la hoja principal.
+
+    python benchmarks/bench_geocodificacion.py --csv incidencias.csv --remoto 50
+
+Requiere el mismo entorno que el bot (GCP_SA_PATH, GOOGLE_MAPS_API_KEY, GEO_LIMITES_PATH).
+El backend remoto consume cuota de pago: por defecto solo se consulta una muestra.
+"""
+import argparse
+import asyncio
+import csv
+import os
+import statistics
+import sys
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def _coordenadas_csv(ruta):
+    with open(ruta, newline="", encoding="utf-8") as f:
+        for fila in csv.DictReader(f):
+            try:
+                yield float(fila["LAT_CAJA"]), float(fila["LNG_CAJA"])
+            except (KeyError, TypeError, ValueError):
+                continue
+
+
+def _coordenadas_sheet():
+    for fila in main.clientes_google.hoja().get_all_records():
+        try:
+            yield float(fila["LAT_CAJA"]), float(fila["LNG_CAJA"])
+        except (KeyError, TypeError, ValueError):
+            continue
+
+
+def _normalizar(texto):
+    texto = unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode()
+    return texto.upper().replace("PROVINCIA DE ", "").strip()
+
+
+def _medir(funcion, coords):
+    tiempos, resultados = [], []
+    for lat, lng in coords:
+        inicio = time.perf_counter()
+        resultados.append(funcion(lat, lng))
+        tiempos.append(time.perf_counter() - inicio)
+    return tiempos, resultados
+
+
+def _reporte(nombre, tiempos):
+    if not tiempos:
+        print(f"{nombre:<8} sin datos")
+        return
+    ordenados = sorted(tiempos)
+    p95 = ordenados[min(len(ordenados) - 1, int(len(ordenados) * 0.95))]
+    print(
+        f"{nombre:<8} n={len(tiempos):<6} media={statistics.mean(tiempos) * 1e6:10.1f} µs  "
+        f"p50={statistics.median(tiempos) * 1e6:10.1f} µs  p95={p95 * 1e6:10.1f} µs"
+    )
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--csv", help="CSV con columnas LAT_CAJA y LNG_CAJA")
+    parser.add_argument("--desde-sheet", action="store_true", help="leer coordenadas de la hoja principal")
+    parser.add_argument("--remoto", type=int, default=20, help="cantidad de puntos a consultar en Google (0 = ninguno)")
+    args = parser.parse_args()
+
+    if args.csv:
+        coords = list(_coordenadas_csv(args.csv))
+    elif args.desde_sheet:
+        coords = list(_coordenadas_sheet())
+    else:
+        parser.error("indica --csv o --desde-sheet")
+    print(f"📍 {len(coords)} coordenadas históricas")
+
+    local = main.obtener_geocodificador_local()
+    if not local:
+        sys.exit("GEO_LIMITES_PATH no está configurado o no se pudo cargar.")
+
+    t_local, r_local = _medir(local.buscar, coords)
+    fuera = sum(1 for r in r_local if r is None)
+    _reporte("local", t_local)
+    print(f"         fuera de todo polígono: {fuera} ({fuera / max(1, len(coords)):.1%})")
+
+    if args.remoto:
+        muestra = coords[:args.remoto]
+        loop = asyncio.new_event_loop()
+        remoto = lambda lat, lng: loop.run_until_complete(main.geocodificar_google(lat, lng))
+        t_remoto, r_remoto = _medir(remoto, muestra)
+        loop.run_until_complete(main.cerrar_sesion_geocodificacion())
+        loop.close()
+        _reporte("google", t_remoto)
+        comparables = [(a, b) for a, b in zip(r_local, r_remoto) if a and b != ("-", "-", "-")]
+        coinciden = sum(1 for a, b in comparables if _normalizar(a[2]) == _normalizar(b[2]))
+        print(f"         distrito coincidente: {coinciden}/{len(comparables)}")
+        if t_remoto and t_local:
+            print(f"⚡ aceleración local vs google: x{statistics.mean(t_remoto) / statistics.mean(t_local):,.0f}")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,131 @@
+"""
+Micro-benchmark de CPU por handler: botoneras reconstruidas en cada llamada vs TECLADOS preconstruidos.
+
+"antes" reproduce la construcción que hacían los handlers en cada llamada; "después" ejecuta
+los handlers actuales (que toman la instancia de TECLADOS) contra un bot falso, sin red.
+
+    python benchmarks/bench_teclados.py --iteraciones 20000
+
+Requiere el mismo entorno que el bot (GCP_SA_PATH, BOT_TOKEN) solo para importar main.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+
+# ---------- construcción "antes": igual a la que hacía cada handler ----------
+def _antes_tipo_cuadrilla():
+    opciones = ["AVERIAS ALTO VALOR", "AVERIAS PREFERENTE", "AVERIAS PROVINCIA", "POSTVENTA LIMA", "POSTVENTA PROVINCIA"]
+    return InlineKeyboardMarkup([[InlineKeyboardButton(opc, callback_data=f"SET_TC_{opc}")] for opc in opciones])
+
+
+def _antes_puertos():
+    keyboard, row = [], []
+    for i in range(1, 18):
+        row.append(InlineKeyboardButton(str(i), callback_data=f"SET_PTO_{i}"))
+        if len(row) == 4:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _antes_obs(tipo="CTO"):
+    keyboard = [[InlineKeyboardButton(obs, callback_data=f"OBS_SET_{idx}")]
+                for idx, obs in enumerate(main.OBS_OPCIONES[tipo])]
+    keyboard.append([InlineKeyboardButton("🔙 Volver", callback_data="OBS_BACK")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _antes_confirmar(paso="TICKET"):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_{paso}"),
+        InlineKeyboardButton("✏️ Corregir", callback_data=f"CORREGIR_{paso}"),
+    ]])
+
+
+def _antes_final_corregir():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎫 Ticket", callback_data="EDITAR_TICKET")],
+        [InlineKeyboardButton("👥 Tipo Cuadrilla", callback_data="EDITAR_TIPO_CUADRILLA")],
+        [InlineKeyboardButton("🏷 Código CTO/NAP/FAT", callback_data="EDITAR_CODIGO_CAJA")],
+        [InlineKeyboardButton("📍 Ubicación CTO/NAP/FAT", callback_data="EDITAR_UBICACION_CTO")],
+        [InlineKeyboardButton("📸 Foto (Exterior)", callback_data="EDITAR_FOTO_CAJA"), InlineKeyboardButton("📸 Foto (Interior)", callback_data="EDITAR_FOTO_CAJA_ABIERTA")],
+        [InlineKeyboardButton("📸 Foto (Medición)", callback_data="EDITAR_FOTO_MEDICION"), InlineKeyboardButton("📝 Observación", callback_data="EDITAR_OBS")],
+    ])
+
+
+# ---------- handlers actuales contra un bot falso ----------
+class _BotFalso:
+    async def send_message(self, **kwargs):
+        return SimpleNamespace(message_id=1)
+
+    async def delete_messages(self, **kwargs):
+        return True
+
+
+def _contexto():
+    return SimpleNamespace(bot=_BotFalso(), user_data={"registro": {"CANTIDAD_PUERTOS_TOTAL": 2}})
+
+
+def _medir(funcion, iteraciones):
+    """Tiempo de CPU (process_time) por llamada, en lotes de 100 para no medir el reloj."""
+    muestras = []
+    for _ in range(max(1, iteraciones // 100)):
+        inicio = time.process_time()
+        for _ in range(100):
+            funcion()
+        muestras.append((time.process_time() - inicio) / 100)
+    return muestras
+
+
+def _reporte(nombre, antes, despues):
+    a, d = statistics.median(antes) * 1e6, statistics.median(despues) * 1e6
+    print(f"{nombre:<18} antes={a:8.2f} µs  después={d:8.2f} µs  x{a / d if d else float('inf'):,.1f}")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iteraciones", type=int, default=20000)
+    args = parser.parse_args()
+    n = args.iteraciones
+
+    print("⌨️  Solo construcción de la botonera")
+    _reporte("tipo_cuadrilla", _medir(_antes_tipo_cuadrilla, n), _medir(lambda: main.TECLADOS["TIPO_CUADRILLA"], n))
+    _reporte("puertos (17)", _medir(_antes_puertos, n), _medir(lambda: main.TECLADOS["PUERTOS"], n))
+    _reporte("obs CTO", _medir(_antes_obs, n), _medir(lambda: main.TECLADOS["OBS_CTO"], n))
+    _reporte("confirmar", _medir(_antes_confirmar, n), _medir(lambda: main.teclado_confirmar("TICKET"), n))
+    _reporte("final_corregir", _medir(_antes_final_corregir, n), _medir(lambda: main.TECLADOS["FINAL_CORREGIR"], n))
+
+    print("🤖 Handler completo (bot falso, sin red)")
+    loop = asyncio.new_event_loop()
+    ctx = _contexto()
+
+    def _menu_obs():
+        ctx.user_data["registro"].pop("ULTIMO_MENSAJE_OBS", None)  # sin borrados pendientes en el planificador
+        return main.mostrar_menu_obs(1, ctx, tipo="CTO")
+
+    handlers = {
+        "menu_puerto": (lambda: main.mostrar_menu_puerto(1, ctx), _antes_puertos),
+        "menu_tipo_cuadrilla": (lambda: main.mostrar_menu_tipo_cuadrilla(1, ctx), _antes_tipo_cuadrilla),
+        "menu_obs CTO": (_menu_obs, _antes_obs),
+    }
+    for nombre, (handler, construir) in handlers.items():
+        despues = statistics.median(_medir(lambda: loop.run_until_complete(handler()), n // 10))
+        antes = despues + statistics.median(_medir(construir, n // 10))  # handler + botonera reconstruida
+        print(f"{nombre:<18} antes≈{antes * 1e6:8.2f} µs  después={despues * 1e6:8.2f} µs  x{antes / despues:,.1f}")
+    loop.close()
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -1,30 +1,282 @@
 import os, io, json, uuid, logging, time
+_T_ARRANQUE = time.perf_counter()  # ⏱️ referencia del reporte de arranque (antes de cualquier import pesado)
 import re
-from datetime import datetime
+import importlib
+import csv
+import shlex
+import tempfile
+import atexit
+import contextvars
+import queue
+import logging.handlers
+import zlib
+import contextlib
+import functools
+import inspect
+import threading
+import sqlite3
+import pickle
+import hashlib
+import multiprocessing
+from collections import OrderedDict, Counter
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, date, timedelta
 import asyncio
 from telegram.error import NetworkError
 import sys
 import nest_asyncio
-import pandas as pd
 from pytz import timezone
 from dotenv import load_dotenv
-import requests
+import random
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, ConversationHandler, filters
+    ContextTypes, ConversationHandler, filters, BasePersistence, PersistenceInput, BaseUpdateProcessor
 )
-from telegram.error import BadRequest
-import gspread
-from google.oauth2.service_account import Credentials
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from telegram.error import BadRequest, RetryAfter, TimedOut
 import logging
 
 nest_asyncio.apply()  # ✅ evita conflictos en Windows o VSCode
 
+
+# ======== ⏱️ ARRANQUE E IMPORTS DIFERIDOS ========
+class RelojArranque:
+    """
+    Marcas de tiempo del arranque, en segundos desde que empezó a cargarse main.py,
+    y lo que tardó cada import diferido en su primer uso. `reporte()` arma la línea de log.
+    """
+
+    def __init__(self, t0: float):
+        self.t0 = t0
+        self.marcas: dict[str, float] = {}
+        self.imports: dict[str, float] = {}
+
+    def marcar(self, nombre: str):
+        """Registra la marca solo la primera vez (p. ej. 'primer_update')."""
+        if nombre not in self.marcas:
+            self.marcas[nombre] = time.perf_counter() - self.t0
+
+    def reporte(self) -> str:
+        partes = [f"{nombre} {seg:.2f}s" for nombre, seg in self.marcas.items()]
+        if self.imports:
+            partes.append("diferidos: " + ", ".join(f"{m} {seg * 1000:.0f}ms" for m, seg in self.imports.items()))
+        return " · ".join(partes)
+
+
+arranque = RelojArranque(_T_ARRANQUE)
+
+
+class ModuloPerezoso:
+    """
+    Sustituto de un módulo que se importa en el primer acceso a un atributo
+    (gspread.authorize, Image.open...). El import queda anotado en `arranque`.
+    """
+
+    def __init__(self, nombre: str):
+        self._nombre = nombre
+        self._modulo = None
+        self._lock = threading.Lock()
+
+    def _cargar(self):
+        if self._modulo is None:
+            with self._lock:
+                if self._modulo is None:
+                    inicio = time.perf_counter()
+                    modulo = importlib.import_module(self._nombre)
+                    arranque.imports[self._nombre] = time.perf_counter() - inicio
+                    self._modulo = modulo
+        return self._modulo
+
+    def __getattr__(self, atributo):
+        return getattr(self._cargar(), atributo)
+
+    def __repr__(self):
+        estado = "cargado" if self._modulo is not None else "sin cargar"
+        return f"<ModuloPerezoso {self._nombre} ({estado})>"
+
+
+# ☁️ Google y Pillow solo se importan cuando se usan (arranque rápido en Render)
+gspread = ModuloPerezoso("gspread")
+google_sa = ModuloPerezoso("google.oauth2.service_account")
+google_auth_requests = ModuloPerezoso("google.auth.transport.requests")
+gapi_discovery = ModuloPerezoso("googleapiclient.discovery")
+gapi_http = ModuloPerezoso("googleapiclient.http")
+gapi_errors = ModuloPerezoso("googleapiclient.errors")
+Image = ModuloPerezoso("PIL.Image")
+ImageOps = ModuloPerezoso("PIL.ImageOps")
+xlsxwriter = ModuloPerezoso("xlsxwriter")
+arranque.marcar("imports")
+
+
+# ======== 📈 MÉTRICAS EN MEMORIA ========
+# Histogramas de latencia, contadores de error y gauges de llamadas en curso por
+# (familia, etiquetas). Familias: "handler" (estado + callback del ConversationHandler),
+# "dependencia" (Google, geocodificación, Drive), "telegram" (método de la Bot API) y
+# "exportar" (/exportar por formato).
+# Se exponen en formato Prometheus (/metrics del modo webhook) y en /stats (USUARIOS_DEV).
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metricas:
+    """Registro de métricas thread-safe (las dependencias de Google corren en hilos)."""
+
+    def __init__(self, buckets=METRICAS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series: dict[tuple, list] = {}   # (familia, etiquetas) → [conteos por bucket..., suma, total, errores, en_curso]
+        self._fuentes: dict = {}               # nombre → callable que devuelve {clave: número}
+
+    def _serie(self, familia: str, etiquetas: tuple) -> list:
+        serie = self._series.get((familia, etiquetas))
+        if serie is None:
+            serie = self._series[(familia, etiquetas)] = [0] * (len(self.buckets) + 1) + [0.0, 0, 0, 0]
+        return serie
+
+    def iniciar(self, familia: str, etiquetas: tuple):
+        with self._lock:
+            self._serie(familia, etiquetas)[-1] += 1
+
+    def observar(self, familia: str, etiquetas: tuple, segundos: float, error: bool = False):
+        with self._lock:
+            serie = self._serie(familia, etiquetas)
+            serie[bisect_left(self.buckets, segundos)] += 1
+            serie[-4] += segundos
+            serie[-3] += 1
+            serie[-2] += error
+            serie[-1] -= 1
+
+    @contextlib.contextmanager
+    def medir(self, familia: str, **etiquetas):
+        """Mide el bloque: latencia, error si sale por excepción y gauge en curso."""
+        clave = tuple(sorted(etiquetas.items()))
+        self.iniciar(familia, clave)
+        inicio = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observar(familia, clave, time.perf_counter() - inicio, error)
+
+    def registrar_fuente(self, nombre: str, funcion):
+        """Gauges externos (colas, cachés): se leen al momento de exportar."""
+        self._fuentes[nombre] = funcion
+
+    def instantanea(self) -> dict:
+        with self._lock:
+            return {clave: list(serie) for clave, serie in self._series.items()}
+
+    def _leer_fuentes(self):
+        for nombre, funcion in list(self._fuentes.items()):
+            try:
+                valores = funcion()
+            except Exception:
+                continue
+            for clave, valor in valores.items():
+                if isinstance(valor, (int, float)):
+                    yield f"bot_{nombre}_{clave}", valor
+
+    def percentil(self, serie: list, q: float) -> float:
+        """Cota superior del bucket que contiene el percentil q (inf si cae en el último)."""
+        objetivo = q * serie[-3]
+        acumulado = 0
+        for limite, conteo in zip(self.buckets + (float("inf"),), serie):
+            acumulado += conteo
+            if acumulado >= objetivo:
+                return limite
+        return float("inf")
+
+    def prometheus(self) -> str:
+        """Formato de texto de Prometheus: cada métrica agrupada bajo su línea TYPE."""
+        por_familia: dict[str, list] = {}
+        for (familia, etiquetas), serie in sorted(self.instantanea().items()):
+            por_familia.setdefault(familia, []).append((",".join(f'{k}="{v}"' for k, v in etiquetas), serie))
+
+        lineas = []
+        for familia, series in por_familia.items():
+            nombre = f"bot_{familia}"
+            lineas.append(f"# TYPE {nombre}_segundos histogram")
+            for base, serie in series:
+                sep = "," if base else ""
+                acumulado = 0
+                for limite, conteo in zip(self.buckets + (float("inf"),), serie):
+                    acumulado += conteo
+                    le = "+Inf" if limite == float("inf") else repr(limite)
+                    lineas.append(f'{nombre}_segundos_bucket{{{base}{sep}le="{le}"}} {acumulado}')
+                lineas.append(f"{nombre}_segundos_sum{{{base}}} {serie[-4]:.6f}")
+                lineas.append(f"{nombre}_segundos_count{{{base}}} {serie[-3]}")
+            lineas.append(f"# TYPE {nombre}_errores_total counter")
+            lineas += [f"{nombre}_errores_total{{{base}}} {serie[-2]}" for base, serie in series]
+            lineas.append(f"# TYPE {nombre}_en_curso gauge")
+            lineas += [f"{nombre}_en_curso{{{base}}} {serie[-1]}" for base, serie in series]
+        for nombre, valor in self._leer_fuentes():
+            lineas += [f"# TYPE {nombre} gauge", f"{nombre} {valor}"]
+        return "\n".join(lineas) + "\n"
+
+    def resumen(self) -> str:
+        """Texto corto para /stats: llamadas, p50/p95, errores y en curso por serie."""
+        lineas = []
+        for (familia, etiquetas), serie in sorted(self.instantanea().items()):
+            nombre = "/".join(str(v) for _, v in etiquetas)
+            p50, p95 = self.percentil(serie, 0.5), self.percentil(serie, 0.95)
+            lineas.append(
+                f"{familia} {nombre}: n={serie[-3]} p50≤{p50:g}s p95≤{p95:g}s "
+                f"err={serie[-2]} en_curso={serie[-1]}"
+            )
+        lineas += [f"{nombre} = {valor}" for nombre, valor in self._leer_fuentes()]
+        return "\n".join(lineas) or "Sin datos todavía."
+
+
+metricas = Metricas()
+
+
+def instrumentar(familia: str, **etiquetas):
+    """Decorador: mide cada llamada (síncrona o async) con metricas.medir."""
+    def decorador(funcion):
+        if inspect.iscoroutinefunction(funcion):
+            @functools.wraps(funcion)
+            async def envoltura_async(*args, **kwargs):
+                with metricas.medir(familia, **etiquetas):
+                    return await funcion(*args, **kwargs)
+            return envoltura_async
+
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with metricas.medir(familia, **etiquetas):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+class RequestInstrumentado(HTTPXRequest):
+    """HTTPXRequest que mide cada llamada a la Bot API por método (sendMessage, deleteMessages...)."""
+
+    @staticmethod
+    def metodo_de_url(url: str) -> str:
+        """
+        "sendMessage" para .../bot<token>/sendMessage; cualquier otra ruta (descargas de
+        .../file/bot<token>/photos/file_N.jpg) se agrupa en "descarga" para no abrir una serie por archivo.
+        """
+        prefijo, _, ultimo = url.rpartition("/")
+        if prefijo.rpartition("/")[2].startswith("bot") and "/file/bot" not in prefijo:
+            return ultimo
+        return "descarga"
+
+    async def do_request(self, url, method, *args, **kwargs):
+        clave = (("metodo", self.metodo_de_url(url)),)
+        metricas.iniciar("telegram", clave)
+        inicio = time.perf_counter()
+        codigo = None
+        try:
+            codigo, cuerpo = await super().do_request(url, method, *args, **kwargs)
+            return codigo, cuerpo
+        finally:
+            metricas.observar("telegram", clave, time.perf_counter() - inicio, codigo is None or codigo >= 400)
+
 # ======== ENV ========
 
 load_dotenv()
@@ -47,9 +299,8 @@ GCP_SA_JSON = os.getenv("GCP_SA_PATH")
 if not GCP_SA_JSON:
     raise ValueError("⚠️ Variable de entorno GCP_SA_PATH vacía o no definida")
 
-# Convierte el texto JSON a diccionario
+# Convierte el texto JSON a diccionario (las credenciales se crean en el primer uso)
 service_account_info = json.loads(GCP_SA_JSON)
-creds = Credentials.from_service_account_info(service_account_info, scopes=SCOPES)
 
 
 # 🌍 API Key de Google Maps
@@ -57,12 +308,18 @@ GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 
 CARPETA_BASE = "REPORTE_INCIDENCIAS"
 
+# 💽 Carpeta local para cachés y archivos de estado
+DATA_DIR = os.getenv("DATA_DIR", ".")
+os.makedirs(DATA_DIR, exist_ok=True)
+
 SHEET_NAME = "Hoja1"
 ENCABEZADOS = [
     "USER_ID", "FECHA", "HORA", "PARTNER", "TIPO_CUADRILLA", "CUADRILLA", "TICKET", "DNI", "NOMBRE_CLIENTE",
     "NODO", "CODIGO_CAJA", "FOTO_CAJA", "FOTO_CAJA_ABIERTA", "FOTO_MEDICION", "LAT_CAJA", "LNG_CAJA",
-    "DEPARTAMENTO", "PROVINCIA", "DISTRITO", "OBS", "PUERTO_REPORTADO", "FOTO_PUERTO"
+    "DEPARTAMENTO", "PROVINCIA", "DISTRITO", "OBS", "PUERTO_REPORTADO", "FOTO_PUERTO",
+    "ID_REGISTRO",  # 🔑 clave de idempotencia (columna oculta)
 ]
+COL_ID_REGISTRO = ENCABEZADOS.index("ID_REGISTRO")
 
 # AÑADIR DESPLEGABLE ALTERNATIVO
 OBS_REQUIERE_PUERTO = [
@@ -126,91 +383,765 @@ def _detectar_tipo_por_codigo(codigo: str) -> str | None:
 USUARIOS_DEV = {7175478712, 798153777}
 GRUPO_SUPERVISION_ID = [-4829763481]  # si quieres enviar resumen al grupo, pon IDs aquí
 
-# Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger(__name__)
+# ======================================
+# 📝 LOGGING ESTRUCTURADO EN SEGUNDO PLANO
+# ======================================
+# Los handlers solo encolan el LogRecord (QueueHandler); un hilo (QueueListener) formatea
+# y escribe en stderr, así la E/S de logs nunca frena al event loop.
+# Cada línea lleva user_id, id_registro y paso del update en curso (contextvar que fijan los
+# handlers del ConversationHandler; las tareas y hilos lanzados desde ahí lo heredan).
+#   LOG_FORMATO=json | texto
+#   LOG_MUESTREO="httpx:0.1,main:0.5" → fracción de líneas INFO/DEBUG que se conservan por logger.
+#   Los mensajes usan argumentos estilo % (no f-strings): solo se formatean en el hilo del
+#   QueueListener, así una línea descartada por nivel o muestreo no paga el formateo.
+#   El muestreo por registro es determinista: se conservan o descartan todas sus líneas juntas.
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO").upper()
+LOG_FORMATO = os.getenv("LOG_FORMATO", "json").lower()
+LOG_MUESTREO = {
+    nombre.strip(): float(fraccion)
+    for nombre, _, fraccion in (p.partition(":") for p in os.getenv("LOG_MUESTREO", "httpx:0.1").split(",") if ":" in p)
+}
+
+contexto_log: contextvars.ContextVar[dict] = contextvars.ContextVar("contexto_log", default={})
+
+
+class FiltroContextoLog(logging.Filter):
+    """Copia el contexto del update al record (corre en el hilo que loguea, antes de encolar)."""
+
+    def filter(self, record):
+        ctx = contexto_log.get()
+        record.user_id = ctx.get("user_id")
+        record.id_registro = ctx.get("id_registro")
+        record.paso = ctx.get("paso")
+        return True
+
+
+class FiltroMuestreo(logging.Filter):
+    """Conserva solo una fracción de las líneas INFO/DEBUG de los loggers configurados."""
+
+    def __init__(self, fracciones: dict):
+        super().__init__()
+        self.fracciones = fracciones
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not self.fracciones:
+            return True
+        fraccion = self.fracciones.get(record.name, self.fracciones.get(record.name.split(".")[0]))
+        if fraccion is None or fraccion >= 1:
+            return True
+        id_registro = getattr(record, "id_registro", None)
+        if id_registro:
+            return zlib.crc32(id_registro.encode()) % 10000 < fraccion * 10000
+        return random.random() < fraccion
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        linea = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for campo in ("user_id", "id_registro", "paso"):
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                linea[campo] = valor
+        if record.exc_info:
+            linea["exc"] = self.formatException(record.exc_info)
+        return json.dumps(linea, ensure_ascii=False, default=str)
+
+
+class ColaLogs(logging.handlers.QueueHandler):
+    """
+    QueueHandler sin formateo en el llamador: el record viaja tal cual (misma memoria de proceso)
+    y el hilo del QueueListener hace todo el trabajo de formato.
+    Si algún argumento es mutable (un dict de registro, una excepción…), el mensaje se formatea
+    aquí: en el listener ya podría mostrar valores posteriores al evento.
+    """
+
+    ARGS_INMUTABLES = (str, int, float, bool, bytes, type(None))
+
+    def prepare(self, record):
+        args = record.args
+        # Un único dict como argumento llega como record.args (estilo "%(clave)s"): también es mutable
+        if args and (isinstance(args, dict) or not all(isinstance(a, self.ARGS_INMUTABLES) for a in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def configurar_logging():
+    """Root logger → QueueHandler (con contexto y muestreo) → QueueListener → stderr."""
+    cola = queue.SimpleQueue()
+    salida_log = logging.StreamHandler()
+    if LOG_FORMATO == "json":
+        salida_log.setFormatter(FormatoJSON())
+    else:
+        salida_log.setFormatter(logging.Formatter(
+            "%(asctime)s - %(levelname)s - [%(user_id)s %(id_registro)s %(paso)s] %(message)s"
+        ))
+    manejador = ColaLogs(cola)
+    manejador.addFilter(FiltroContextoLog())
+    manejador.addFilter(FiltroMuestreo(LOG_MUESTREO))
+
+    raiz = logging.getLogger()
+    for previo in list(raiz.handlers):
+        raiz.removeHandler(previo)
+    raiz.addHandler(manejador)
+    nivel_valido = isinstance(logging.getLevelName(LOG_NIVEL), int)
+    raiz.setLevel(LOG_NIVEL if nivel_valido else logging.INFO)
+
+    oyente = logging.handlers.QueueListener(cola, salida_log, respect_handler_level=True)
+    oyente.start()
+    if not nivel_valido:
+        logging.getLogger("main").warning("⚠️ LOG_NIVEL=%s no es un nivel válido; se usa INFO.", LOG_NIVEL)
+    atexit.register(oyente.stop)  # vacía la cola al salir
+    return oyente
+
+
+oyente_log = configurar_logging()
+logger = logging.getLogger("main")  # nombre fijo: con "python main.py" __name__ sería "__main__"
 
 # ======================================
 # ☁️ GOOGLE SHEETS SYNC
 # ======================================
 
+# ======================================
+# 🔌 CLIENTES GOOGLE PERSISTENTES (UNO POR PROCESO)
+# ======================================
+class ClientesGoogle:
+    """
+    Registro de clientes Google reutilizables en todo el proceso:
+    un cliente gspread autorizado, la hoja principal ya abierta y un servicio Drive
+    por hilo (httplib2 no es thread-safe). El token se refresca antes de expirar.
+    Las credenciales se crean en el primer uso, junto con el import de google-auth.
+    `construcciones` cuenta cuántas veces se creó cada cliente.
+    """
+
+    MARGEN_REFRESCO = 300  # segundos antes de la expiración para refrescar el token
+
+    def __init__(self, info_cuenta: dict):
+        self._info_cuenta = info_cuenta
+        self._creds_cache = None
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._gc = None
+        self._hoja = None
+        self.construcciones = {"gspread": 0, "hoja": 0, "drive": 0, "token": 0}
+
+    @property
+    def _creds(self):
+        if self._creds_cache is None:
+            with self._lock:
+                if self._creds_cache is None:
+                    self._creds_cache = google_sa.Credentials.from_service_account_info(self._info_cuenta, scopes=SCOPES)
+        return self._creds_cache
+
+    def _refrescar_token(self):
+        """Refresca el token de la Service Account si falta poco para que expire."""
+        expira = self._creds.expiry
+        if self._creds.valid and expira and (expira - datetime.utcnow()).total_seconds() > self.MARGEN_REFRESCO:
+            return
+        with self._lock:
+            expira = self._creds.expiry
+            if self._creds.valid and expira and (expira - datetime.utcnow()).total_seconds() > self.MARGEN_REFRESCO:
+                return
+            self._creds.refresh(google_auth_requests.Request())
+            self.construcciones["token"] += 1
+            logger.info("🔑 Token de Google refrescado proactivamente.")
+
+    def gspread(self):
+        """Cliente gspread autorizado (se construye una sola vez)."""
+        self._refrescar_token()
+        if self._gc is None:
+            with self._lock:
+                if self._gc is None:
+                    self._gc = gspread.authorize(self._creds)
+                    self.construcciones["gspread"] += 1
+                    logger.info("🔌 Cliente gspread creado.")
+        return self._gc
+
+    def hoja(self):
+        """Worksheet principal (SPREADSHEET_ID) ya abierta."""
+        gc = self.gspread()
+        if self._hoja is None:
+            with self._lock:
+                if self._hoja is None:
+                    self._hoja = gc.open_by_key(SPREADSHEET_ID).sheet1
+                    self.construcciones["hoja"] += 1
+                    logger.info("📄 Hoja principal de Google Sheets abierta.")
+        return self._hoja
+
+    def drive(self):
+        """Servicio Drive v3 del hilo actual (reutiliza su conexión HTTP)."""
+        self._refrescar_token()
+        service = getattr(self._local, "drive", None)
+        if service is None:
+            service = gapi_discovery.build("drive", "v3", credentials=self._creds, cache_discovery=False)
+            self._local.drive = service
+            with self._lock:
+                self.construcciones["drive"] += 1
+            logger.info("🔌 Servicio Drive creado para el hilo %s.", threading.current_thread().name)
+        return service
+
+    def invalidar_hoja(self):
+        """Olvida la hoja abierta (p. ej. tras un error) para reabrirla en la próxima llamada."""
+        with self._lock:
+            self._hoja = None
+
+
+clientes_google = ClientesGoogle(service_account_info)
+
+
 def _gs_connect():
-    """Conecta a Google Sheets usando Service Account"""
+    """Devuelve la hoja principal usando el cliente persistente de la Service Account"""
     try:
-        gc = gspread.authorize(creds)
-        sheet = gc.open_by_key(SPREADSHEET_ID).sheet1
-        return sheet
+        return clientes_google.hoja()
     except gspread.SpreadsheetNotFound:
         logger.error("❌ No se encontró el Google Sheet. Verifica el SPREADSHEET_ID.")
         raise
     except Exception as e:
-        logger.error(f"❌ Error conectando con Google Sheets: {e}")
+        logger.error("❌ Error conectando con Google Sheets: %s", e)
         raise
 
+# 🧾 Firma (id de la pestaña, ENCABEZADOS) ya verificada: evita leer la fila 1 en cada append
+_encabezados_verificados: tuple | None = None
+_encabezados_lock = threading.Lock()
+
+
+def invalidar_encabezados():
+    """Fuerza a revalidar los encabezados en la próxima escritura."""
+    global _encabezados_verificados
+    _encabezados_verificados = None
+
+
 def gs_ensure_headers(sheet):
-    """Verifica y crea los encabezados si no existen, sin borrar datos previos."""
-    try:
-        expected_headers = ENCABEZADOS
-        current = sheet.row_values(1)
-
-        # Si la hoja está vacía (sin encabezados)
-        if not current:
-            logger.info("📄 Hoja vacía. Creando encabezados...")
-            sheet.update([expected_headers], "A1:S1")
-            logger.info("✅ Encabezados creados correctamente.")
+    """
+    Verifica y crea los encabezados si no existen, sin borrar datos previos.
+    El resultado queda en caché por proceso: solo se vuelve a leer la fila 1 si
+    cambia la pestaña o ENCABEZADOS, o tras invalidar_encabezados().
+    """
+    global _encabezados_verificados
+    firma = (sheet.id, tuple(ENCABEZADOS))
+    if _encabezados_verificados == firma:
+        return
+
+    with _encabezados_lock:
+        if _encabezados_verificados == firma:
             return
+        try:
+            expected_headers = ENCABEZADOS
+            current = sheet.row_values(1)
+            rango = f"A1:{gspread.utils.rowcol_to_a1(1, len(expected_headers))}"
+
+            # Si la hoja está vacía (sin encabezados) o difieren parcialmente → una sola escritura de rango
+            if current != expected_headers:
+                if not current:
+                    logger.info("📄 Hoja vacía. Creando encabezados...")
+                else:
+                    logger.info("🧾 Corrigiendo encabezados sin borrar contenido...")
+                # Solo se escribe la fila 1, no se tocan filas previas
+                sheet.update([expected_headers], rango)
+                sheet.hide_columns(COL_ID_REGISTRO, COL_ID_REGISTRO + 1)  # 🔑 ID_REGISTRO oculto
+                logger.info("✅ Encabezados escritos en %s.", rango)
+            else:
+                logger.debug("🟢 Encabezados ya están correctos.")
+            _encabezados_verificados = firma
 
-        # Si los encabezados difieren parcialmente (ajustar columnas sin borrar contenido)
-        if current != expected_headers:
-            logger.info("🧾 Corrigiendo encabezados sin borrar contenido...")
-            # Solo actualiza celdas de encabezado, no borra filas previas
-            for i, val in enumerate(expected_headers, start=1):
-                if i > len(current) or current[i - 1] != val:
-                    sheet.update_cell(1, i, val)
-            logger.info("✅ Encabezados actualizados sin borrar filas previas.")
-        else:
-            logger.debug("🟢 Encabezados ya están correctos.")
+        except Exception as e:
+            logger.error("❌ Error asegurando encabezados en Google Sheets: %s", e)
 
-    except Exception as e:
-        logger.error(f"❌ Error asegurando encabezados en Google Sheets: {e}")
 
+def _normalizar_fila(fila):
+    """Ajusta la fila al número de columnas de ENCABEZADOS."""
+    fila = list(fila)
+    if len(fila) < len(ENCABEZADOS): fila += [""] * (len(ENCABEZADOS) - len(fila))
+    elif len(fila) > len(ENCABEZADOS): fila = fila[:len(ENCABEZADOS)]
+    return fila
 
-_last_row = None  # variable global arriba del todo
+def _id_como_texto(fila):
+    """
+    Copia de la fila con ID_REGISTRO precedido de "'": con USER_ENTERED Sheets lo guarda como
+    texto literal (sin el apóstrofo) y no lo convierte en número ("00412345" → 412345).
+    """
+    fila = list(fila)
+    clave = str(fila[COL_ID_REGISTRO])
+    if clave and not clave.startswith("'"):
+        fila[COL_ID_REGISTRO] = "'" + clave
+    return fila
 
-def gs_append_row(fila):
-    """Agrega una fila al Google Sheet con tolerancia a errores y evita duplicados inmediatos"""
-    global _last_row
-    try:
-        # Evita duplicado inmediato (misma fila consecutiva)
-        if fila == _last_row:
-            logger.warning("⚠️ Duplicado inmediato evitado, misma fila ya enviada.")
-            return
-        _last_row = fila
 
-        if len(fila) < len(ENCABEZADOS): fila += [""] * (len(ENCABEZADOS) - len(fila))
-        elif len(fila) > len(ENCABEZADOS): fila = fila[:len(ENCABEZADOS)]
+@instrumentar("dependencia", dependencia="gs_append_rows")
+def gs_append_rows(filas):
+    """
+    Agrega varias filas al Google Sheet en una sola petición (values.append).
+    Propaga la excepción para que quien llama decida si reintenta.
+    """
+    if not filas:
+        return
+    filas = [_id_como_texto(_normalizar_fila(f)) for f in filas]
 
-        sheet = _gs_connect()
-        try:
-            gs_ensure_headers(sheet)
-        except Exception as e:
-            logger.warning(f"⚠️ No se pudieron asegurar encabezados: {e}")
+    sheet = _gs_connect()
+    try:
+        gs_ensure_headers(sheet)
+    except Exception as e:
+        logger.warning("⚠️ No se pudieron asegurar encabezados: %s", e)
 
-        sheet.append_row(fila, value_input_option="USER_ENTERED")
-        logger.info("☁️ Fila reflejada correctamente en Google Sheets.")
+    try:
+        sheet.append_rows(filas, value_input_option="USER_ENTERED")
+    except Exception:
+        clientes_google.invalidar_hoja()
+        invalidar_encabezados()
+        raise
+    logger.info("☁️ %s fila(s) reflejada(s) correctamente en Google Sheets.", len(filas))
 
+def gs_append_row(fila):
+    """Agrega una fila al Google Sheet con tolerancia a errores (llamada síncrona)."""
+    try:
+        gs_append_rows([fila])
     except gspread.SpreadsheetNotFound:
         logger.error("❌ ID de Google Sheet inválido o inexistente.")
     except gspread.exceptions.APIError as e:
         if "PERMISSION_DENIED" in str(e):
             logger.error("🚫 Service Account sin acceso. Compártelo con permisos de editor.")
         else:
-            logger.error(f"❌ Error API Google Sheets: {e}")
+            logger.error("❌ Error API Google Sheets: %s", e)
     except Exception as e:
-        logger.error(f"⚠️ Error reflejando en Google Sheets: {e}")
+        logger.error("⚠️ Error reflejando en Google Sheets: %s", e)
+
+
+# ======================================
+# 🔑 ÍNDICE LOCAL DE FILAS YA CONFIRMADAS (IDEMPOTENCIA POR ID_REGISTRO)
+# ======================================
+class FiltroBloom:
+    """Filtro de Bloom simple: sin falsos negativos, falsos positivos acotados."""
+
+    def __init__(self, bits: int = 1 << 20, hashes: int = 7):
+        self.bits = bits
+        self.hashes = hashes
+        self._datos = bytearray(bits // 8)
+
+    def _posiciones(self, clave: str):
+        digest = hashlib.blake2b(clave.encode(), digest_size=8 * self.hashes).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[i * 8:(i + 1) * 8], "little") % self.bits
+
+    def agregar(self, clave: str):
+        for p in self._posiciones(clave):
+            self._datos[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, clave: str) -> bool:
+        return all(self._datos[p >> 3] & (1 << (p & 7)) for p in self._posiciones(clave))
+
+
+class IndiceIdempotencia:
+    """
+    Claves ID_REGISTRO ya escritas en Google Sheets.
+    El filtro de Bloom descarta en memoria las claves nuevas (el caso normal);
+    solo un "quizás" consulta el conjunto en disco (SQLite). Nunca se lee la hoja.
+    """
+
+    def __init__(self, ruta: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS confirmadas (clave TEXT PRIMARY KEY, ts REAL)")
+        self._db.commit()
+        self._bloom = FiltroBloom()
+        total = 0
+        for (clave,) in self._db.execute("SELECT clave FROM confirmadas"):
+            self._bloom.agregar(clave)
+            total += 1
+        logger.info("🔑 Índice de idempotencia cargado: %s registro(s) confirmados.", total)
+
+    def ya_confirmada(self, clave: str) -> bool:
+        if not clave or clave not in self._bloom:
+            return False
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM confirmadas WHERE clave = ?", (clave,)).fetchone() is not None
+
+    def marcar_confirmadas(self, claves):
+        claves = [c for c in claves if c]
+        if not claves:
+            return
+        ahora = time.time()
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO confirmadas (clave, ts) VALUES (?, ?)", [(c, ahora) for c in claves])
+        for c in claves:
+            self._bloom.agregar(c)
+
+
+indice_idempotencia = IndiceIdempotencia(os.path.join(DATA_DIR, "idempotencia.sqlite3"))
+
+
+def gs_claves_existentes() -> set:
+    """Lee la columna ID_REGISTRO de la hoja. Solo se usa para resolver lotes en duda (timeouts)."""
+    return set(_gs_connect().col_values(COL_ID_REGISTRO + 1)[1:])
+
+
+# ======================================
+# 📒 OUTBOX LOCAL (JOURNAL APPEND-ONLY) PARA FILAS DE GOOGLE SHEETS
+# ======================================
+OUTBOX_PATH = os.path.join(DATA_DIR, "outbox.jsonl")
+OUTBOX_FSYNC_MS = float(os.getenv("OUTBOX_FSYNC_MS", "20"))   # ventana de agrupación de fsync
+OUTBOX_COMPACTAR_BYTES = 1 << 20
+
+
+class OutboxJournal:
+    """
+    Journal append-only: cada registro terminado se anota ("fila") y queda durable en disco
+    antes de cualquier llamada a Google; al confirmarse en Sheets se anota un "ok".
+    Los fsync se agrupan: todas las escrituras de una ventana de OUTBOX_FSYNC_MS comparten uno.
+    Al iniciar, las filas sin "ok" se vuelven a encolar (replay tras un crash o corte).
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self.pendientes: dict[str, list] = {}  # ID_REGISTRO → fila (en orden de llegada)
+        self._esperando_fsync: list[asyncio.Future] = []
+        self._fsync_task: asyncio.Task | None = None
+        self._compactacion: asyncio.Task | None = None
+        self._leer()
+        self._archivo = open(ruta, "a", encoding="utf-8")
+
+    def _leer(self):
+        if not os.path.exists(self.ruta):
+            return
+        with open(self.ruta, encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    entrada = json.loads(linea)
+                except json.JSONDecodeError:
+                    continue  # última línea truncada por un corte
+                if entrada.get("t") == "fila":
+                    self.pendientes[entrada["id"]] = entrada["fila"]
+                elif entrada.get("t") == "ok":
+                    self.pendientes.pop(entrada["id"], None)
+        if self.pendientes:
+            logger.info("📒 Outbox con %s fila(s) pendientes de enviar a Sheets.", len(self.pendientes))
+
+    def _escribir(self, entradas):
+        with self._lock:
+            self._archivo.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entradas))
+            self._archivo.flush()
+
+    def _fsync(self):
+        # Bajo el lock solo se duplica el descriptor: el event loop escribe con ese mismo lock y
+        # no debe esperar al disco. El duplicado sigue apuntando al archivo aunque se compacte.
+        with self._lock:
+            fd = os.dup(self._archivo.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    async def _fsync_agrupado(self):
+        await asyncio.sleep(OUTBOX_FSYNC_MS / 1000)
+        esperando, self._esperando_fsync = self._esperando_fsync, []
+        try:
+            await asyncio.to_thread(self._fsync)
+        except Exception as e:
+            for fut in esperando:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut in esperando:
+            if not fut.done():
+                fut.set_result(None)
+
+    async def registrar(self, clave: str, fila: list):
+        """Anota la fila y espera a que esté en disco (fsync agrupado)."""
+        self._escribir([{"t": "fila", "id": clave, "fila": fila, "ts": time.time()}])
+        self.pendientes[clave] = fila
+        fut = asyncio.get_running_loop().create_future()
+        self._esperando_fsync.append(fut)
+        if self._fsync_task is None or self._fsync_task.done():
+            self._fsync_task = asyncio.create_task(self._fsync_agrupado())
+        await fut
+
+    def confirmar(self, claves):
+        """Marca filas como escritas en Sheets (el índice de idempotencia cubre un "ok" perdido)."""
+        claves = [c for c in claves if c in self.pendientes]
+        if not claves:
+            return
+        self._escribir([{"t": "ok", "id": c} for c in claves])
+        for c in claves:
+            self.pendientes.pop(c, None)
+        self._compactar_si_conviene()
+
+    def _compactar_si_conviene(self):
+        """Cuando el journal crece demasiado, lo reescribe solo con lo pendiente en un hilo aparte."""
+        if self._compactacion is not None and not self._compactacion.done():
+            return
+        with self._lock:
+            desde = self._archivo.tell()
+        if desde < OUTBOX_COMPACTAR_BYTES:
+            return
+        self._compactacion = asyncio.create_task(asyncio.to_thread(self._compactar, dict(self.pendientes), desde))
+
+    def _compactar(self, pendientes: dict, desde: int):
+        """
+        Escribe la foto de lo pendiente a un temporal y le agrega lo anotado en el journal después
+        de la foto (desde `desde`), todo con fsync y sin el lock. El lock solo cubre comprobar que
+        no llegó nada nuevo y cambiar de archivo; si llegó algo, se copia y se vuelve a intentar.
+        """
+        temporal = self.ruta + ".tmp"
+        try:
+            f = open(temporal, "wb")
+            try:
+                for clave, fila in pendientes.items():
+                    f.write((json.dumps({"t": "fila", "id": clave, "fila": fila}, ensure_ascii=False) + "\n").encode())
+                posicion = desde
+                while True:
+                    with open(self.ruta, "rb") as original:
+                        original.seek(posicion)
+                        cola = original.read()
+                    posicion += len(cola)
+                    f.write(cola)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    with self._lock:
+                        if self._archivo.tell() != posicion:
+                            continue
+                        f.close()
+                        self._archivo.close()
+                        os.replace(temporal, self.ruta)
+                        self._archivo = open(self.ruta, "a", encoding="utf-8")
+                        break
+            finally:
+                f.close()
+        except OSError as e:
+            logger.error("❌ No se pudo compactar el outbox: %s", e)
+            return
+        logger.info("📒 Outbox compactado (%s pendiente(s)).", len(pendientes))
+
+    def cerrar(self):
+        with self._lock:
+            self._archivo.close()
+
+
+outbox: OutboxJournal | None = None  # se abre al iniciar la cola (modo webhook: ya con el shard reclamado)
+
+
+def abrir_outbox(ruta: str = OUTBOX_PATH) -> OutboxJournal:
+    """Abre el journal de este proceso; si había otro abierto en otra ruta, lo cierra."""
+    global outbox
+    if outbox is not None:
+        if outbox.ruta == ruta:
+            return outbox
+        outbox.cerrar()
+    outbox = OutboxJournal(ruta)
+    return outbox
+
+
+# ======================================
+# ⏳ COLA DE ESCRITURA DIFERIDA (WRITE-BEHIND) HACIA GOOGLE SHEETS
+# ======================================
+# guardar_registro anota la fila en el outbox y la encola; un worker en segundo plano
+# agrupa las filas pendientes y las envía en un único values.append cada
+# GS_FLUSH_INTERVALO segundos o en cuanto se acumulan GS_FLUSH_MAX_FILAS.
+GS_FLUSH_INTERVALO = float(os.getenv("GS_FLUSH_INTERVALO", "5"))
+GS_FLUSH_MAX_FILAS = int(os.getenv("GS_FLUSH_MAX_FILAS", "50"))
+GS_REINTENTO_MAX_ESPERA = 60
+# Filas que Google rechaza de forma definitiva (4xx): se apartan aquí para no bloquear la cola
+GS_RECHAZADAS_PATH = os.path.join(DATA_DIR, "sheets-rechazadas.jsonl")
+
+_gs_cola: asyncio.Queue | None = None
+_gs_worker_task: asyncio.Task | None = None
+_gs_claves_en_cola: set = set()
+
+
+async def gs_registrar_fila(fila):
+    """
+    Anota la fila en el outbox (durable) y la encola para escritura diferida.
+    Ignora filas cuyo ID_REGISTRO ya fue escrito o ya está en cola (reintentos seguros).
+    Lanza excepción solo si no se pudo dejar constancia local de la fila.
+    """
+    fila = _normalizar_fila(fila)
+    clave = fila[COL_ID_REGISTRO]
+    if clave and (clave in _gs_claves_en_cola or indice_idempotencia.ya_confirmada(clave)):
+        logger.warning("⚠️ Registro %s ya enviado o en cola; se omite el duplicado.", clave)
+        return
+
+    await (outbox or abrir_outbox()).registrar(clave, fila)
+
+    if _gs_cola is None:
+        # Sin worker activo (p. ej. fuera de la aplicación) → escritura directa; si falla queda en el outbox
+        logger.warning("⚠️ Cola de Sheets no iniciada; escribiendo fila de forma directa.")
+        try:
+            await asyncio.to_thread(gs_append_rows, [fila])
+        except Exception as e:
+            logger.error("❌ Escritura directa fallida (%s); la fila queda en el outbox para el próximo inicio.", e)
+            return
+        indice_idempotencia.marcar_confirmadas([clave])
+        outbox.confirmar([clave])
+        return
+
+    _gs_encolar(clave, fila)
+
+
+def _gs_encolar(clave, fila):
+    _gs_claves_en_cola.add(clave)
+    _gs_cola.put_nowait(fila)
+    logger.info("📥 Fila %s encolada para Google Sheets (pendientes: %s).", clave, _gs_cola.qsize())
+
+
+async def _gs_tomar_lote(cola: asyncio.Queue) -> list:
+    """Espera la primera fila y acumula más hasta cumplir el intervalo o el tamaño máximo."""
+    lote = [await cola.get()]
+    limite = asyncio.get_running_loop().time() + GS_FLUSH_INTERVALO
+    while len(lote) < GS_FLUSH_MAX_FILAS:
+        restante = limite - asyncio.get_running_loop().time()
+        if restante <= 0:
+            break
+        try:
+            lote.append(await asyncio.wait_for(cola.get(), timeout=restante))
+        except asyncio.TimeoutError:
+            break
+    return lote
+
+
+def _codigo_api(e: Exception) -> int:
+    if isinstance(e, gspread.exceptions.APIError):
+        return int(getattr(e, "code", None) or getattr(getattr(e, "response", None), "status_code", 0) or 0)
+    return 0
+
+
+def _error_definitivo(e: Exception) -> bool:
+    """True si Google rechazó la petición (4xx): seguro que la fila no se escribió."""
+    return 400 <= _codigo_api(e) < 500
+
+
+# 4xx que no dependen del contenido del lote (credenciales, hoja inexistente, cuota): ninguna
+# fila podría escribirse, así que se reintentan con espera en lugar de apartarse.
+_GS_CODIGOS_DE_HOJA = {401, 403, 404, 408, 429}
+
+
+def _error_rechazo_filas(e: Exception) -> bool:
+    """True si Google rechazó el contenido del lote (p. ej. 400): reintentarlo igual nunca funcionará."""
+    return _error_definitivo(e) and _codigo_api(e) not in _GS_CODIGOS_DE_HOJA
+
+
+def _gs_apartar_filas(filas, error: Exception):
+    """Anota en GS_RECHAZADAS_PATH filas rechazadas por Google y las quita del outbox (no se reenvían al reiniciar)."""
+    with open(GS_RECHAZADAS_PATH, "a", encoding="utf-8") as f:
+        for fila in filas:
+            f.write(json.dumps({"id": fila[COL_ID_REGISTRO], "fila": fila, "error": str(error), "ts": time.time()},
+                               ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    logger.error("🚫 %s fila(s) rechazada(s) por Google Sheets (%s); apartadas en %s.", len(filas), error, GS_RECHAZADAS_PATH)
+
+
+async def gs_worker_escritura():
+    """
+    Vacía la cola en lotes; si Google falla, reintenta el lote con espera progresiva.
+    Si el fallo fue ambiguo (timeout / red), antes de reintentar se descartan las filas
+    cuyo ID_REGISTRO ya aparece en la hoja para no duplicarlas.
+    Si Google rechaza el contenido (4xx), el lote se reenvía fila por fila y la fila rechazada se
+    aparta en GS_RECHAZADAS_PATH: reintentarla para siempre bloquearía todas las siguientes.
+    """
+    intento = 0
+    lote = []
+    separadas = []  # filas de un lote rechazado que se reenvían de a una
+    enviando = []
+    en_duda = False
+    while True:
+        try:
+            if not lote:
+                lote = [separadas.pop(0)] if separadas else await _gs_tomar_lote(_gs_cola)
+            if en_duda:
+                existentes = await asyncio.to_thread(gs_claves_existentes)
+                escritas = [f for f in lote if f[COL_ID_REGISTRO] in existentes]
+                if escritas:
+                    logger.info("🔑 %s fila(s) del lote ya estaban en la hoja; no se reenvían.", len(escritas))
+                    indice_idempotencia.marcar_confirmadas([f[COL_ID_REGISTRO] for f in escritas])
+                    outbox.confirmar([f[COL_ID_REGISTRO] for f in escritas])
+                pendientes = [f for f in lote if f[COL_ID_REGISTRO] not in existentes]
+                en_duda = False
+            else:
+                pendientes = lote
+            if pendientes:
+                enviando = pendientes
+                await asyncio.to_thread(gs_append_rows, pendientes)
+                enviando = []
+                indice_idempotencia.marcar_confirmadas([f[COL_ID_REGISTRO] for f in pendientes])
+                outbox.confirmar([f[COL_ID_REGISTRO] for f in pendientes])
+            _gs_liberar(lote)
+            lote, intento = [], 0
+        except asyncio.CancelledError:
+            if lote or separadas:
+                logger.warning("⚠️ Worker de Sheets detenido con %s fila(s) sin enviar.", len(lote) + len(separadas))
+            raise
+        except Exception as e:
+            if enviando and _error_rechazo_filas(e):
+                # Rechazo seguro (la fila no se escribió): no se reintenta el mismo lote
+                claves = {f[COL_ID_REGISTRO] for f in enviando}
+                _gs_liberar([f for f in lote if f[COL_ID_REGISTRO] not in claves])  # ya estaban en la hoja
+                if len(enviando) > 1:
+                    logger.warning("⚠️ Google rechazó un lote de %s fila(s) (%s); se reenvían de a una.", len(enviando), e)
+                    separadas = enviando + separadas
+                else:
+                    try:
+                        await asyncio.to_thread(_gs_apartar_filas, enviando, e)
+                    except OSError as e_disco:
+                        logger.error("❌ No se pudo apartar la fila rechazada (%s); queda en el outbox.", e_disco)
+                    else:
+                        outbox.confirmar([f[COL_ID_REGISTRO] for f in enviando])
+                    _gs_liberar(enviando)
+                lote, enviando, intento, en_duda = [], [], 0, False
+                continue
+            enviando = []
+            intento += 1
+            en_duda = en_duda or not _error_definitivo(e)
+            espera = min(GS_REINTENTO_MAX_ESPERA, 2 ** intento)
+            logger.error("❌ Error enviando lote de %s fila(s) a Google Sheets: %s. Reintento en %ss...", len(lote), e, espera)
+            await asyncio.sleep(espera)
+
+
+def _gs_liberar(filas):
+    """Da por terminadas filas tomadas de la cola (enviadas, ya presentes o apartadas)."""
+    for fila in filas:
+        _gs_claves_en_cola.discard(fila[COL_ID_REGISTRO])
+        _gs_cola.task_done()
+
+
+async def gs_iniciar_cola(app=None):
+    """Crea la cola y arranca el worker (se usa como post_init de la aplicación)."""
+    global _gs_cola, _gs_worker_task
+    _gs_cola = asyncio.Queue()
+
+    # 📒 Replay: lo que quedó en el outbox sin confirmar vuelve a la cola
+    if outbox is None:
+        abrir_outbox()
+    ya_escritas = [c for c in outbox.pendientes if indice_idempotencia.ya_confirmada(c)]
+    outbox.confirmar(ya_escritas)
+    for clave, fila in list(outbox.pendientes.items()):
+        _gs_encolar(clave, fila)
+
+    _gs_worker_task = asyncio.create_task(gs_worker_escritura())
+    logger.info("⏳ Cola de escritura a Sheets iniciada (intervalo %ss, lote máx. %s).", GS_FLUSH_INTERVALO, GS_FLUSH_MAX_FILAS)
+
+
+async def gs_detener_cola(app=None):
+    """Espera a que el worker envíe lo pendiente y lo detiene (se usa como post_shutdown)."""
+    global _gs_cola, _gs_worker_task
+    if _gs_worker_task is None:
+        return
+    if not _gs_cola.empty():
+        logger.info("💾 Esperando envío de %s fila(s) pendientes antes de apagar...", _gs_cola.qsize())
+    try:
+        await asyncio.wait_for(_gs_cola.join(), timeout=GS_REINTENTO_MAX_ESPERA)
+    except asyncio.TimeoutError:
+        logger.error("❌ Se apaga con %s fila(s) sin enviar; quedan en el outbox para el próximo inicio.", _gs_cola.qsize())
+
+    _gs_worker_task.cancel()
+    try:
+        await _gs_worker_task
+    except asyncio.CancelledError:
+        pass
+    _gs_cola, _gs_worker_task = None, None
 
 
 
@@ -225,7 +1156,7 @@ def ensure_google_folder_imagenes():
     Compatible con unidades compartidas (supportsAllDrives=True).
     """
     try:
-        service = build("drive", "v3", credentials=creds)
+        service = clientes_google.drive()
 
         # 1️⃣ Verificar si el ID definido existe y es accesible
         if GOOGLE_IMAGES_FOLDER_ID:
@@ -235,7 +1166,7 @@ def ensure_google_folder_imagenes():
                     fields="id, name",
                     supportsAllDrives=True
                 ).execute()
-                logger.info(f"📁 Carpeta IMAGENES existente: {f['id']} ({f['name']})")
+                logger.info("📁 Carpeta IMAGENES existente: %s (%s)", f['id'], f['name'])
                 return GOOGLE_IMAGES_FOLDER_ID
             except Exception:
                 logger.warning("⚠️ La carpeta IMAGENES con el ID definido no existe o no es accesible. Se buscará o creará una nueva.")
@@ -252,7 +1183,7 @@ def ensure_google_folder_imagenes():
 
         if folders:
             folder_id = folders[0]["id"]
-            logger.info(f"📁 Carpeta IMAGENES encontrada por nombre: {folder_id}")
+            logger.info("📁 Carpeta IMAGENES encontrada por nombre: %s", folder_id)
             return folder_id
 
         # 3️⃣ Crear la carpeta si no existe
@@ -266,42 +1197,79 @@ def ensure_google_folder_imagenes():
             supportsAllDrives=True
         ).execute()
         folder_id = folder["id"]
-        logger.info(f"🆕 Carpeta IMAGENES creada en Google Drive: {folder_id}")
+        logger.info("🆕 Carpeta IMAGENES creada en Google Drive: %s", folder_id)
         return folder_id
 
     except Exception as e:
-        logger.error(f"❌ Error asegurando carpeta IMAGENES: {e}")
+        logger.error("❌ Error asegurando carpeta IMAGENES: %s", e)
         return None
 
 
+# ID de la carpeta IMAGENES resuelto una sola vez (al iniciar) y reutilizado en cada subida
+_carpeta_imagenes_id = None
+_carpeta_imagenes_lock = threading.Lock()
+
+
+def obtener_carpeta_imagenes(revalidar: bool = False):
+    """
+    Devuelve el ID cacheado de la carpeta IMAGENES.
+    Solo consulta Drive si aún no se resolvió o si se pide revalidar (tras un error de subida).
+    """
+    global _carpeta_imagenes_id
+    if _carpeta_imagenes_id and not revalidar:
+        return _carpeta_imagenes_id
+    with _carpeta_imagenes_lock:
+        if _carpeta_imagenes_id and not revalidar:
+            return _carpeta_imagenes_id
+        folder_id = ensure_google_folder_imagenes()
+        if folder_id:
+            _carpeta_imagenes_id = folder_id
+        return folder_id
+
+
+def _crear_archivo_drive(service, folder_id: str, file_bytes: bytes, filename: str):
+    file_metadata = {
+        "name": filename,
+        "parents": [folder_id],
+        "mimeType": "image/jpeg"
+    }
+    media = gapi_http.MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype="image/jpeg", resumable=True)
+    return service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields="id, webViewLink",
+        supportsAllDrives=True
+    ).execute()
+
+
+@instrumentar("dependencia", dependencia="upload_image_to_google_drive")
 def upload_image_to_google_drive(file_bytes: bytes, filename: str):
     """
-    Sube imagen a la carpeta IMAGENES en Google Drive (creándola si no existe)
-    y devuelve su enlace público.
+    Sube imagen a la carpeta IMAGENES en Google Drive y devuelve su enlace público.
+    Usa el ID de carpeta cacheado; solo lo revalida si la subida falla por 404/403.
     Compatible con unidades compartidas (supportsAllDrives=True).
     """
     try:
-        service = build("drive", "v3", credentials=creds)
+        service = clientes_google.drive()
 
-        # 🗂 Obtener o crear carpeta IMAGENES
-        folder_id = ensure_google_folder_imagenes()
+        # 🗂 Carpeta IMAGENES (cacheada)
+        folder_id = obtener_carpeta_imagenes()
         if not folder_id:
             logger.error("❌ No se pudo obtener ni crear la carpeta IMAGENES.")
             return None
 
         # 📤 Subir la imagen
-        file_metadata = {
-            "name": filename,
-            "parents": [folder_id],
-            "mimeType": "image/jpeg"
-        }
-        media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype="image/jpeg", resumable=True)
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields="id, webViewLink",
-            supportsAllDrives=True
-        ).execute()
+        try:
+            file = _crear_archivo_drive(service, folder_id, file_bytes, filename)
+        except gapi_errors.HttpError as e:
+            if e.resp.status not in (403, 404):
+                raise
+            logger.warning("⚠️ Carpeta IMAGENES %s no accesible (%s). Revalidando...", folder_id, e.resp.status)
+            folder_id = obtener_carpeta_imagenes(revalidar=True)
+            if not folder_id:
+                logger.error("❌ No se pudo obtener ni crear la carpeta IMAGENES.")
+                return None
+            file = _crear_archivo_drive(service, folder_id, file_bytes, filename)
 
         # 🔓 Hacer pública la imagen
         service.permissions().create(
@@ -311,12 +1279,188 @@ def upload_image_to_google_drive(file_bytes: bytes, filename: str):
         ).execute()
 
         web_link = file["webViewLink"]
-        logger.info(f"✅ Imagen subida correctamente a Google Drive: {web_link}")
+        logger.info("✅ Imagen subida correctamente a Google Drive: %s", web_link)
         return web_link
 
     except Exception as e:
-        logger.error(f"❌ Error subiendo imagen a Google Drive: {e}")
+        logger.error("❌ Error subiendo imagen a Google Drive: %s", e)
+        return None
+
+
+# ======================================
+# 🗜️ REDUCCIÓN Y RECOMPRESIÓN DE FOTOS ANTES DE SUBIR
+# ======================================
+# Corre en un pool de procesos para que el trabajo de CPU no frene al bot. Los procesos se
+# crean con forkserver (spawn fuera de POSIX), nunca con fork: un fork desde un proceso con
+# hilos (logs, pools de Drive, imports diferidos) puede heredar un lock tomado y colgarse.
+# Se corrige la orientación, se eliminan los metadatos EXIF y solo se conserva el bloque GPS.
+FOTO_TRANSCODIFICAR = os.getenv("FOTO_TRANSCODIFICAR", "1") == "1"
+FOTO_MAX_DIM = int(os.getenv("FOTO_MAX_DIM", "1600"))   # lado mayor en píxeles
+FOTO_CALIDAD = int(os.getenv("FOTO_CALIDAD", "80"))     # calidad JPEG (1-95)
+FOTO_PROCESOS = int(os.getenv("FOTO_PROCESOS", "2"))
+_EXIF_GPS_IFD = 0x8825
+
+_pool_procesos = None
+_pool_procesos_lock = threading.Lock()
+
+
+def transcodificar_imagen(file_bytes: bytes, max_dim: int = FOTO_MAX_DIM, calidad: int = FOTO_CALIDAD) -> bytes:
+    """Reescala al lado máximo, aplica la orientación EXIF y recomprime a JPEG conservando solo el GPS."""
+    with Image.open(io.BytesIO(file_bytes)) as original:
+        gps = original.getexif().get_ifd(_EXIF_GPS_IFD)
+        img = ImageOps.exif_transpose(original)
+
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+
+    exif = Image.Exif()
+    if gps:
+        exif[_EXIF_GPS_IFD] = gps
+
+    salida = io.BytesIO()
+    img.save(salida, "JPEG", quality=calidad, optimize=True, progressive=True, exif=exif.tobytes())
+    return salida.getvalue()
+
+
+def _obtener_pool_procesos():
+    global _pool_procesos
+    if _pool_procesos is None:
+        with _pool_procesos_lock:
+            if _pool_procesos is None:
+                if "forkserver" in multiprocessing.get_all_start_methods():
+                    contexto = multiprocessing.get_context("forkserver")
+                    # El servidor solo precarga Pillow (sin hilos); este módulo lo importa cada proceso hijo
+                    contexto.set_forkserver_preload(["PIL.Image", "PIL.ImageOps"])
+                else:
+                    contexto = multiprocessing.get_context("spawn")
+                _pool_procesos = ProcessPoolExecutor(max_workers=FOTO_PROCESOS, mp_context=contexto)
+    return _pool_procesos
+
+
+def calentar_pool_procesos():
+    """Arranca los procesos del pool al iniciar (cada uno importa este módulo) para no demorar la primera foto."""
+    if not FOTO_TRANSCODIFICAR:
+        return
+    pool = _obtener_pool_procesos()
+    for futuro in [pool.submit(os.getpid) for _ in range(FOTO_PROCESOS)]:
+        futuro.result()
+
+
+def preparar_foto(file_bytes: bytes, filename: str):
+    """
+    Transcodifica la foto en el pool de procesos (si está habilitado).
+    Ante cualquier error devuelve los bytes originales para no perder la foto.
+    """
+    if not FOTO_TRANSCODIFICAR:
+        return file_bytes, filename
+    try:
+        reducida = _obtener_pool_procesos().submit(transcodificar_imagen, file_bytes).result()
+        logger.info("🗜️ Foto %s reducida: %s KB → %s KB", filename, len(file_bytes) // 1024, len(reducida) // 1024)
+        return reducida, os.path.splitext(filename)[0] + ".jpg"
+    except Exception as e:
+        logger.warning("⚠️ No se pudo transcodificar %s, se sube el original: %s", filename, e)
+        return file_bytes, filename
+
+
+def preparar_y_subir_foto(file_bytes: bytes, filename: str, cancelada: threading.Event | None = None):
+    """Etapa completa de una foto: transcodificación + subida a Drive (se omite si se canceló entretanto)."""
+    file_bytes, filename = preparar_foto(file_bytes, filename)
+    if cancelada is not None and cancelada.is_set():
+        logger.info("🚫 Subida de %s cancelada antes de enviarla a Drive.", filename)
         return None
+    return upload_image_to_google_drive(file_bytes, filename)
+
+
+# ======================================
+# 📤 SUBIDA DE FOTOS EN SEGUNDO PLANO (POOL ACOTADO)
+# ======================================
+# El paso de foto guarda un marcador FOTO_PENDIENTE y muestra los botones al instante;
+# la subida corre en un pool de hilos y guardar_registro espera las que sigan pendientes.
+FOTOS_MAX_WORKERS = int(os.getenv("FOTOS_MAX_WORKERS", "4"))
+FOTO_PENDIENTE = "⏳ PENDIENTE"
+
+_pool_subidas = ThreadPoolExecutor(max_workers=FOTOS_MAX_WORKERS, thread_name_prefix="drive")
+_subidas_pendientes: dict[str, dict[str, asyncio.Task]] = {}  # ID_REGISTRO → {paso: tarea}
+
+
+async def _subir_foto_en_segundo_plano(context, chat_id, registro, paso, file_bytes, filename):
+    # Al cancelar la tarea: si aún no empezó, sale del pool; si ya corre, no llega a subir a Drive
+    cancelada = threading.Event()
+    try:
+        link = await asyncio.get_running_loop().run_in_executor(
+            _pool_subidas, preparar_y_subir_foto, file_bytes, filename, cancelada
+        )
+    except asyncio.CancelledError:
+        cancelada.set()
+        raise
+    tareas = _subidas_pendientes.get(registro.get("ID_REGISTRO"), {})
+    if tareas.get(paso) is not asyncio.current_task():
+        return link  # ya se reemplazó por una foto más reciente
+
+    if link:
+        registro[paso] = link
+        if registro.get("USER_ID"):
+            context.application.mark_data_for_update_persistence(user_ids=registro["USER_ID"])
+    else:
+        try:
+            await salida.enviar(
+                context.bot,
+                chat_id,
+                f"⚠️ No se pudo subir la foto de *{ETIQUETAS.get(paso, paso)}*. Se te pedirá reenviarla al guardar.",
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.warning("⚠️ No se pudo avisar fallo de subida (%s): %s", paso, e)
+    return link
+
+
+def programar_subida_foto(context, chat_id, registro, paso, file_bytes, filename):
+    """Lanza la subida en segundo plano y deja el marcador FOTO_PENDIENTE en el registro."""
+    tarea = asyncio.create_task(
+        _subir_foto_en_segundo_plano(context, chat_id, registro, paso, bytes(file_bytes), filename)
+    )
+    anterior = _subidas_pendientes.setdefault(registro["ID_REGISTRO"], {}).get(paso)
+    if anterior is not None:
+        anterior.cancel()  # la foto reemplazada ya no hace falta en Drive
+    _subidas_pendientes[registro["ID_REGISTRO"]][paso] = tarea
+    registro[paso] = FOTO_PENDIENTE
+    logger.info("📤 Subida de %s programada (%s).", paso, registro['ID_REGISTRO'])
+
+
+async def esperar_subidas_pendientes(registro) -> list:
+    """
+    Espera las subidas aún en curso del registro y coloca sus enlaces.
+    Devuelve la lista de pasos de foto que no tienen enlace válido.
+    """
+    tareas = _subidas_pendientes.pop(registro.get("ID_REGISTRO"), {})
+    for paso, tarea in tareas.items():
+        try:
+            link = await tarea
+        except Exception as e:
+            logger.error("❌ Error en subida pendiente (%s): %s", paso, e)
+            link = None
+        registro[paso] = link or None
+
+    # Marcadores sin tarea (p. ej. registro restaurado tras un reinicio) también cuentan como fallidos
+    fallidos = []
+    for paso, cfg in PASOS.items():
+        if cfg.get("tipo") != "foto":
+            continue
+        if registro.get(paso) == FOTO_PENDIENTE:
+            registro[paso] = None
+        if paso in registro and not registro.get(paso):
+            fallidos.append(paso)
+    return fallidos
+
+
+def descartar_subidas_pendientes(registro):
+    """Cancela las subidas en curso de un registro cancelado."""
+    tareas = _subidas_pendientes.pop((registro or {}).get("ID_REGISTRO"), {})
+    for tarea in tareas.values():
+        tarea.cancel()
+    if tareas:
+        logger.info("🚫 %s subida(s) de fotos canceladas (%s).", len(tareas), registro.get("ID_REGISTRO"))
 
 
 # ======================================
@@ -326,89 +1470,361 @@ def upload_image_to_google_drive(file_bytes: bytes, filename: str):
 def verificar_carpeta_imagenes_inicial():
     try:
         logger.info("🔎 Verificando carpeta IMAGENES antes de iniciar el bot...")
-        folder_id = ensure_google_folder_imagenes()
+        folder_id = obtener_carpeta_imagenes(revalidar=True)  # ✅ queda cacheado para las subidas
         if folder_id:
-            logger.info(f"✅ Carpeta IMAGENES lista para usar: {folder_id}")
+            logger.info("✅ Carpeta IMAGENES lista para usar: %s", folder_id)
         else:
             logger.error("❌ No se pudo verificar o crear la carpeta IMAGENES. Revisa tus credenciales o permisos.")
     except Exception as e:
-        logger.error(f"💥 Error al verificar carpeta IMAGENES: {e}")
+        logger.error("💥 Error al verificar carpeta IMAGENES: %s", e)
 
 
-def cargar_cajas_nodos():
-    """Lee el archivo CAJAS_NODOS desde Google Sheets y carga los códigos y nodos."""
-    global CAJAS_NODOS
-    try:
-        logger.info("📄 Cargando 'CAJAS_NODOS' desde Google Sheets...")
+# ======================================
+# 🗃️ SERVICIO DE BÚSQUEDA CAJAS_NODOS (ÍNDICE RECARGABLE EN CALIENTE)
+# ======================================
+CAJAS_ARCHIVO = "CAJAS_NODOS"
+CAJAS_PESTANA = "Hoja1"   # Verifica en tu archivo el nombre de la pestaña, puede ser "Hoja 1" o "Sheet1"
+CAJAS_REFRESCO = int(os.getenv("CAJAS_REFRESCO_SEG", "900"))
+CAJAS_SNAPSHOT = os.path.join(DATA_DIR, "cajas_nodos.json")
 
-        # 🔐 Usa las credenciales globales ya cargadas desde Render (GCP_SA_PATH)
-        gc = gspread.authorize(creds)
 
-        # 🗂 Abrir el archivo por nombre
-        sh = gc.open("CAJAS_NODOS")
+CAJAS_SUGERENCIAS = int(os.getenv("CAJAS_SUGERENCIAS", "5"))
 
-        # ✅ Usa worksheet por nombre exacto (corrige el error 'no attribute Hoja1')
-        # Verifica en tu archivo el nombre de la pestaña, puede ser "Hoja 1" o "Sheet1"
-        ws = sh.worksheet("Hoja1")
 
-        # 📋 Leer todos los registros como diccionarios
-        data = ws.get_all_records()
+def distancia_edicion(a: str, b: str, tope: int) -> int:
+    """Levenshtein con corte temprano: devuelve tope + 1 si la distancia supera el tope."""
+    if abs(len(a) - len(b)) > tope:
+        return tope + 1
+    previa = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        actual = [i]
+        for j, cb in enumerate(b, 1):
+            actual.append(min(previa[j] + 1, actual[j - 1] + 1, previa[j - 1] + (ca != cb)))
+        if min(actual) > tope:
+            return tope + 1
+        previa = actual
+    return previa[-1]
 
-        # 🧠 Crear el diccionario con los códigos y nodos
-        CAJAS_NODOS = {
-            str(row["CODIGO_CAJA"]).strip().upper(): str(row["NODO"]).strip()
-            for row in data if row.get("CODIGO_CAJA") and row.get("NODO")
-        }
 
-        logger.info(f"✅ Cargados {len(CAJAS_NODOS)} registros desde 'CAJAS_NODOS'.")
+class IndiceCodigos:
+    """
+    Búsqueda aproximada sobre los códigos de caja.
+    - Prefijos: lista ordenada + bisect (equivalente a recorrer un trie, sin su costo de memoria).
+    - Un error de tipeo: con una sola edición, todo lo que está antes y después del tramo
+      editado queda intacto como prefijo y sufijo; se busca por rango (bisect) en la lista
+      ordenada y en la de códigos invertidos, y se recorre solo el rango más chico.
+    - Más errores (solo si lo anterior no encontró nada): índice invertido de trigramas (arrays de enteros) con presupuesto fijo,
+      recorriendo primero los trigramas más raros.
+    """
+
+    PRESUPUESTO_POSTINGS = 5000
+    MAX_CANDIDATOS = 30
+    MAX_RANGO = 5000
+
+    def __init__(self, codigos):
+        self.codigos = sorted(codigos)
+        self._invertidos = sorted(c[::-1] for c in self.codigos)
+        self._trigramas: dict[str, array] = {}
+        for i, codigo in enumerate(self.codigos):
+            for g in self._gramas(codigo):
+                lista = self._trigramas.get(g)
+                if lista is None:
+                    lista = self._trigramas[g] = array("I")
+                lista.append(i)
+
+    @staticmethod
+    def _gramas(texto: str) -> set:
+        t = f"^{texto}$"
+        return {t[i:i + 3] for i in range(len(t) - 2)}
+
+    @staticmethod
+    def _rango(lista: list, prefijo: str):
+        return bisect_left(lista, prefijo), bisect_left(lista, prefijo + "\uffff")
+
+    def por_prefijo(self, prefijo: str, n: int) -> list:
+        lo, hi = self._rango(self.codigos, prefijo)
+        return self.codigos[lo:min(hi, lo + n)]
+
+    @staticmethod
+    def _es_una_edicion(a: str, b: str) -> bool:
+        """True si a y b difieren en como máximo una inserción, borrado o sustitución."""
+        la, lb = len(a), len(b)
+        if abs(la - lb) > 1:
+            return False
+        i = 0
+        corto = min(la, lb)
+        while i < corto and a[i] == b[i]:
+            i += 1
+        if la == lb:
+            return a[i + 1:] == b[i + 1:]
+        return a[i:] == b[i + 1:] if la < lb else a[i + 1:] == b[i:]
+
+    def _a_una_edicion(self, consulta: str) -> set:
+        # Tramos de 2 caracteres: la edición cae en uno de ellos y el resto queda como prefijo + sufijo exactos
+        largo = len(consulta)
+        cortes = list(range(0, largo, 2)) + [largo]
+        encontrados = set()
+        for d in range(len(cortes) - 1):
+            prefijo, sufijo = consulta[:cortes[d]], consulta[cortes[d + 1]:]
+            plo, phi = self._rango(self.codigos, prefijo)
+            slo, shi = self._rango(self._invertidos, sufijo[::-1])
+            if phi - plo <= shi - slo:
+                candidatos = (c for c in self.codigos[plo:min(phi, plo + self.MAX_RANGO)] if c.endswith(sufijo))
+            else:
+                inv_prefijo = prefijo[::-1]
+                candidatos = (r[::-1] for r in self._invertidos[slo:min(shi, slo + self.MAX_RANGO)] if r.endswith(inv_prefijo))
+            for c in candidatos:
+                if self._es_una_edicion(consulta, c):
+                    encontrados.add(c)
+        return encontrados
+
+    def _por_trigramas(self, consulta: str) -> set:
+        listas = sorted((self._trigramas[g] for g in self._gramas(consulta) if g in self._trigramas), key=len)
+        conteo = Counter()
+        recorridos = 0
+        for lista in listas:
+            if recorridos and recorridos + len(lista) > self.PRESUPUESTO_POSTINGS:
+                break
+            conteo.update(lista)
+            recorridos += len(lista)
+        return {self.codigos[i] for i, _ in conteo.most_common(self.MAX_CANDIDATOS)}
+
+    def similares(self, consulta: str, n: int = CAJAS_SUGERENCIAS) -> list:
+        """Top-n códigos más cercanos a la consulta (prefijos primero, luego por distancia)."""
+        consulta = consulta.strip().upper()
+        if not consulta or not self.codigos:
+            return []
+
+        puntuados = {c: 0 for c in self.por_prefijo(consulta, n)}
+        for c in self._a_una_edicion(consulta):
+            puntuados.setdefault(c, 1)
+
+        if not puntuados:  # solo si no hubo coincidencias a una edición (camino más caro)
+            tope = max(2, len(consulta) // 3)
+            for c in self._por_trigramas(consulta):
+                if c not in puntuados:
+                    d = distancia_edicion(consulta, c, tope)
+                    if d <= tope:
+                        puntuados[c] = d
+
+        orden = sorted(puntuados, key=lambda c: (puntuados[c], len(c), c))
+        return orden[:n]
+
+
+class ServicioCajasNodos:
+    """
+    Índice código de caja → nodo.
+    - Arranca desde un snapshot local (lookups disponibles antes de llegar a Google).
+    - Se refresca en segundo plano o a pedido; solo relee la hoja si cambió su modifiedTime en Drive.
+    - El índice nuevo se construye aparte y se reemplaza de forma atómica.
+    """
+
+    def __init__(self, ruta_snapshot: str):
+        self.ruta_snapshot = ruta_snapshot
+        self._indice: dict[str, str] = {}
+        self._busqueda = IndiceCodigos(())
+        self._modificado = None
+        self._archivo_id = None
+        self._lock = threading.Lock()  # un solo refresco a la vez
+        self.ultima_carga = None
+
+    def __len__(self):
+        return len(self._indice)
+
+    def obtener(self, codigo: str) -> str:
+        return self._indice.get(codigo.strip().upper(), "")
+
+    def sugerir(self, codigo: str, n: int = CAJAS_SUGERENCIAS) -> list:
+        """Códigos existentes más parecidos al ingresado (para el teclado de sugerencias)."""
+        return self._busqueda.similares(codigo, n)
+
+    def _publicar(self, indice: dict, modificado):
+        busqueda = IndiceCodigos(indice.keys())
+        self._indice = indice          # ✅ reemplazo atómico (una sola asignación)
+        self._busqueda = busqueda
+        self._modificado = modificado
+        self.ultima_carga = time.time()
+
+    @staticmethod
+    def _construir_indice(valores: list) -> dict:
+        """Índice compacto a partir de get_all_values(): los nombres de nodo se internan."""
+        if not valores:
+            return {}
+        encabezado = [str(h).strip().upper() for h in valores[0]]
+        i_codigo, i_nodo = encabezado.index("CODIGO_CAJA"), encabezado.index("NODO")
+        nodos = {}
+        indice = {}
+        for fila in valores[1:]:
+            if len(fila) <= max(i_codigo, i_nodo):
+                continue
+            codigo, nodo = str(fila[i_codigo]).strip().upper(), str(fila[i_nodo]).strip()
+            if codigo and nodo:
+                indice[sys.intern(codigo)] = nodos.setdefault(nodo, sys.intern(nodo))
+        return indice
+
+    def cargar_snapshot(self) -> bool:
+        try:
+            with open(self.ruta_snapshot, encoding="utf-8") as f:
+                data = json.load(f)
+            self._publicar({sys.intern(k): sys.intern(v) for k, v in data["cajas"].items()}, data.get("modificado"))
+            logger.info("💽 Snapshot de 'CAJAS_NODOS' cargado: %s códigos.", len(self._indice))
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning("⚠️ Snapshot de 'CAJAS_NODOS' ilegible: %s", e)
+            return False
+
+    def _guardar_snapshot(self):
+        temporal = self.ruta_snapshot + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump({"modificado": self._modificado, "cajas": self._indice}, f, ensure_ascii=False)
+        os.replace(temporal, self.ruta_snapshot)
+
+    def refrescar(self, forzar: bool = False) -> bool:
+        """Relee la hoja si cambió (bloqueante: llamar desde un hilo). Devuelve True si hubo recarga."""
+        with self._lock:
+            gc = clientes_google.gspread()
+            sh = gc.open_by_key(self._archivo_id) if self._archivo_id else gc.open(CAJAS_ARCHIVO)
+            self._archivo_id = sh.id
+
+            modificado = clientes_google.drive().files().get(
+                fileId=self._archivo_id, fields="modifiedTime", supportsAllDrives=True
+            ).execute().get("modifiedTime")
+            if not forzar and modificado and modificado == self._modificado:
+                logger.info("🟢 'CAJAS_NODOS' sin cambios desde la última carga.")
+                return False
+
+            indice = self._construir_indice(sh.worksheet(CAJAS_PESTANA).get_all_values())
+            self._publicar(indice, modificado)
+            try:
+                self._guardar_snapshot()
+            except Exception as e:
+                logger.warning("⚠️ No se pudo guardar el snapshot de 'CAJAS_NODOS': %s", e)
+            logger.info("✅ Cargados %s registros desde 'CAJAS_NODOS'.", len(indice))
+            return True
+
+    async def bucle_refresco(self):
+        """Refresca el índice cada CAJAS_REFRESCO segundos sin bloquear el bot."""
+        while True:
+            await asyncio.sleep(CAJAS_REFRESCO)
+            try:
+                await asyncio.to_thread(self.refrescar)
+            except Exception as e:
+                logger.error("❌ Error refrescando 'CAJAS_NODOS': %s", e)
+
+
+servicio_cajas = ServicioCajasNodos(CAJAS_SNAPSHOT)
+servicio_cajas.cargar_snapshot()
+
 
+def cargar_cajas_nodos(forzar: bool = True):
+    """Lee el archivo CAJAS_NODOS desde Google Sheets y carga los códigos y nodos."""
+    try:
+        logger.info("📄 Cargando 'CAJAS_NODOS' desde Google Sheets...")
+        return servicio_cajas.refrescar(forzar=forzar)
     except Exception as e:
-        logger.error(f"❌ Error cargando 'CAJAS_NODOS' desde Google Sheets: {e}")
-        CAJAS_NODOS = {}
+        logger.error("❌ Error cargando 'CAJAS_NODOS' desde Google Sheets: %s", e)
+        if len(servicio_cajas):
+            logger.info("💽 Se siguen usando %s códigos del snapshot local.", len(servicio_cajas))
+        return False
 
 
 def obtener_nodo_por_codigo(codigo: str) -> str:
     try:
-        return CAJAS_NODOS.get(codigo.strip().upper(), "")
+        return servicio_cajas.obtener(codigo)
     except Exception:
         return ""
 
 
-# ================== PASOS ===============================================================================
+async def comando_recargar_cajas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/recargar_cajas → fuerza la recarga de CAJAS_NODOS (solo USUARIOS_DEV)."""
+    if update.effective_user.id not in USUARIOS_DEV:
+        return
+    await update.message.reply_text("🔄 Recargando 'CAJAS_NODOS'...")
+    recargado = await asyncio.to_thread(cargar_cajas_nodos, True)
+    texto = (f"✅ 'CAJAS_NODOS' recargado: {len(servicio_cajas)} códigos."
+             if recargado else f"⚠️ No se pudo recargar. Se mantienen {len(servicio_cajas)} códigos.")
+    await update.message.reply_text(texto)
+
+
+# ================== PASOS ===============================================================================
+# Definición declarativa del flujo. El motor de pasos (más abajo) la compila al importar:
+#   tipo          → texto | ubicacion | foto | menu (define validación, captura y filtro del handler)
+#   siguiente     → paso destino al confirmar, "RESUMEN_FINAL" o {"si": condición, "entonces", "sino"}
+#   instruccion   → texto al llegar al paso desde el anterior (si falta se usa "mensaje")
+#   confirmar     → plantilla del mensaje Confirmar/Corregir ({valor})
+#   confirmado    → texto que reemplaza la botonera al confirmar
+#   error         → respuesta ante una entrada inválida
+#   captura / menu / al_confirmar → comportamientos con nombre (ver MotorPasos)
+#   corregir      → estado al que lleva "Corregir" (si no es el mismo paso)
+#   mensajes      → False si el paso solo se responde con botones
+#   instruccion_correccion → texto al corregir desde el resumen (si falta, uno según el tipo)
+#   subestados    → estados propios del menú del paso que se corrigen como el paso mismo
 PASOS = {
     "TICKET": {
         "tipo": "texto",
         "mensaje": "🎫 Ingrese el número de *TICKET* a registrar:",
-        "siguiente": "CODIGO_CAJA",
+        "mayusculas": True,
+        "error": "⚠️ Debes enviar un número de ticket válido.",
+        "confirmar": "🎫 *Ticket ingresado:* `{valor}`\n\n¿Deseas confirmar o corregir?",
+        "confirmado": "✅ TICKET confirmado.",
+        "siguiente": "DNI",
     },
     "DNI": {
         "tipo": "texto",
         "mensaje": "🪪 Ingrese el *DNI del cliente*: ",
+        "instruccion": "🪪 Ingrese ahora el *DNI del cliente:*",
+        "mayusculas": True,
+        "error": "⚠️ Debes enviar un número de DNI válido.",
+        "confirmar": "🪪 *DNI del cliente:* `{valor}`\n\n¿Deseas confirmar o corregir?",
+        "confirmado": "✅ DNI confirmado.",
         "siguiente": "NOMBRE_CLIENTE",
     },
     "NOMBRE_CLIENTE": {
         "tipo": "texto",
         "mensaje": "👤 Ingrese el *nombre del cliente*: ",
-        "siguiente": "CODIGO_CAJA",
+        "instruccion": "👤 Ingrese el *Nombre del Cliente:*",
+        "mayusculas": True,
+        "error": "⚠️ Debes ingresar el nombre del cliente.",
+        "confirmar": "👤 *Cliente:* {valor}\n\n¿Deseas confirmar o corregir?",
+        "confirmado": "✅ NOMBRE CLIENTE confirmado.",
+        "siguiente": "PARTNER",
     },
     "PARTNER": {
         "tipo": "texto",
         "mensaje": "🏢 Ingrese el nombre del *Partner*:",
-        "siguiente": "CUADRILLA",
+        "instruccion": "🏢 Ingrese el *Partner:*",
+        "mayusculas": True,
+        "error": "⚠️ Debes ingresar el nombre del Partner",
+        "confirmar": "🏢 *Partner:* {valor}\n\n¿Deseas confirmar o corregir?",
+        "confirmado": "✅ PARTNER confirmado.",
+        "siguiente": "TIPO_CUADRILLA",
     },
     "TIPO_CUADRILLA": {
         "tipo": "menu",
         "mensaje": "🛠 Selecciona el *Tipo de Cuadrilla*:",
+        "menu": "tipo_cuadrilla",
+        "confirmado": "✅ TIPO CUADRILLA confirmado.",
         "siguiente": "CUADRILLA",
     },
     "CUADRILLA": {
         "tipo": "texto",
         "mensaje": "👷 Ingrese el *nombre o código de cuadrilla*: ",
-        "siguiente": "DNI",
+        "instruccion": "👷 Ingresa tu *nomenclatura junto al nombre de tu Cuadrilla:*",
+        "mayusculas": True,
+        "error": "⚠️ Debes ingresar el nombre o código de cuadrilla.",
+        "confirmar": "👷 *Cuadrilla:* {valor}\n\n¿Deseas confirmar o corregir?",
+        "confirmado": "✅ CUADRILLA confirmado.",
+        "siguiente": "CODIGO_CAJA",
     },
     "CODIGO_CAJA": {
         "tipo": "texto",
         "mensaje": "🏷 Ingresa el *Código de la CTO/NAP/FAT*:",
+        "instruccion": "🏷 Ingrese el *Código de CTO/NAP/FAT:*",
+        "mayusculas": True,
+        "captura": "codigo_caja",
+        "error": "⚠️ Debes enviar un código de CTO/NAP/FAT válido.",
         "siguiente": "UBICACION_CTO",
     },
     "UBICACION_CTO": {
@@ -421,37 +1837,55 @@ PASOS = {
     "FOTO_CAJA": {
         "tipo": "foto",
         "mensaje": "📸 Envía *foto de la CTO/NAP/FAT con rotulo visible*:",
+        "confirmado": "✅ Foto confirmada.",
         "siguiente": "FOTO_CAJA_ABIERTA",
     },
     "FOTO_CAJA_ABIERTA": {
         "tipo": "foto",
         "mensaje": "📸 Envía *foto de la CTO/NAP/FAT abierta* mostrando puertos visibles:",
+        "instruccion_correccion": "📸 Envía nuevamente la *Foto Caja Abierta*.",
+        "confirmado": "✅ Foto confirmada.",
         "siguiente": "FOTO_MEDICION",
     },
     "FOTO_MEDICION": {
         "tipo": "foto",
         "mensaje": "📸 Envía *foto de la potencia óptica en dBm. & λ 1490 nm.* del puerto asignado:",
+        "instruccion_correccion": "📸 Envía nuevamente la *Foto Medicion*.",
+        "confirmado": "✅ Foto confirmada.",
         "siguiente": "OBS",
     },
     "OBS": {
         "tipo": "menu",
         "mensaje": "🧭 Selecciona el tipo de observación en CTO / NAP / FAT:",
         "instruccion": "📋 Usa el menú para elegir el tipo de observación.",
-        "siguiente": "DINAMICO",
+        "menu": "obs",
+        "subestados": ["OBS_TIPO", "OBS_SELECCION"],
+        "al_confirmar": "obs",
+        "siguiente": {"si": "requiere_puerto", "entonces": "CANTIDAD_PUERTOS", "sino": "RESUMEN_FINAL"},
+    },
+    "CANTIDAD_PUERTOS": {
+        "tipo": "menu",
+        "mensaje": "🔢 *¿Cuántos puertos vas a reportar?*",
+        "menu": "cantidad_puertos",
+        "mensajes": False,
+        "siguiente": "PUERTO_REPORTADO",
     },
     "PUERTO_REPORTADO": {
         "tipo": "texto",
         "mensaje": "🔌 Ingresa el *número del puerto* a reportar (del 1 al 17):",
+        "mensajes": False,
+        "corregir": "CANTIDAD_PUERTOS",
+        "confirmado": "✅ PUERTO REPORTADO confirmado.",
         "siguiente": "FOTO_PUERTO",
     },
     "FOTO_PUERTO": {
         "tipo": "foto",
         "mensaje": "📸 Envía la *foto del puerto reportado sin potencia*:",
+        "confirmado": "✅ Foto de puerto confirmada.",
         "siguiente": "RESUMEN_FINAL",
     }
 }
 
-
 PASOS_LISTA = list(PASOS.keys())
 
 ETIQUETAS = {
@@ -472,33 +1906,345 @@ ETIQUETAS = {
 }
 
 
+# ================== TECLADOS PRECONSTRUIDOS ==================
+# Todas las botoneras estáticas se construyen una sola vez al importar y se reutilizan
+# (InlineKeyboardMarkup es inmutable en PTB 20, así que compartir la instancia es seguro).
+TIPOS_CUADRILLA = ["AVERIAS ALTO VALOR", "AVERIAS PREFERENTE", "AVERIAS PROVINCIA", "POSTVENTA LIMA", "POSTVENTA PROVINCIA"]
+PUERTOS_MAX = 17
+
+
+def _filas(botones, por_fila):
+    return [botones[i:i + por_fila] for i in range(0, len(botones), por_fila)]
+
+
+def construir_teclados() -> dict[str, InlineKeyboardMarkup]:
+    teclados = {
+        "TIPO_CUADRILLA": InlineKeyboardMarkup(
+            [[InlineKeyboardButton(opc, callback_data=f"SET_TC_{opc}")] for opc in TIPOS_CUADRILLA]
+        ),
+        "CANTIDAD_PUERTOS": InlineKeyboardMarkup([[
+            InlineKeyboardButton("1 puerto", callback_data="SET_CANT_PTO_1"),
+            InlineKeyboardButton("2 puertos", callback_data="SET_CANT_PTO_2"),
+            InlineKeyboardButton("3 puertos", callback_data="SET_CANT_PTO_3"),
+        ]]),
+        "PUERTOS": InlineKeyboardMarkup(_filas(
+            [InlineKeyboardButton(str(i), callback_data=f"SET_PTO_{i}") for i in range(1, PUERTOS_MAX + 1)], 4
+        )),
+        "OBS_TIPO": InlineKeyboardMarkup([
+            [InlineKeyboardButton("🟧 CTO", callback_data="OBS_TIPO_CTO")],
+            [InlineKeyboardButton("🟦 NAP", callback_data="OBS_TIPO_NAP")],
+            [InlineKeyboardButton("🟩 FAT", callback_data="OBS_TIPO_FAT")],
+        ]),
+        "RESUMEN_FINAL": InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Guardar", callback_data="FINAL_GUARDAR")],
+            [InlineKeyboardButton("✏️ Corregir", callback_data="FINAL_CORREGIR")],
+            [InlineKeyboardButton("❌ Cancelar", callback_data="FINAL_CANCELAR")],
+        ]),
+    }
+
+    # 📝 Submenús de observaciones (uno por tipo de elemento)
+    for tipo, opciones in OBS_OPCIONES.items():
+        teclados[f"OBS_{tipo}"] = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(obs, callback_data=f"OBS_SET_{idx}")] for idx, obs in enumerate(opciones)]
+            + [[InlineKeyboardButton("🔙 Volver", callback_data="OBS_BACK")]]
+        )
+
+    # ✅ Confirmar / ✏️ Corregir de cada paso
+    for paso in PASOS:
+        teclados[f"CONFIRMAR_{paso}"] = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_{paso}"),
+            InlineKeyboardButton("✏️ Corregir",  callback_data=f"CORREGIR_{paso}"),
+        ]])
+
+    # ✏️ Menú de correcciones del resumen final (con y sin puerto reportado)
+    campos = [
+        [InlineKeyboardButton("🎫 Ticket", callback_data="EDITAR_TICKET")],
+        [InlineKeyboardButton("👥 Tipo Cuadrilla", callback_data="EDITAR_TIPO_CUADRILLA")],
+        [InlineKeyboardButton("🏷 Código CTO/NAP/FAT", callback_data="EDITAR_CODIGO_CAJA")],
+        [InlineKeyboardButton("📍 Ubicación CTO/NAP/FAT", callback_data="EDITAR_UBICACION_CTO")],
+        [InlineKeyboardButton("📸 Foto (Exterior)", callback_data="EDITAR_FOTO_CAJA"), InlineKeyboardButton("📸 Foto (Interior)", callback_data="EDITAR_FOTO_CAJA_ABIERTA")],
+        [InlineKeyboardButton("📸 Foto (Medición)", callback_data="EDITAR_FOTO_MEDICION"), InlineKeyboardButton("📝 Observación", callback_data="EDITAR_OBS")],
+    ]
+    teclados["FINAL_CORREGIR"] = InlineKeyboardMarkup(campos)
+    teclados["FINAL_CORREGIR_PUERTO"] = InlineKeyboardMarkup(campos + [[
+        InlineKeyboardButton("🔌 Puerto", callback_data="EDITAR_PUERTO_REPORTADO"),
+        InlineKeyboardButton("📸 Foto Puerto", callback_data="EDITAR_FOTO_PUERTO"),
+    ]])
+    return teclados
+
+
+TECLADOS = construir_teclados()
+
+
 # ================== UTILS ==================
 def get_fecha_hora():
     lima = timezone("America/Lima")
     now = datetime.now(lima)
     return now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S")
 
-def geocodificar(lat, lng):
-    """Devuelve Departamento, Provincia y Distrito usando Google Maps API"""
-    if not GOOGLE_MAPS_API_KEY:
-        logger.error("❌ GOOGLE_MAPS_API_KEY no está definido.")
-        return "-", "-", "-"
+# ======================================
+# 🗺️ CACHÉ DE GEOCODIFICACIÓN (COORDENADAS REDONDEADAS)
+# ======================================
+GEO_CACHE_PRECISION = int(os.getenv("GEO_CACHE_PRECISION", "4"))   # decimales (4 ≈ celdas de 11 m)
+GEO_CACHE_TTL = int(os.getenv("GEO_CACHE_TTL_DIAS", "90")) * 86400
+GEO_CACHE_MAX = int(os.getenv("GEO_CACHE_MAX", "20000"))
 
-    url = (
-        f"https://maps.googleapis.com/maps/api/geocode/json?"
-        f"latlng={lat},{lng}&key={GOOGLE_MAPS_API_KEY}&language=es"
-    )
 
-    try:
-        resp = requests.get(url, timeout=12).json()
-    except Exception as e:
-        logger.error(f"❌ Error en request a Google Maps: {e}")
-        return "-", "-", "-"
+class CacheGeocodificacion:
+    """
+    Caché LRU con TTL de (departamento, provincia, distrito) por celda de coordenadas.
+    Vive en memoria y se persiste en SQLite para sobrevivir a los reinicios.
+    """
 
-    if resp.get("status") != "OK" or not resp.get("results"):
-        logger.error(f"❌ Geocoding falló → {resp.get('status')}, {resp.get('error_message')}")
-        return "-", "-", "-"
+    def __init__(self, ruta: str, precision: int, ttl: int, max_entradas: int):
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()  # clave → (dep, prov, dist, creado)
+
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS geocache ("
+            "clave TEXT PRIMARY KEY, dep TEXT, prov TEXT, dist TEXT, creado REAL)"
+        )
+        limite = time.time() - ttl
+        self._db.execute("DELETE FROM geocache WHERE creado < ?", (limite,))
+        filas = self._db.execute(
+            "SELECT clave, dep, prov, dist, creado FROM geocache ORDER BY creado DESC LIMIT ?",
+            (max_entradas,)
+        ).fetchall()
+        for clave, dep, prov, dist, creado in reversed(filas):
+            self._mem[clave] = (dep, prov, dist, creado)
+        self._db.commit()
+        logger.info("🗺️ Caché de geocodificación cargada: %s celdas.", len(self._mem))
+
+    def clave(self, lat, lng) -> str:
+        p = self.precision
+        return f"{round(float(lat), p):.{p}f},{round(float(lng), p):.{p}f}"
+
+    def obtener(self, lat, lng):
+        clave = self.clave(lat, lng)
+        with self._lock:
+            entrada = self._mem.get(clave)
+            if entrada and time.time() - entrada[3] <= self.ttl:
+                self._mem.move_to_end(clave)
+                self.aciertos += 1
+                return entrada[:3]
+            if entrada:
+                del self._mem[clave]
+            self.fallos += 1
+            return None
+
+    def guardar(self, lat, lng, dep, prov, dist):
+        clave = self.clave(lat, lng)
+        ahora = time.time()
+        with self._lock:
+            self._mem[clave] = (dep, prov, dist, ahora)
+            self._mem.move_to_end(clave)
+            expulsadas = []
+            while len(self._mem) > self.max_entradas:
+                expulsadas.append(self._mem.popitem(last=False)[0])
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO geocache (clave, dep, prov, dist, creado) VALUES (?, ?, ?, ?, ?)",
+                    (clave, dep, prov, dist, ahora)
+                )
+                if expulsadas:
+                    self._db.executemany("DELETE FROM geocache WHERE clave = ?", [(c,) for c in expulsadas])
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.warning("⚠️ No se pudo persistir la caché de geocodificación: %s", e)
+
+    def estadisticas(self) -> dict:
+        total = self.aciertos + self.fallos
+        return {
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "ratio": round(self.aciertos / total, 3) if total else 0.0,
+            "celdas": len(self._mem),
+        }
+
+
+cache_geo = CacheGeocodificacion(
+    os.path.join(DATA_DIR, "geocache.sqlite3"), GEO_CACHE_PRECISION, GEO_CACHE_TTL, GEO_CACHE_MAX
+)
+
+
+# ======================================
+# 🧭 GEOCODIFICADOR INVERSO LOCAL (LÍMITES ADMINISTRATIVOS)
+# ======================================
+# GeoJSON de distritos del Perú (p. ej. límites INEI) con propiedades de departamento,
+# provincia y distrito. Si no se configura, todo sigue resolviéndose con Google Maps.
+GEO_LIMITES_PATH = os.getenv("GEO_LIMITES_PATH", "")
+GEO_PROP_DEPARTAMENTO = os.getenv("GEO_PROP_DEPARTAMENTO", "NOMBDEP")
+GEO_PROP_PROVINCIA = os.getenv("GEO_PROP_PROVINCIA", "NOMBPROV")
+GEO_PROP_DISTRITO = os.getenv("GEO_PROP_DISTRITO", "NOMBDIST")
+GEO_CELDA = float(os.getenv("GEO_CELDA", "0.05"))  # tamaño de celda de la grilla (grados)
 
+
+class GeocodificadorLocal:
+    """
+    Punto-en-polígono sobre una grilla regular.
+    Cada polígono registra sus aristas por franja horizontal de la grilla, así el conteo
+    de cruces (regla par-impar, cubre huecos y multipolígonos) solo recorre las aristas
+    de la franja del punto. Las celdas sin bordes se resuelven una vez y quedan memorizadas.
+    """
+
+    def __init__(self, celda: float = GEO_CELDA):
+        self.celda = celda
+        self.ubicaciones = []        # pid → (dep, prov, dist)
+        self._bbox = []              # pid → (minx, miny, maxx, maxy)
+        self._grilla = {}            # (ix, iy) → [pid, ...] cuyo bbox toca la celda
+        self._franjas = {}           # (pid, iy) → [(x1, y1, x2, y2), ...]
+        self._celdas_con_borde = set()
+        self._memo_celdas = {}       # (ix, iy) → pid | None para celdas sin bordes
+
+    def _ix(self, x): return int((x + 180.0) // self.celda)
+    def _iy(self, y): return int((y + 90.0) // self.celda)
+
+    def cargar_geojson(self, ruta: str):
+        with open(ruta, encoding="utf-8") as f:
+            data = json.load(f)
+
+        for feature in data.get("features", []):
+            geom = feature.get("geometry") or {}
+            props = feature.get("properties") or {}
+            if geom.get("type") == "Polygon":
+                anillos = geom["coordinates"]
+            elif geom.get("type") == "MultiPolygon":
+                anillos = [anillo for poligono in geom["coordinates"] for anillo in poligono]
+            else:
+                continue
+            self._agregar(anillos, (
+                str(props.get(GEO_PROP_DEPARTAMENTO, "-")).strip() or "-",
+                str(props.get(GEO_PROP_PROVINCIA, "-")).strip() or "-",
+                str(props.get(GEO_PROP_DISTRITO, "-")).strip() or "-",
+            ))
+        return self
+
+    def _agregar(self, anillos, ubicacion):
+        pid = len(self.ubicaciones)
+        xs = [p[0] for anillo in anillos for p in anillo]
+        ys = [p[1] for anillo in anillos for p in anillo]
+        if not xs:
+            return
+        self.ubicaciones.append(ubicacion)
+        self._bbox.append((min(xs), min(ys), max(xs), max(ys)))
+
+        for ix in range(self._ix(min(xs)), self._ix(max(xs)) + 1):
+            for iy in range(self._iy(min(ys)), self._iy(max(ys)) + 1):
+                self._grilla.setdefault((ix, iy), []).append(pid)
+
+        for anillo in anillos:
+            for (x1, y1), (x2, y2) in zip(anillo, anillo[1:] + anillo[:1]):
+                if y1 == y2 and x1 == x2:
+                    continue
+                iy0, iy1 = self._iy(min(y1, y2)), self._iy(max(y1, y2))
+                ix0, ix1 = self._ix(min(x1, x2)), self._ix(max(x1, x2))
+                arista = (x1, y1, x2, y2)
+                for iy in range(iy0, iy1 + 1):
+                    self._franjas.setdefault((pid, iy), []).append(arista)
+                    for ix in range(ix0, ix1 + 1):
+                        self._celdas_con_borde.add((ix, iy))
+
+    def _contiene(self, pid, x, y, iy) -> bool:
+        minx, miny, maxx, maxy = self._bbox[pid]
+        if not (minx <= x <= maxx and miny <= y <= maxy):
+            return False
+        dentro = False
+        for x1, y1, x2, y2 in self._franjas.get((pid, iy), ()):
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                dentro = not dentro
+        return dentro
+
+    def _buscar_pid(self, x, y, celda):
+        iy = celda[1]
+        for pid in self._grilla.get(celda, ()):
+            if self._contiene(pid, x, y, iy):
+                return pid
+        return None
+
+    def buscar(self, lat, lng):
+        """Devuelve (departamento, provincia, distrito) o None si el punto cae fuera de todo polígono."""
+        x, y = float(lng), float(lat)
+        celda = (self._ix(x), self._iy(y))
+        if celda in self._celdas_con_borde:
+            pid = self._buscar_pid(x, y, celda)
+        else:
+            if celda not in self._memo_celdas:
+                cx = (celda[0] + 0.5) * self.celda - 180.0
+                cy = (celda[1] + 0.5) * self.celda - 90.0
+                self._memo_celdas[celda] = self._buscar_pid(cx, cy, celda)
+            pid = self._memo_celdas[celda]
+        return self.ubicaciones[pid] if pid is not None else None
+
+
+_geocodificador_local = None
+_geocodificador_local_lock = threading.Lock()
+
+
+def obtener_geocodificador_local():
+    """Carga (una sola vez) el índice de límites administrativos; None si no está configurado."""
+    global _geocodificador_local
+    if not GEO_LIMITES_PATH:
+        return None
+    if _geocodificador_local is None:
+        with _geocodificador_local_lock:
+            if _geocodificador_local is None:
+                try:
+                    inicio = time.perf_counter()
+                    _geocodificador_local = GeocodificadorLocal().cargar_geojson(GEO_LIMITES_PATH)
+                    logger.info(
+                        "🧭 Límites administrativos cargados: %s polígonos en %.2fs",
+                        len(_geocodificador_local.ubicaciones), time.perf_counter() - inicio,
+                    )
+                except Exception as e:
+                    logger.error("❌ No se pudo cargar GEO_LIMITES_PATH (%s): %s", GEO_LIMITES_PATH, e)
+                    _geocodificador_local = False
+    return _geocodificador_local or None
+
+
+# ======================================
+# 🌐 GEOCODIFICACIÓN REMOTA ASÍNCRONA (GOOGLE MAPS)
+# ======================================
+# Sesión HTTP compartida con keep-alive, presupuesto de tiempo por consulta,
+# concurrencia acotada, reintentos con jitter ante OVER_QUERY_LIMIT y coalescencia:
+# consultas simultáneas de la misma celda comparten una sola llamada en curso.
+GEOCODING_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+GEO_PRESUPUESTO = float(os.getenv("GEO_PRESUPUESTO", "8"))        # segundos máximos por consulta
+GEO_MAX_CONCURRENCIA = int(os.getenv("GEO_MAX_CONCURRENCIA", "8"))
+GEO_REINTENTOS = int(os.getenv("GEO_REINTENTOS", "3"))
+SIN_UBICACION = ("-", "-", "-")
+
+_geo_http = None        # (loop, httpx.AsyncClient, asyncio.Semaphore)
+_geo_en_vuelo: dict[str, asyncio.Task] = {}
+
+
+def _geo_sesion():
+    """Cliente HTTP y semáforo del event loop actual (se crean una vez por loop)."""
+    global _geo_http
+    loop = asyncio.get_running_loop()
+    if _geo_http is None or _geo_http[0] is not loop:
+        cliente = httpx.AsyncClient(
+            timeout=httpx.Timeout(GEO_PRESUPUESTO),
+            limits=httpx.Limits(max_connections=GEO_MAX_CONCURRENCIA, max_keepalive_connections=GEO_MAX_CONCURRENCIA),
+        )
+        _geo_http = (loop, cliente, asyncio.Semaphore(GEO_MAX_CONCURRENCIA))
+    return _geo_http[1], _geo_http[2]
+
+
+async def cerrar_sesion_geocodificacion():
+    global _geo_http
+    if _geo_http is not None:
+        await _geo_http[1].aclose()
+        _geo_http = None
+
+
+def _extraer_ubicacion(resp: dict):
+    """Extrae (departamento, provincia, distrito) de la respuesta de Geocoding."""
     comps = resp["results"][0]["address_components"]
 
     depto, prov, distrito = "-", "-", "-"
@@ -519,41 +2265,384 @@ def geocodificar(lat, lng):
                 if "locality" in c.get("types", []):
                     distrito = c.get("long_name", "-")
 
-    logger.info(f"📍 Geocodificado correctamente: {depto}, {prov}, {distrito}")
     return depto, prov, distrito
 
-def obtener_ubicacion(lat, lng):
-    """Devuelve departamento, provincia y distrito usando Google Maps API"""
-    url = f"https://maps.googleapis.com/maps/api/geocode/json?latlng={lat},{lng}&key={GOOGLE_MAPS_API_KEY}&language=es"
-    response = requests.get(url)
-    data = response.json()
 
-    departamento, provincia, distrito = "-", "-", "-"
-    if data.get("status") == "OK" and data.get("results"):
-        for comp in data["results"][0]["address_components"]:
-            if "administrative_area_level_1" in comp["types"]:
-                departamento = comp["long_name"]
-            elif "administrative_area_level_2" in comp["types"]:
-                provincia = comp["long_name"]
-            elif "locality" in comp["types"] or "administrative_area_level_3" in comp["types"]:
-                distrito = comp["long_name"]
-    return departamento, provincia, distrito
+@instrumentar("dependencia", dependencia="geocodificar_google")
+async def geocodificar_google(lat, lng):
+    """Devuelve Departamento, Provincia y Distrito usando Google Maps API"""
+    if not GOOGLE_MAPS_API_KEY:
+        logger.error("❌ GOOGLE_MAPS_API_KEY no está definido.")
+        return SIN_UBICACION
+
+    cliente, semaforo = _geo_sesion()
+    params = {"latlng": f"{lat},{lng}", "key": GOOGLE_MAPS_API_KEY, "language": "es"}
+    try:
+        async with asyncio.timeout(GEO_PRESUPUESTO):
+            async with semaforo:
+                for intento in range(GEO_REINTENTOS):
+                    resp = (await cliente.get(GEOCODING_URL, params=params)).json()
+                    if resp.get("status") != "OVER_QUERY_LIMIT" or intento == GEO_REINTENTOS - 1:
+                        break
+                    espera = random.uniform(0, 0.5 * 2 ** intento)
+                    logger.warning("⏳ Geocoding OVER_QUERY_LIMIT, reintento en %.2fs...", espera)
+                    await asyncio.sleep(espera)
+    except TimeoutError:
+        logger.error("❌ Geocoding superó el presupuesto de %ss.", GEO_PRESUPUESTO)
+        return SIN_UBICACION
+    except Exception as e:
+        logger.error("❌ Error en request a Google Maps: %s", e)
+        return SIN_UBICACION
+
+    if resp.get("status") != "OK" or not resp.get("results"):
+        logger.error("❌ Geocoding falló → %s, %s", resp.get('status'), resp.get('error_message'))
+        return SIN_UBICACION
+
+    depto, prov, distrito = _extraer_ubicacion(resp)
+    logger.info("📍 Geocodificado correctamente: %s, %s, %s", depto, prov, distrito)
+    return depto, prov, distrito
+
+
+async def _geocodificar_y_cachear(lat, lng):
+    ubicacion = await geocodificar_google(lat, lng)
+    if ubicacion != SIN_UBICACION:
+        cache_geo.guardar(lat, lng, *ubicacion)
+    return ubicacion
+
+
+@instrumentar("dependencia", dependencia="geocodificar")
+async def geocodificar(lat, lng):
+    """
+    Devuelve Departamento, Provincia y Distrito.
+    Orden: límites locales → caché → Google Maps API (solo si el punto no cae en ningún polígono).
+    """
+    local = obtener_geocodificador_local()
+    if local:
+        encontrado = local.buscar(lat, lng)
+        if encontrado:
+            logger.info("🧭 Geocodificación local: %s", ', '.join(encontrado))
+            return encontrado
+
+    en_cache = cache_geo.obtener(lat, lng)
+    if en_cache:
+        logger.info("📍 Geocodificación desde caché: %s (%s)", ', '.join(en_cache), cache_geo.estadisticas())
+        return en_cache
+
+    # 🔗 Coalescencia: una sola llamada en curso por celda
+    clave = cache_geo.clave(lat, lng)
+    tarea = _geo_en_vuelo.get(clave)
+    if tarea is None:
+        tarea = asyncio.ensure_future(_geocodificar_y_cachear(lat, lng))
+        _geo_en_vuelo[clave] = tarea
+        tarea.add_done_callback(lambda _t: _geo_en_vuelo.pop(clave, None))
+    else:
+        logger.info("🔗 Geocodificación en curso reutilizada para %s", clave)
+    return await asyncio.shield(tarea)
+
+
+# ======================================
+# 📢 DIFUSIÓN A GRUPOS DE SUPERVISIÓN (RATE LIMIT DE TELEGRAM)
+# ======================================
+# Cada envío a un grupo corre como tarea propia: el técnico no espera a los grupos.
+# Dos cubos de tokens: uno global (~30 msg/s por bot) y uno por chat
+# (20 msg/min en grupos, ~1 msg/s en chats privados). RetryAfter pausa el chat
+# el tiempo indicado por Telegram; errores transitorios se reintentan con backoff.
+DIFUSION_TASA_GLOBAL = float(os.getenv("DIFUSION_TASA_GLOBAL", "25"))   # mensajes/segundo
+DIFUSION_REINTENTOS = int(os.getenv("DIFUSION_REINTENTOS", "5"))
+
+
+class CuboTokens:
+    """Token bucket asíncrono: `tasa` tokens/segundo con ráfagas de hasta `capacidad`."""
+
+    def __init__(self, tasa: float, capacidad: float):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self._ultimo = time.monotonic()
+        self._pausado_hasta = 0.0
+        self._lock = asyncio.Lock()
+
+    def pausar(self, segundos: float):
+        """Bloquea el cubo (p. ej. tras RetryAfter) y lo vacía."""
+        self._pausado_hasta = max(self._pausado_hasta, time.monotonic() + segundos)
+        self.tokens = 0
+
+    def en_reposo(self, ahora: float) -> bool:
+        """True si nadie lo espera y ya se rellenó: descartarlo equivale a crearlo de nuevo."""
+        return (not self._lock.locked() and ahora >= self._pausado_hasta
+                and self.tokens + (ahora - self._ultimo) * self.tasa >= self.capacidad)
+
+    async def adquirir(self):
+        async with self._lock:  # FIFO: quien llegó primero envía primero
+            while True:
+                ahora = time.monotonic()
+                if ahora < self._pausado_hasta:
+                    await asyncio.sleep(self._pausado_hasta - ahora)
+                    continue
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.tasa)
+
+
+class LimitesTelegram:
+    """Cubo global del bot + un cubo por chat; compartidos por todo el tráfico saliente."""
+
+    BARRIDO_SEGUNDOS = 60  # cada cuánto se descartan los cubos de chats inactivos
+
+    def __init__(self, tasa_global: float):
+        self._cubo_global = CuboTokens(tasa_global, tasa_global)
+        self._cubos_chat: dict[int, CuboTokens] = {}
+        self._proximo_barrido = time.monotonic() + self.BARRIDO_SEGUNDOS
+
+    def cubo_chat(self, chat_id: int) -> CuboTokens:
+        cubo = self._cubos_chat.get(chat_id)
+        if cubo is None:
+            self._barrer()
+            # Grupos/canales (id negativo): 20 msg/min; privados: ~1 msg/s con ráfagas cortas
+            cubo = CuboTokens(20 / 60, 5) if chat_id < 0 else CuboTokens(1, 3)
+            self._cubos_chat[chat_id] = cubo
+        return cubo
+
+    def _barrer(self):
+        """Descarta los cubos en reposo (llenos y sin espera): el dict no crece con cada chat visto."""
+        ahora = time.monotonic()
+        if ahora < self._proximo_barrido:
+            return
+        self._proximo_barrido = ahora + self.BARRIDO_SEGUNDOS
+        for chat_id in [c for c, cubo in self._cubos_chat.items() if cubo.en_reposo(ahora)]:
+            del self._cubos_chat[chat_id]
+
+    async def adquirir(self, chat_id: int):
+        await self.cubo_chat(chat_id).adquirir()
+        await self._cubo_global.adquirir()
+
+    def pausar(self, chat_id: int, e: RetryAfter) -> float:
+        espera = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+        logger.warning("⏳ Telegram pide esperar %ss antes de escribir al chat %s.", espera, chat_id)
+        self.cubo_chat(chat_id).pausar(espera)
+        return espera
+
+
+limites_telegram = LimitesTelegram(DIFUSION_TASA_GLOBAL)
+
+
+class DifusorTelegram:
+    """Envía un mismo mensaje a varios chats en paralelo respetando los límites de Telegram."""
+
+    def __init__(self, limites: LimitesTelegram, reintentos: int):
+        self.limites = limites
+        self.reintentos = reintentos
+        self._envios: set = set()
+        self.enviados = 0
+        self.fallidos = 0
+
+    def difundir(self, bot, chat_ids, texto: str, **kwargs):
+        """Programa el envío a cada chat y retorna de inmediato."""
+        for chat_id in chat_ids:
+            tarea = asyncio.create_task(self._enviar(bot, chat_id, texto, kwargs))
+            self._envios.add(tarea)
+            tarea.add_done_callback(self._envios.discard)
+
+    async def _enviar(self, bot, chat_id, texto, kwargs):
+        for intento in range(self.reintentos):
+            await self.limites.adquirir(chat_id)
+            try:
+                await bot.send_message(chat_id=chat_id, text=texto, **kwargs)
+                self.enviados += 1
+                return
+            except RetryAfter as e:
+                self.limites.pausar(chat_id, e)
+            except (TimedOut, NetworkError) as e:
+                espera = random.uniform(0, 2 ** intento)
+                logger.warning("🔁 Error transitorio enviando al chat %s (%s); reintento en %.1fs.", chat_id, e, espera)
+                await asyncio.sleep(espera)
+            except Exception as e:
+                logger.error("❌ Error enviando al grupo %s: %s", chat_id, e)
+                break
+        self.fallidos += 1
+        logger.error("❌ No se pudo entregar el mensaje al chat %s.", chat_id)
+
+    async def drenar(self, timeout: float = 30):
+        """Espera los envíos en curso (al apagar); cancela los que excedan el timeout."""
+        if not self._envios:
+            return
+        pendientes = list(self._envios)
+        logger.info("📢 Esperando %s envío(s) a supervisión antes de apagar...", len(pendientes))
+        _, no_terminados = await asyncio.wait(pendientes, timeout=timeout)
+        for tarea in no_terminados:
+            tarea.cancel()
+        if no_terminados:
+            logger.error("❌ %s envío(s) a supervisión cancelados al apagar.", len(no_terminados))
+
+    def estadisticas(self) -> dict:
+        return {"enviados": self.enviados, "fallidos": self.fallidos, "en_curso": len(self._envios)}
+
+
+difusor = DifusorTelegram(limites_telegram, DIFUSION_REINTENTOS)
+
+
+# ======================================
+# 📤 PLANIFICADOR DE SALIDA POR CHAT (COALESCENCIA DE ENVÍOS Y BORRADOS)
+# ======================================
+# Cada chat tiene una cola FIFO atendida por una tarea corta. Al vaciarla:
+#   • todos los borrados pendientes salen en un único delete_messages (hasta 100 ids);
+#   • textos consecutivos sin teclado (mismo parse_mode) se unen en un solo mensaje,
+#     incluido el mensaje con teclado que los siga.
+# `encolar` no espera (avisos intermedios); `enviar` espera el Message resultante.
+# Todo mensaje nuevo del flujo de registro pasa por aquí. Quedan fuera a propósito: las
+# ediciones de mensajes existentes (edit_message_*, no cuentan como envío nuevo), los avisos
+# al grupo de supervisión (DifusorTelegram) y los comandos de administración
+# (/recargar_cajas, /stats, /exportar).
+# Un RetryAfter se reintenta hasta SALIDA_REINTENTOS veces; luego el envío falla (y sus futures).
+TELEGRAM_MAX_TEXTO = 4096
+TELEGRAM_MAX_BORRADOS = 100
+SALIDA_REINTENTOS = max(1, int(os.getenv("SALIDA_REINTENTOS", "3")))
+
+
+class SalidaTelegram:
+    """Planificador de mensajes salientes por chat con rate limit compartido."""
+
+    def __init__(self, limites: LimitesTelegram, reintentos: int):
+        self.limites = limites
+        self.reintentos = reintentos
+        self._colas: dict[int, list] = {}
+        self._borrados: dict[int, list] = {}
+        self._tareas: dict[int, asyncio.Task] = {}
+        self.llamadas = 0      # llamadas reales a la API
+        self.solicitudes = 0   # envíos/borrados pedidos por el flujo
+
+    def _despertar(self, bot, chat_id):
+        tarea = self._tareas.get(chat_id)
+        if tarea is None or tarea.done():
+            self._tareas[chat_id] = asyncio.create_task(self._atender(bot, chat_id))
+
+    def _agregar(self, bot, chat_id: int, texto: str, kwargs: dict) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._colas.setdefault(chat_id, []).append((texto, kwargs, fut))
+        self.solicitudes += 1
+        self._despertar(bot, chat_id)
+        return fut
+
+    def encolar(self, bot, chat_id: int, texto: str, **kwargs) -> asyncio.Future:
+        """
+        Agrega un texto a la cola del chat; devuelve un future con el Message enviado.
+        Si nadie lo espera, un error de envío se registra en el log (no queda "never retrieved").
+        """
+        fut = self._agregar(bot, chat_id, texto, kwargs)
+        fut.add_done_callback(functools.partial(self._registrar_error, chat_id))
+        return fut
+
+    async def enviar(self, bot, chat_id: int, texto: str, **kwargs):
+        """Como `encolar`, pero espera y devuelve el Message (se une a los avisos previos)."""
+        return await self._agregar(bot, chat_id, texto, kwargs)
+
+    @staticmethod
+    def _registrar_error(chat_id, fut: asyncio.Future):
+        if not fut.cancelled() and fut.exception() is not None:
+            logger.warning("⚠️ No se pudo enviar un aviso al chat %s: %s", chat_id, fut.exception())
+
+    def borrar(self, bot, chat_id: int, message_id: int | None):
+        """Programa el borrado de un mensaje; se agrupa con los demás del chat."""
+        if not message_id:
+            return
+        self._borrados.setdefault(chat_id, []).append(message_id)
+        self.solicitudes += 1
+        self._despertar(bot, chat_id)
+
+    @staticmethod
+    def _unibles(previo, siguiente, largo) -> bool:
+        _, kw_previo, _ = previo
+        texto, kw, _ = siguiente
+        if set(kw_previo) - {"parse_mode"} or set(kw) - {"parse_mode", "reply_markup"}:
+            return False
+        return kw_previo.get("parse_mode") == kw.get("parse_mode") and largo + 2 + len(texto) <= TELEGRAM_MAX_TEXTO
+
+    def _tomar_grupo(self, cola):
+        """Saca de la cola el siguiente grupo de textos que puede viajar en un solo mensaje."""
+        grupo = [cola.pop(0)]
+        largo = len(grupo[0][0])
+        while cola and not grupo[-1][1].get("reply_markup") and self._unibles(grupo[-1], cola[0], largo):
+            grupo.append(cola.pop(0))
+            largo += 2 + len(grupo[-1][0])
+        return grupo
+
+    async def _llamar(self, chat_id, llamada):
+        for intento in range(1, self.reintentos + 1):
+            await self.limites.adquirir(chat_id)
+            try:
+                self.llamadas += 1
+                return await llamada()
+            except RetryAfter as e:
+                self.limites.pausar(chat_id, e)  # el cubo queda pausado aunque ya no se reintente
+                if intento == self.reintentos:
+                    raise
+
+    async def _atender(self, bot, chat_id):
+        try:
+            await self._vaciar(bot, chat_id)
+        finally:
+            # Chat sin pendientes: no se guarda nada de él hasta el próximo mensaje
+            for _, _, fut in self._colas.pop(chat_id, []):
+                fut.cancel()  # solo si la tarea terminó antes de tiempo (cancelación al apagar)
+            self._borrados.pop(chat_id, None)
+            if self._tareas.get(chat_id) is asyncio.current_task():
+                del self._tareas[chat_id]
+
+    async def _vaciar(self, bot, chat_id):
+        cola = self._colas.setdefault(chat_id, [])
+        while cola or self._borrados.get(chat_id):
+            ids = self._borrados.pop(chat_id, [])
+            for i in range(0, len(ids), TELEGRAM_MAX_BORRADOS):
+                lote = ids[i:i + TELEGRAM_MAX_BORRADOS]
+                try:
+                    await self._llamar(chat_id, lambda: bot.delete_messages(chat_id=chat_id, message_ids=lote))
+                except Exception as e:
+                    logger.debug("No se pudieron borrar mensajes %s en %s: %s", lote, chat_id, e)
+
+            if not cola:
+                continue
+            grupo = self._tomar_grupo(cola)
+            texto = "\n\n".join(t for t, _, _ in grupo)
+            kwargs = grupo[-1][1]
+            try:
+                msg = await self._llamar(chat_id, lambda: bot.send_message(chat_id=chat_id, text=texto, **kwargs))
+            except Exception as e:
+                for _, _, fut in grupo:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            if len(grupo) > 1:
+                logger.debug("📤 %s mensajes unidos en uno para el chat %s.", len(grupo), chat_id)
+            for _, _, fut in grupo:
+                if not fut.done():
+                    fut.set_result(msg)
+
+    def estadisticas(self) -> dict:
+        return {
+            "llamadas": self.llamadas,
+            "solicitudes": self.solicitudes,
+            "chats_activos": len(self._tareas),
+        }
+
+
+salida = SalidaTelegram(limites_telegram, SALIDA_REINTENTOS)
 
 
 # ============================================================
 # 📋 NUEVOS MENÚS DESPLEGABLES: TIPO DE CUADRILLA Y PUERTO
 # ============================================================
 async def mostrar_menu_tipo_cuadrilla(chat_id, context, query=None):
-    opciones = ["AVERIAS ALTO VALOR", "AVERIAS PREFERENTE", "AVERIAS PROVINCIA", "POSTVENTA LIMA", "POSTVENTA PROVINCIA"]
-    keyboard = [[InlineKeyboardButton(opc, callback_data=f"SET_TC_{opc}")] for opc in opciones]
-    markup = InlineKeyboardMarkup(keyboard)
+    markup = TECLADOS["TIPO_CUADRILLA"]
     texto = "👥 *Selecciona el Tipo de Cuadrilla:*"
     
     if query:
         try: await query.edit_message_text(texto, reply_markup=markup, parse_mode="Markdown")
-        except: await context.bot.send_message(chat_id=chat_id, text=texto, reply_markup=markup, parse_mode="Markdown")
+        except: await salida.enviar(context.bot, chat_id, texto, reply_markup=markup, parse_mode="Markdown")
     else:
-        await context.bot.send_message(chat_id=chat_id, text=texto, reply_markup=markup, parse_mode="Markdown")
+        await salida.enviar(context.bot, chat_id, texto, reply_markup=markup, parse_mode="Markdown")
 
 async def manejar_seleccion_cuadrilla(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -565,28 +2654,20 @@ async def manejar_seleccion_cuadrilla(update: Update, context: ContextTypes.DEFA
     registro["PASO_ACTUAL"] = "TIPO_CUADRILLA"
     
     texto = f"👥 *Tipo de Cuadrilla registrado:* {valor}\n\n¿Confirmas o corriges?"
-    markup = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_TIPO_CUADRILLA"),
-         InlineKeyboardButton("✏️ Corregir", callback_data="CORREGIR_TIPO_CUADRILLA")]
-    ])
+    markup = TECLADOS["CONFIRMAR_TIPO_CUADRILLA"]
     await query.edit_message_text(texto, parse_mode="Markdown", reply_markup=markup)
     return "CONFIRMAR"
 
 
 async def mostrar_menu_cantidad_puertos(chat_id, context, query=None):
-    keyboard = [
-        [InlineKeyboardButton("1 puerto", callback_data="SET_CANT_PTO_1"),
-         InlineKeyboardButton("2 puertos", callback_data="SET_CANT_PTO_2"),
-         InlineKeyboardButton("3 puertos", callback_data="SET_CANT_PTO_3")]
-    ]
-    markup = InlineKeyboardMarkup(keyboard)
+    markup = TECLADOS["CANTIDAD_PUERTOS"]
     texto = "🔢 *¿Cuántos puertos vas a reportar?*"
     
     if query:
         try: await query.edit_message_text(texto, reply_markup=markup, parse_mode="Markdown")
-        except: await context.bot.send_message(chat_id=chat_id, text=texto, reply_markup=markup, parse_mode="Markdown")
+        except: await salida.enviar(context.bot, chat_id, texto, reply_markup=markup, parse_mode="Markdown")
     else:
-        await context.bot.send_message(chat_id=chat_id, text=texto, reply_markup=markup, parse_mode="Markdown")
+        await salida.enviar(context.bot, chat_id, texto, reply_markup=markup, parse_mode="Markdown")
 
 async def manejar_seleccion_cantidad_puertos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -606,24 +2687,15 @@ async def mostrar_menu_puerto(chat_id, context, query=None):
     registro = context.user_data.setdefault("registro", {})
     total = registro.get("CANTIDAD_PUERTOS_TOTAL", 1)
     actual = len(registro.get("PUERTOS_SELECCIONADOS", [])) + 1
-    
-    keyboard = []
-    row = []
-    for i in range(1, 18):
-        row.append(InlineKeyboardButton(str(i), callback_data=f"SET_PTO_{i}"))
-        if len(row) == 4: 
-            keyboard.append(row)
-            row = []
-    if row: keyboard.append(row)
-        
-    markup = InlineKeyboardMarkup(keyboard)
+
+    markup = TECLADOS["PUERTOS"]
     texto = f"🔌 *Selecciona el puerto {actual} de {total}:*"
     
     if query:
         try: await query.edit_message_text(texto, reply_markup=markup, parse_mode="Markdown")
-        except: await context.bot.send_message(chat_id=chat_id, text=texto, reply_markup=markup, parse_mode="Markdown")
+        except: await salida.enviar(context.bot, chat_id, texto, reply_markup=markup, parse_mode="Markdown")
     else:
-        await context.bot.send_message(chat_id=chat_id, text=texto, reply_markup=markup, parse_mode="Markdown")
+        await salida.enviar(context.bot, chat_id, texto, reply_markup=markup, parse_mode="Markdown")
 
 
 
@@ -653,10 +2725,7 @@ async def manejar_seleccion_puerto(update: Update, context: ContextTypes.DEFAULT
     registro["PASO_ACTUAL"] = "PUERTO_REPORTADO"
     
     texto = f"🔌 *Puerto(s) Reportado(s) registrado(s):* {puertos_finales}\n\n¿Confirmas o corriges?"
-    markup = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_PUERTO_REPORTADO"),
-         InlineKeyboardButton("✏️ Corregir", callback_data="CORREGIR_PUERTO_REPORTADO")]
-    ])
+    markup = TECLADOS["CONFIRMAR_PUERTO_REPORTADO"]
     await query.edit_message_text(texto, parse_mode="Markdown", reply_markup=markup)
     return "CONFIRMAR"
 
@@ -671,7 +2740,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     registro = context.user_data.get("registro", {})
     if registro.get("ACTIVO", False):
         paso_actual = registro.get("PASO_ACTUAL", PASOS_LISTA[0])
-        await update.message.reply_text(
+        await salida.enviar(
+            context.bot,
+            chat_id,
             f"⚠️ Ya tienes un registro en curso.\n\n"
             f"📌 Estás en el paso: *{ETIQUETAS.get(paso_actual, paso_actual)}*.\n\n"
             f"👉 Responde lo solicitado o usa /cancel para anular.",
@@ -686,7 +2757,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Usa /cancel para cancelar un registro en curso.\n\n"
         "‼️ Si ya tienes un registro activo, no podrás iniciar otro."
     )
-    await update.message.reply_text(instrucciones, parse_mode="Markdown")
+    await salida.enviar(context.bot, chat_id, instrucciones, parse_mode="Markdown")
     return ConversationHandler.END
 
 async def comando_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -698,7 +2769,9 @@ async def comando_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reg = context.user_data.get("registro")
     if reg and reg.get("ACTIVO", False):
         paso_actual = reg.get("PASO_ACTUAL", PASOS_LISTA[0])
-        await update.message.reply_text(
+        await salida.enviar(
+            context.bot,
+            chat_id,
             f"⚠️ Ya tienes un registro en curso.\n\n"
             f"📌 Estás en el paso: *{ETIQUETAS.get(paso_actual, paso_actual)}*.\n\n"
             f"👉 Responde lo solicitado o usa /cancel para anular.",
@@ -709,346 +2782,434 @@ async def comando_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Crear registro nuevo
     context.user_data["registro"] = {
         "USER_ID": user_id,
-        "ID_REGISTRO": str(uuid.uuid4())[:8],
+        "ID_REGISTRO": uuid.uuid4().hex,
         "ACTIVO": True,
         "PASO_ACTUAL": "TICKET",
     }
-    await update.message.reply_text("🎫 Ingrese el *TICKET* a registrar:", parse_mode="Markdown")
+    contexto_log.set({**contexto_log.get(), "id_registro": context.user_data["registro"]["ID_REGISTRO"], "paso": "TICKET"})
+    await salida.enviar(context.bot, chat_id, "🎫 Ingrese el *TICKET* a registrar:", parse_mode="Markdown")
     return "TICKET"
 
 
-# ================== MANEJAR PASO (CORREGIDO) ==================
-async def manejar_paso(update: Update, context: ContextTypes.DEFAULT_TYPE, paso: str):
-    chat_id = update.effective_chat.id
+# ================== MOTOR DE PASOS (COMPILADO DESDE PASOS) ==================
+# Al importar se compila cada paso de PASOS: validador, captura, teclado Confirmar/Corregir,
+# destino al confirmar y handler del ConversationHandler. Despachar es un lookup en un dict;
+# un paso nuevo se agrega en PASOS (y, si necesita lógica propia, con una captura/menú con nombre).
+def _marcar_origen_resumen(reg):
+    """Si se llegó desde el resumen, marca la intención de volver a él tras confirmar."""
+    if reg.get("DESDE_RESUMEN", False):
+        reg["VOLVER_A_RESUMEN"] = True       # ← marca intención de regresar al resumen tras confirmar
+        reg["DESDE_RESUMEN"] = False         # ← reset inmediato para NO disparar resúmenes fuera de lugar
 
-    # 🚫 Evita respuestas del grupo de supervisión
-    if chat_id in GRUPO_SUPERVISION_ID:
-        return ConversationHandler.END
 
-    registro = context.user_data.setdefault("registro", {})
-    paso_cfg = PASOS.get(paso, {"tipo": "texto"})  # asume tu dict PASOS tiene 'tipo' y 'siguiente'
+def teclado_confirmar(paso: str) -> InlineKeyboardMarkup:
+    return TECLADOS[f"CONFIRMAR_{paso}"]
 
-    # 🔸 CORRECCIÓN CLAVE 🔸
-    # Si el paso actual es OBS → abrir menú de observaciones en lugar de pedir texto
-    if paso == "OBS":
-        logger.info("🟣 Entrando a menú de observaciones desde manejar_paso()")
-        await mostrar_menu_obs(chat_id, context, tipo=None)
-        registro["PASO_ACTUAL"] = "OBS_TIPO"
-        return "OBS_TIPO"
 
-    # ─────────────────────────────────────────────────────────────
-    # Helper: marcar si venimos de resumen y limpiar el flag
-    # ─────────────────────────────────────────────────────────────
-    def _marcar_origen_resumen(reg):
-        if reg.get("DESDE_RESUMEN", False):
-            reg["VOLVER_A_RESUMEN"] = True       # ← marca intención de regresar al resumen tras confirmar
-            reg["DESDE_RESUMEN"] = False         # ← reset inmediato para NO disparar resúmenes fuera de lugar
-
-    # ─────────────────────────────────────────────────────────────
-    # 1️⃣ TICKET (texto)
-    # ─────────────────────────────────────────────────────────────
-    if paso == "TICKET":
-        if not update.message or not update.message.text:
-            await update.message.reply_text("⚠️ Debes enviar un número de ticket válido.")
-            return paso
-
-        registro["TICKET"] = update.message.text.strip().upper()
-
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_TICKET"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data="CORREGIR_TICKET"),
-        ]]
-        await update.message.reply_text(
-            f"🎫 *Ticket ingresado:* `{registro['TICKET']}`\n\n¿Deseas confirmar o corregir?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        registro["PASO_ACTUAL"] = "TICKET"
-        return "CONFIRMAR"
-
-    # ─────────────────────────────────────────────────────────────
-    # 2️⃣ DNI DEL CLIENTE
-    # ─────────────────────────────────────────────────────────────
-    if paso == "DNI":
-        if not update.message or not update.message.text:
-            await update.message.reply_text("⚠️ Debes enviar un número de DNI válido.")
-            return paso
-
-        registro["DNI"] = update.message.text.strip().upper()
-
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_DNI"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data="CORREGIR_DNI"),
-        ]]
-        await update.message.reply_text(
-            f"🪪 *DNI del cliente:* `{registro['DNI']}`\n\n¿Deseas confirmar o corregir?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        registro["PASO_ACTUAL"] = "DNI"
-        return "CONFIRMAR"
-
-    # ─────────────────────────────────────────────────────────────
-    # 3️⃣ NOMBRE DEL CLIENTE
-    # ─────────────────────────────────────────────────────────────
-    if paso == "NOMBRE_CLIENTE":
-        if not update.message or not update.message.text:
-            await update.message.reply_text("⚠️ Debes ingresar el nombre del cliente.")
-            return paso
-
-        registro["NOMBRE_CLIENTE"] = update.message.text.strip().upper()
-
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_NOMBRE_CLIENTE"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data="CORREGIR_NOMBRE_CLIENTE"),
-        ]]
-        await update.message.reply_text(
-            f"👤 *Cliente:* {registro['NOMBRE_CLIENTE']}\n\n¿Deseas confirmar o corregir?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        registro["PASO_ACTUAL"] = "NOMBRE_CLIENTE"
-        return "CONFIRMAR"
-
-    # ─────────────────────────────────────────────────────────────
-    # 4️⃣ PARTNER
-    # ─────────────────────────────────────────────────────────────
-    if paso == "PARTNER":
-        if not update.message or not update.message.text:
-            await update.message.reply_text("⚠️ Debes ingresar el nombre del Partner")
-            return paso
-
-        registro["PARTNER"] = update.message.text.strip().upper()
-
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_PARTNER"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data="CORREGIR_PARTNER"),
-        ]]
-        await update.message.reply_text(
-            f"🏢 *Partner:* {registro['PARTNER']}\n\n¿Deseas confirmar o corregir?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        registro["PASO_ACTUAL"] = "PARTNER"
-        return "CONFIRMAR"
-
-    # ─────────────────────────────────────────────────────────────
-    # 5️⃣ CUADRILLA
-    # ─────────────────────────────────────────────────────────────
-    if paso == "CUADRILLA":
-        if not update.message or not update.message.text:
-            await update.message.reply_text("⚠️ Debes ingresar el nombre o código de cuadrilla.")
-            return paso
-
-        registro["CUADRILLA"] = update.message.text.strip().upper()
-
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_CUADRILLA"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data="CORREGIR_CUADRILLA"),
-        ]]
-        await update.message.reply_text(
-            f"👷 *Cuadrilla:* {registro['CUADRILLA']}\n\n¿Deseas confirmar o corregir?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        registro["PASO_ACTUAL"] = "CUADRILLA"
-        return "CONFIRMAR"
+# ---------- validadores: devuelven el valor capturado o None ----------
+def _validar_texto(update, cfg):
+    if not update.message or not update.message.text:
+        return None
+    valor = update.message.text.strip()
+    return valor.upper() if cfg.get("mayusculas") else valor
 
-    # ─────────────────────────────────────────────────────────────
-    # 2) CODIGO_CAJA (texto → buscar NODO + detectar tipo)
-    # ─────────────────────────────────────────────────────────────
-    if paso == "CODIGO_CAJA":
-        if not update.message or not update.message.text:
-            await update.message.reply_text("⚠️ Debes enviar un código de CTO/NAP/FAT válido.")
-            return paso
 
-        _marcar_origen_resumen(registro)
+def _validar_ubicacion(update, cfg):
+    return update.message.location if update.message else None
 
-        codigo = update.message.text.strip().upper()
-        registro["CODIGO_CAJA"] = codigo
 
-        try:
-            nodo = obtener_nodo_por_codigo(codigo)  # ← tu función
-        except Exception as e:
-            nodo = None
-            logger.error(f"❌ Error obteniendo nodo para {codigo}: {e}")
+def _validar_foto(update, cfg):
+    msg = update.message
+    if not msg:
+        return None
+    if msg.photo:
+        return msg.photo[-1]
+    doc = msg.document
+    if doc and doc.mime_type and doc.mime_type.startswith("image/"):
+        return doc
+    return None
 
-        registro["NODO"] = nodo or "-"
 
-        if nodo:
-            await update.message.reply_text(f"📡 Nodo encontrado: *{nodo}*", parse_mode="Markdown")
+# ---------- capturas: guardan el valor y piden confirmación ----------
+async def _capturar_texto(update, context, registro, paso, valor):
+    registro[paso.nombre] = valor
+    plantilla = paso.cfg.get("confirmar")
+    texto = (plantilla.format(valor=valor) if plantilla else
+             f"📝 *{paso.nombre.replace('_',' ')}* registrado:\n{valor}\n\n¿Confirmas o corriges?")
+    await salida.enviar(context.bot, update.effective_chat.id, texto, parse_mode="Markdown", reply_markup=paso.teclado)
+    registro["PASO_ACTUAL"] = paso.nombre
+    return "CONFIRMAR"
 
-        # Detección automática de tipo de observación (opcional)
-        try:
-            tipo_detectado = _detectar_tipo_por_codigo(codigo)  # ← tu función
-        except Exception as e:
-            tipo_detectado = None
-            logger.warning(f"⚠️ No se pudo detectar tipo por código: {e}")
 
-        if tipo_detectado:
-            registro["OBS_TIPO"] = tipo_detectado
-            await update.message.reply_text(f"🧩 Tipo detectado automáticamente: *{tipo_detectado}*", parse_mode="Markdown")
+async def _capturar_codigo_caja(update, context, registro, paso, codigo):
+    """CODIGO_CAJA: busca NODO, detecta tipo y sugiere códigos parecidos si no existe."""
+    registro["CODIGO_CAJA"] = codigo
+    chat_id = update.effective_chat.id
+    await esperar_cajas_nodos()
 
-        # Botonera
-        msg = (
-            f"🏷 *Código CTO/NAP/FAT:* {registro['CODIGO_CAJA']}\n"
-            f"¿Deseas confirmar o corregir?"
-        )
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_CODIGO_CAJA"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data="CORREGIR_CODIGO_CAJA"),
-        ]]
-        await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
-        registro["PASO_ACTUAL"] = "CODIGO_CAJA"
-        return "CONFIRMAR"
-
-
-    # ─────────────────────────────────────────────────────────────
-    # 3) UBICACIONES (cubre pasos de tipo 'ubicacion' vía PASOS)
-    #    Debes tener en PASOS[paso] las keys: lat_key, lng_key, siguiente
-    # ─────────────────────────────────────────────────────────────
-    if paso_cfg["tipo"] == "ubicacion":
-        if not update.message or not update.message.location:
-            await update.message.reply_text("⚠️ Debe enviar una *ubicación GPS* válida.")
-            return paso
-
-        # 💡 NUEVO: detectar si viene desde resumen final
-        if registro.get("DESDE_RESUMEN", False):
-            registro["VOLVER_A_RESUMEN"] = True
-            registro["DESDE_RESUMEN"] = False
-            logger.info("🔁 Corrección de ubicación desde resumen → volverá al resumen final tras confirmar")
-
-        _marcar_origen_resumen(registro)
-
-        lat = update.message.location.latitude
-        lng = update.message.location.longitude
-        registro[paso_cfg["lat_key"]] = lat
-        registro[paso_cfg["lng_key"]] = lng
-
-        # Geocodificación
+    try:
+        nodo = obtener_nodo_por_codigo(codigo)
+    except Exception as e:
+        nodo = None
+        logger.error("❌ Error obteniendo nodo para %s: %s", codigo, e)
+
+    registro["NODO"] = nodo or "-"
+    if nodo:
+        salida.encolar(context.bot, chat_id, f"📡 Nodo encontrado: *{nodo}*", parse_mode="Markdown")
+
+    # Detección automática de tipo de observación (opcional)
+    try:
+        tipo_detectado = _detectar_tipo_por_codigo(codigo)
+    except Exception as e:
+        tipo_detectado = None
+        logger.warning("⚠️ No se pudo detectar tipo por código: %s", e)
+
+    if tipo_detectado:
+        registro["OBS_TIPO"] = tipo_detectado
+        salida.encolar(context.bot, chat_id, f"🧩 Tipo detectado automáticamente: *{tipo_detectado}*", parse_mode="Markdown")
+
+    # Botonera
+    msg = (
+        f"🏷 *Código CTO/NAP/FAT:* {codigo}\n"
+        f"¿Deseas confirmar o corregir?"
+    )
+    markup = paso.teclado
+
+    # 🔎 Código no encontrado → sugerir los más parecidos de CAJAS_NODOS
+    if not nodo:
         try:
-            dep, prov, dist = geocodificar(lat, lng)  # ← tu función
+            sugerencias = servicio_cajas.sugerir(codigo)
         except Exception as e:
-            logger.error(f"❌ Error geocodificando: {e}")
-            dep = prov = dist = "-"
+            sugerencias = []
+            logger.warning("⚠️ No se pudieron calcular sugerencias para %s: %s", codigo, e)
+        sugerencias = [c for c in sugerencias if len(f"USAR_CAJA_{c}".encode()) <= 64]
+        if sugerencias:
+            msg = (
+                f"🏷 *Código CTO/NAP/FAT:* {codigo}\n"
+                f"⚠️ No se encontró en CAJAS\\_NODOS. ¿Quisiste decir alguno de estos?\n\n"
+                f"O confirma / corrige lo ingresado."
+            )
+            markup = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(f"🔎 {c}", callback_data=f"USAR_CAJA_{c}")] for c in sugerencias]
+                + list(paso.teclado.inline_keyboard)
+            )
 
-        registro["DEPARTAMENTO"] = dep or "-"
-        registro["PROVINCIA"]    = prov or "-"
-        registro["DISTRITO"]     = dist or "-"
+    await salida.enviar(context.bot, chat_id, msg, parse_mode="Markdown", reply_markup=markup)
+    registro["PASO_ACTUAL"] = paso.nombre
+    return "CONFIRMAR"
 
-        # 📍 Mensaje con mapa y botones de confirmación/corrección
-        mensaje_ubicacion = (
-            f"✅ 📍 *Ubicación CTO/NAP/FAT confirmada:* ({lat:.6f}, {lng:.6f})\n"
-            f"🌍 [Ver ubicación CTO](https://maps.google.com/?q={lat},{lng})"
-        )
 
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_{paso}"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data=f"CORREGIR_{paso}"),
-        ]]
+async def _capturar_ubicacion(update, context, registro, paso, ubicacion):
+    lat, lng = ubicacion.latitude, ubicacion.longitude
+    registro[paso.cfg["lat_key"]] = lat
+    registro[paso.cfg["lng_key"]] = lng
 
-        await update.message.reply_text(
-            mensaje_ubicacion,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            disable_web_page_preview=True
-        )
+    # Geocodificación
+    try:
+        dep, prov, dist = await geocodificar(lat, lng)
+    except Exception as e:
+        logger.error("❌ Error geocodificando: %s", e)
+        dep = prov = dist = "-"
 
-        registro["PASO_ACTUAL"] = paso
-        return "CONFIRMAR"
+    registro["DEPARTAMENTO"] = dep or "-"
+    registro["PROVINCIA"]    = prov or "-"
+    registro["DISTRITO"]     = dist or "-"
 
+    # 📍 Mensaje con mapa y botones de confirmación/corrección
+    mensaje_ubicacion = (
+        f"✅ 📍 *Ubicación CTO/NAP/FAT confirmada:* ({lat:.6f}, {lng:.6f})\n"
+        f"🌍 [Ver ubicación CTO](https://maps.google.com/?q={lat},{lng})"
+    )
+    await salida.enviar(
+        context.bot,
+        update.effective_chat.id,
+        mensaje_ubicacion,
+        parse_mode="Markdown",
+        reply_markup=paso.teclado,
+        disable_web_page_preview=True
+    )
+    registro["PASO_ACTUAL"] = paso.nombre
+    return "CONFIRMAR"
 
-    # ─────────────────────────────────────────────────────────────
-    # 4) FOTOS (cubre pasos de tipo 'foto' vía PASOS)
-    # ─────────────────────────────────────────────────────────────
-    if paso_cfg["tipo"] == "foto":
-        _marcar_origen_resumen(registro)
 
-        if "ID_REGISTRO" not in registro:
-            registro["ID_REGISTRO"] = datetime.now().strftime("%Y%m%d%H%M%S")
+async def _capturar_foto(update, context, registro, paso, origen):
+    if "ID_REGISTRO" not in registro:
+        registro["ID_REGISTRO"] = uuid.uuid4().hex
 
-        filename = f"{paso}_{registro['ID_REGISTRO']}.jpg"
-        file_bytes = None
+    filename = f"{paso.nombre}_{registro['ID_REGISTRO']}.jpg"
+    if getattr(origen, "file_name", None):
+        filename = origen.file_name  # documento de imagen: conserva su nombre
+    file = await origen.get_file()
+    file_bytes = await file.download_as_bytearray()
 
-        # Aceptar photo o document (imagen)
-        if update.message.photo:
-            photo = update.message.photo[-1]
-            file = await photo.get_file()
-            file_bytes = await file.download_as_bytearray()
-        elif update.message.document and update.message.document.mime_type and update.message.document.mime_type.startswith("image/"):
-            file = await update.message.document.get_file()
-            file_bytes = await file.download_as_bytearray()
-            filename = update.message.document.file_name or filename
-        else:
-            await update.message.reply_text("⚠️ Debe enviar una *foto* (imagen o archivo de imagen).")
-            return paso
+    # Subir la foto en segundo plano (no bloquea al técnico)
+    try:
+        programar_subida_foto(context, update.effective_chat.id, registro, paso.nombre, file_bytes, filename)
+    except Exception as e:
+        logger.error("❌ Error programando subida de imagen: %s", e)
+        await salida.enviar(context.bot, update.effective_chat.id, "⚠️ Hubo un problema con la foto. Intenta nuevamente.")
+        return paso.nombre
+
+    await salida.enviar(
+        context.bot,
+        update.effective_chat.id,
+        "📸 Foto recibida. ¿Deseas *confirmarla* o *volver a tomarla*?",
+        parse_mode="Markdown",
+        reply_markup=paso.teclado
+    )
+    registro["PASO_ACTUAL"] = paso.nombre
+    return "CONFIRMAR"
 
-        # Subir (o procesar) la foto
-        try:
-            link_google = upload_image_to_google_drive(file_bytes, filename)  # ← tu función
-            if not link_google:
-                await update.message.reply_text("⚠️ No se pudo procesar la foto, por favor vuelve a enviarla.")
-                return paso
-            # Guarda solo lo necesario para ahorrar RAM
-            registro[paso] = link_google
-            # Si deseas conservar bytes:
-            # registro[f"{paso}_BYTES"] = file_bytes
-        except Exception as e:
-            logger.error(f"❌ Error subiendo imagen: {e}")
-            await update.message.reply_text("⚠️ Hubo un problema con la foto. Intenta nuevamente.")
-            return paso
 
-        # Botonera
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_{paso}"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data=f"CORREGIR_{paso}"),
-        ]]
-        await update.message.reply_text(
-            "📸 Foto recibida. ¿Deseas *confirmarla* o *volver a tomarla*?",
+async def _capturar_menu(update, context, registro, paso, _valor):
+    """Texto en un paso de menú → se vuelve a desplegar el menú."""
+    return await motor_pasos.abrir_menu(paso.nombre, update.effective_chat.id, context, registro)
+
+
+# ---------- menús: abren la botonera del paso y devuelven el estado ----------
+async def _menu_tipo_cuadrilla(chat_id, context, registro, query=None, correccion=False):
+    await mostrar_menu_tipo_cuadrilla(chat_id, context, query)
+    registro["PASO_ACTUAL"] = "TIPO_CUADRILLA"
+    return "TIPO_CUADRILLA"
+
+
+async def _menu_cantidad_puertos(chat_id, context, registro, query=None, correccion=False):
+    registro["PUERTOS_SELECCIONADOS"] = []  # Limpiamos el historial
+    registro["PASO_ACTUAL"] = "CANTIDAD_PUERTOS"
+    await mostrar_menu_cantidad_puertos(chat_id, context, query)
+    return "CANTIDAD_PUERTOS"
+
+
+async def _menu_obs(chat_id, context, registro, query=None, correccion=False):
+    registro["PASO_ACTUAL"] = "OBS_TIPO"
+    if correccion:
+        await salida.enviar(
+            context.bot,
+            chat_id,
+            "🧭 Corrige la *observación* seleccionando nuevamente el tipo de elemento:",
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        registro["PASO_ACTUAL"] = paso
-        return "CONFIRMAR"
-
-    # ─────────────────────────────────────────────────────────────
-    # 5) TEXTO genérico (ej. OBSERVACION u otros campos de texto)
-    # ─────────────────────────────────────────────────────────────
-    if paso_cfg["tipo"] == "texto":
-        # ⚙️ Excepción clave: si el paso es OBS, no pedir texto sino abrir menú
-        if paso == "OBS":
-            logger.info("🟣 Derivando a menú de observaciones desde bloque de texto")
-            await mostrar_menu_obs(chat_id, context, tipo=None)
-            registro["PASO_ACTUAL"] = "OBS_TIPO"
-            return "OBS_TIPO"
+        await mostrar_menu_obs(chat_id, context, tipo=None)
+        return "OBS_TIPO"
+
+    # 🧹 Limpiar mensajes anteriores
+    await limpiar_mensaje_anterior(context, chat_id, registro)
+    msg = await salida.enviar(
+        context.bot,
+        chat_id,
+        "📋 Usa el menú para elegir el tipo de observación:",
+        parse_mode="Markdown"
+    )
+    registro["ULTIMO_MENSAJE_MENU"] = msg.message_id
+    await mostrar_menu_obs(chat_id, context, tipo=registro.get("OBS_TIPO") or None)
+    return "OBS_TIPO"
 
-        # ⚠️ Validación normal de texto
-        if not update.message or not update.message.text:
-            await update.message.reply_text("⚠️ Solo se acepta *texto* en este paso.")
-            return paso
 
-        _marcar_origen_resumen(registro)
+# ---------- acciones al confirmar y condiciones de transición ----------
+async def _al_confirmar_obs(query, context, registro):
+    chat_id = query.message.chat_id
+    logger.info("✅ [CONFIRMAR_OBS] Confirmando observación")
 
-        valor = update.message.text.strip()
-        registro[paso] = valor
+    # 🧹 Eliminar mensaje del menú anterior y la confirmación de observación
+    salida.borrar(context.bot, chat_id, registro.pop("ULTIMO_MENSAJE_MENU", None))
+    try:
+        await query.delete_message()
+    except Exception:
+        pass
+    await salida.enviar(
+        context.bot,
+        chat_id,
+        "✅ Observación seleccionada correctamente.",
+        parse_mode="Markdown"
+    )
+    if registro.get("OBSERVACION", "") not in OBS_REQUIERE_PUERTO:
+        for clave in ("PUERTO_REPORTADO", "PUERTOS_SELECCIONADOS", "CANTIDAD_PUERTOS_TOTAL", "FOTO_PUERTO"):
+            registro.pop(clave, None)
 
-        # 🔘 Confirmar / Corregir botones
-        keyboard = [[
-            InlineKeyboardButton("✅ Confirmar", callback_data=f"CONFIRMAR_{paso}"),
-            InlineKeyboardButton("✏️ Corregir",  callback_data=f"CORREGIR_{paso}"),
-        ]]
-        await update.message.reply_text(
-            f"📝 *{paso.replace('_',' ')}* registrado:\n{valor}\n\n¿Confirmas o corriges?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+
+def _requiere_puerto(registro) -> bool:
+    return registro.get("OBSERVACION", "") in OBS_REQUIERE_PUERTO
+
+
+VALIDADORES = {"texto": _validar_texto, "ubicacion": _validar_ubicacion, "foto": _validar_foto, "menu": _validar_texto}
+CAPTURAS = {
+    "texto": _capturar_texto,
+    "ubicacion": _capturar_ubicacion,
+    "foto": _capturar_foto,
+    "menu": _capturar_menu,
+    "codigo_caja": _capturar_codigo_caja,
+}
+MENUS = {"tipo_cuadrilla": _menu_tipo_cuadrilla, "cantidad_puertos": _menu_cantidad_puertos, "obs": _menu_obs}
+ACCIONES_CONFIRMAR = {"obs": _al_confirmar_obs}
+CONDICIONES = {"requiere_puerto": _requiere_puerto}
+FILTROS_PASO = {
+    "texto": filters.TEXT & ~filters.COMMAND,
+    "menu": filters.TEXT & ~filters.COMMAND,
+    "ubicacion": filters.LOCATION,
+    "foto": filters.PHOTO | filters.Document.IMAGE,
+}
+ERRORES_PASO = {
+    "texto": "⚠️ Solo se acepta *texto* en este paso.",
+    "menu": "⚠️ Usa el menú para continuar.",
+    "ubicacion": "⚠️ Debe enviar una *ubicación GPS* válida.",
+    "foto": "⚠️ Debe enviar una *foto* (imagen o archivo de imagen).",
+}
+CORRECCIONES_PASO = {
+    "texto": "✏️ Envía el nuevo *{nombre}*.",
+    "ubicacion": "📍 Envía la *nueva ubicación (GPS)* de la CTO/NAP/FAT.",
+    "foto": "📸 Envía nuevamente la *foto de {nombre}*.",
+}
+
+
+class PasoCompilado:
+    """Un paso de PASOS con todas sus piezas resueltas."""
+
+    __slots__ = ("nombre", "cfg", "tipo", "validar", "capturar", "teclado", "siguiente",
+                 "instruccion", "confirmado", "error", "menu", "al_confirmar", "corregir", "instruccion_correccion", "manejador")
+
+    def __init__(self, nombre: str, cfg: dict):
+        self.nombre = nombre
+        self.cfg = cfg
+        self.tipo = cfg["tipo"]
+        self.validar = VALIDADORES[self.tipo]
+        self.capturar = CAPTURAS[cfg.get("captura", self.tipo)]
+        self.teclado = teclado_confirmar(nombre)
+        self.siguiente = cfg.get("siguiente")
+        self.instruccion = cfg.get("instruccion") or cfg.get("mensaje") or f"➡️ Continúa con *{nombre.replace('_',' ')}*"
+        self.confirmado = cfg.get("confirmado")
+        self.error = cfg.get("error", ERRORES_PASO[self.tipo])
+        self.menu = MENUS[cfg["menu"]] if "menu" in cfg else None
+        self.al_confirmar = ACCIONES_CONFIRMAR[cfg["al_confirmar"]] if "al_confirmar" in cfg else None
+        self.corregir = cfg.get("corregir", nombre)
+        correccion = cfg.get("instruccion_correccion") or CORRECCIONES_PASO.get(self.tipo)
+        self.instruccion_correccion = (
+            correccion.format(nombre=nombre.replace('_', ' ')) if correccion else self.instruccion
         )
 
-        registro["PASO_ACTUAL"] = paso
-        return "CONFIRMAR"
+        async def manejar_paso_motor(update, context, _paso=nombre):
+            return await manejar_paso(update, context, _paso)
+        self.manejador = manejar_paso_motor
 
-    # Por si acaso
-    await update.message.reply_text("⚠️ Paso no reconocido. Intenta nuevamente.")
-    return paso
+
+class MotorPasos:
+    """Máquina de estados compilada: pasos, transiciones y estados del ConversationHandler."""
+
+    def __init__(self, pasos: dict):
+        self.pasos = {nombre: PasoCompilado(nombre, cfg) for nombre, cfg in pasos.items()}
+        # Estados internos de un menú (OBS_TIPO, OBS_SELECCION…) → el paso al que pertenecen
+        self.alias = {sub: paso for paso in self.pasos.values() for sub in paso.cfg.get("subestados", ())}
+        for paso in self.pasos.values():  # valida destinos y condiciones al importar
+            destino = paso.siguiente
+            destinos = [destino["entonces"], destino["sino"]] if isinstance(destino, dict) else [destino]
+            if isinstance(destino, dict) and destino["si"] not in CONDICIONES:
+                raise ValueError(f"Condición desconocida en PASOS[{paso.nombre}]: {destino['si']}")
+            for d in destinos:
+                if d and d != "RESUMEN_FINAL" and d not in self.pasos:
+                    raise ValueError(f"PASOS[{paso.nombre}] apunta a un paso inexistente: {d}")
+
+    def __getitem__(self, nombre) -> PasoCompilado:
+        return self.pasos[nombre]
+
+    def get(self, nombre):
+        return self.pasos.get(nombre)
+
+    def a_corregir(self, nombre) -> PasoCompilado | None:
+        """Paso que se corrige al pulsar Corregir/Editar sobre `nombre` (resuelve subestados)."""
+        return self.pasos.get(nombre) or self.alias.get(nombre)
+
+    def siguiente(self, paso: PasoCompilado, registro) -> str | None:
+        destino = paso.siguiente
+        if isinstance(destino, dict):
+            return destino["entonces"] if CONDICIONES[destino["si"]](registro) else destino["sino"]
+        return destino
+
+    async def abrir_menu(self, nombre, chat_id, context, registro, query=None, correccion=False):
+        return await self.pasos[nombre].menu(chat_id, context, registro, query=query, correccion=correccion)
+
+    async def ir_a(self, destino, update, context, registro):
+        """Lleva la conversación al paso `destino` (pregunta, menú o resumen final)."""
+        chat_id = update.effective_chat.id
+        if destino == "RESUMEN_FINAL":
+            await mostrar_resumen_final(update, context)
+            return "RESUMEN_FINAL"
+        paso = self.pasos[destino]
+        if paso.menu:
+            return await paso.menu(chat_id, context, registro)
+        await salida.enviar(context.bot, chat_id, paso.instruccion, parse_mode="Markdown")
+        registro["PASO_ACTUAL"] = destino
+        return destino
+
+    def estados_conversacion(self) -> dict:
+        """Handlers de mensajes por estado (pasos que aceptan texto, ubicación o foto)."""
+        return {
+            nombre: [MessageHandler(FILTROS_PASO[paso.tipo], paso.manejador)]
+            for nombre, paso in self.pasos.items() if paso.cfg.get("mensajes", True)
+        }
+
+
+motor_pasos = MotorPasos(PASOS)
+
+
+# ================== MANEJAR PASO ==================
+async def manejar_paso(update: Update, context: ContextTypes.DEFAULT_TYPE, paso: str):
+    chat_id = update.effective_chat.id
+
+    # 🚫 Evita respuestas del grupo de supervisión
+    if chat_id in GRUPO_SUPERVISION_ID:
+        return ConversationHandler.END
+
+    registro = context.user_data.setdefault("registro", {})
+    paso_c = motor_pasos.get(paso)
+    if paso_c is None:
+        await salida.enviar(context.bot, chat_id, "⚠️ Paso no reconocido. Intenta nuevamente.")
+        return paso
+
+    valor = paso_c.validar(update, paso_c.cfg)
+    if valor is None and paso_c.tipo != "menu":
+        await salida.enviar(context.bot, chat_id, paso_c.error)
+        return paso
+
+    _marcar_origen_resumen(registro)
+    return await paso_c.capturar(update, context, registro, paso_c, valor)
+
+
+async def manejar_paso_actual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Estado CORREGIR: el mensaje corresponde al paso que se está corrigiendo."""
+    paso = context.user_data.get("registro", {}).get("PASO_ACTUAL", "")
+    return await manejar_paso(update, context, paso)
+
+
+# ============================================================
+# 🔎 USAR_CAJA_<CODIGO> → el técnico elige una sugerencia de código
+# ============================================================
+async def manejar_sugerencia_caja_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    registro = context.user_data.setdefault("registro", {})
+
+    codigo = query.data.replace("USAR_CAJA_", "", 1)
+    nodo = obtener_nodo_por_codigo(codigo)
+    registro["CODIGO_CAJA"] = codigo
+    registro["NODO"] = nodo or "-"
+
+    tipo_detectado = _detectar_tipo_por_codigo(codigo)
+    if tipo_detectado:
+        registro["OBS_TIPO"] = tipo_detectado
+    logger.info("🔎 Sugerencia elegida: %s → nodo %s", codigo, registro['NODO'])
+
+    texto = (
+        f"🏷 *Código CTO/NAP/FAT:* {codigo}\n"
+        f"📡 Nodo encontrado: *{registro['NODO']}*\n"
+        + (f"🧩 Tipo detectado automáticamente: *{tipo_detectado}*\n" if tipo_detectado else "")
+        + "¿Deseas confirmar o corregir?"
+    )
+    markup = TECLADOS["CONFIRMAR_CODIGO_CAJA"]
+    try:
+        await query.edit_message_text(texto, parse_mode="Markdown", reply_markup=markup)
+    except Exception:
+        await salida.enviar(context.bot, query.message.chat_id, texto, parse_mode="Markdown", reply_markup=markup)
+    registro["PASO_ACTUAL"] = "CODIGO_CAJA"
+    return "CONFIRMAR"
 
 
 # ============================================================
@@ -1065,57 +3226,22 @@ async def manejar_confirmar_callback(update: Update, context: ContextTypes.DEFAU
     chat_id = query.message.chat_id
     registro = context.user_data.setdefault("registro", {})
     _, paso = query.data.split("CONFIRMAR_", 1) if "CONFIRMAR_" in query.data else ("CONFIRMAR", registro.get("PASO_ACTUAL", ""))
+    paso_c = motor_pasos.get(paso)
 
-    # 🟢 Si se confirma la observación → mostrar resumen limpio
-    if paso == "OBS":
-        logger.info("✅ [CONFIRMAR_OBS] Confirmando observación y mostrando resumen final")
-
-        # 🧹 Eliminar mensaje del menú anterior
-        old_menu_id = registro.pop("ULTIMO_MENSAJE_MENU", None)
-        if old_menu_id:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=old_menu_id)
-            except Exception:pass
-        # 🧹 Eliminar también el mensaje anterior de confirmación de observación (si existe)
-        try:
-            await query.delete_message()
-        except Exception: pass
-
-        # ✅ Mostrar confirmación única
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="✅ Observación seleccionada correctamente.",
-            parse_mode="Markdown"
-        )
-
-        # 👇 MAGIA CONDICIONAL: ¿Requiere puerto?
-        obs_seleccionada = registro.get("OBSERVACION", "")
-        if obs_seleccionada in OBS_REQUIERE_PUERTO:
-            registro["PASO_ACTUAL"] = "CANTIDAD_PUERTOS"
-            await mostrar_menu_cantidad_puertos(chat_id, context)
-            return "CANTIDAD_PUERTOS"
-        else:
-            registro.pop("PUERTO_REPORTADO", None)
-            registro.pop("PUERTOS_SELECCIONADOS", None)
-            registro.pop("CANTIDAD_PUERTOS_TOTAL", None)
-            registro.pop("FOTO_PUERTO", None)
-            await mostrar_resumen_final(update, context)
-            return "RESUMEN_FINAL"
-
-    # 👇 INTERCEPTAR CUANDO TERMINE LA FOTO DEL PUERTO
-    if paso == "FOTO_PUERTO":
-        try: await query.edit_message_text("✅ Foto de puerto confirmada.", parse_mode="Markdown")
-        except Exception: pass
-        await mostrar_resumen_final(update, context)
-        return "RESUMEN_FINAL"
+    # 🔚 Paso desconocido → menú de observaciones
+    if paso_c is None:
+        return await motor_pasos.abrir_menu("OBS", chat_id, context, registro)
 
+    # 🟢 Pasos con acción propia (OBS) → la acción y luego el destino declarado
+    if paso_c.al_confirmar:
+        await paso_c.al_confirmar(query, context, registro)
+        return await motor_pasos.ir_a(motor_pasos.siguiente(paso_c, registro), update, context, registro)
 
     # ============================================================
     # 🟢 1) CORRECCIÓN DESDE RESUMEN FINAL
     # ============================================================
     if registro.get("CORRECCION_ORIGEN") == "RESUMEN":
-        tipo_paso = PASOS.get(paso, {}).get("tipo", "")
-        if tipo_paso == "foto":
+        if paso_c.tipo == "foto":
             msg = "📸 *Foto corregida correctamente.*"
         else:
             msg = "✅ *Campo corregido correctamente.*"
@@ -1123,7 +3249,7 @@ async def manejar_confirmar_callback(update: Update, context: ContextTypes.DEFAU
         try:
             await query.edit_message_text(msg, parse_mode="Markdown")
         except Exception:
-            await context.bot.send_message(chat_id=chat_id, text=msg, parse_mode="Markdown")
+            await salida.enviar(context.bot, chat_id, msg, parse_mode="Markdown")
 
         registro["CORRECCION_ORIGEN"] = None
         registro["VOLVER_A_RESUMEN"] = False
@@ -1134,106 +3260,15 @@ async def manejar_confirmar_callback(update: Update, context: ContextTypes.DEFAU
         return "RESUMEN_FINAL"
 
     # ============================================================
-    # 🟢 1.5) FLUJO MANUAL PARA CAMPOS BÁSICOS (TICKET, DNI, CLIENTE, PARTNER, CUADRILLA)
-    # ============================================================
-    if paso in ["TICKET", "DNI", "NOMBRE_CLIENTE", "PARTNER", "TIPO_CUADRILLA", "CUADRILLA", "PUERTO_REPORTADO"]:
-        try: await query.edit_message_text(f"✅ {paso.replace('_',' ')} confirmado.", parse_mode="Markdown")
-        except: pass
-
-        if paso == "PUERTO_REPORTADO":
-            await context.bot.send_message(chat_id, "📸 Envía la *foto del puerto reportado sin potencia*:", parse_mode="Markdown")
-            registro["PASO_ACTUAL"] = "FOTO_PUERTO"
-            return "FOTO_PUERTO"
-
-        # Avanza al siguiente paso
-        siguiente_paso = {
-            "TICKET": "DNI",
-            "DNI": "NOMBRE_CLIENTE",
-            "NOMBRE_CLIENTE": "PARTNER",
-            "PARTNER": "TIPO_CUADRILLA",
-            "TIPO_CUADRILLA": "CUADRILLA",
-            "CUADRILLA": "CODIGO_CAJA"
-        }.get(paso)
-
-        if siguiente_paso:
-            if siguiente_paso == "TIPO_CUADRILLA":
-                await mostrar_menu_tipo_cuadrilla(chat_id, context)
-                registro["PASO_ACTUAL"] = "TIPO_CUADRILLA"
-                return "TIPO_CUADRILLA"
-
-            mensajes = {
-                "DNI": "🪪 Ingrese ahora el *DNI del cliente:*",
-                "NOMBRE_CLIENTE": "👤 Ingrese el *Nombre del Cliente:*",
-                "PARTNER": "🏢 Ingrese el *Partner:*",
-                "CUADRILLA": "👷 Ingresa tu *nomenclatura junto al nombre de tu Cuadrilla:*",
-                "CODIGO_CAJA": "🏷 Ingrese el *Código de CTO/NAP/FAT:*"
-            }
-            
-            texto = mensajes.get(siguiente_paso, f"➡️ Continúa con *{siguiente_paso.replace('_',' ')}*")
-            await context.bot.send_message(chat_id=chat_id, text=texto, parse_mode="Markdown")
-            registro["PASO_ACTUAL"] = siguiente_paso
-            return siguiente_paso
-
-
-    # ============================================================
-    # 🟡 2) FLUJO REGULAR (captura normal de datos)
+    # 🟡 2) FLUJO REGULAR → destino declarado en PASOS
     # ============================================================
-    tipo = PASOS.get(paso, {}).get("tipo")
-    siguiente = PASOS.get(paso, {}).get("siguiente")
-
-    # 📸 Si es foto (FOTO_CAJA, FOTO_CAJA_ABIERTA o FOTO_MEDICION)
-    if tipo == "foto":
+    if paso_c.confirmado:
         try:
-            await query.edit_message_text("✅ Foto subida correctamente.", parse_mode="Markdown")
+            await query.edit_message_text(paso_c.confirmado, parse_mode="Markdown")
         except Exception:
-            await context.bot.send_message(chat_id=chat_id, text="✅ Foto subida correctamente.", parse_mode="Markdown")
-
-        if siguiente and siguiente != "OBS":
-            registro["PASO_ACTUAL"] = siguiente
-            instruccion = PASOS.get(siguiente, {}).get(
-                "instruccion",
-                PASOS.get(siguiente, {}).get("mensaje", f"➡️ Continúa con *{siguiente.replace('_',' ')}*")
-            )
-            await context.bot.send_message(chat_id=chat_id, text=instruccion, parse_mode="Markdown")
-            return siguiente
-
-        # Si siguiente es OBS → abrir menú de observaciones
-        if siguiente == "OBS":
-            registro["PASO_ACTUAL"] = "OBS_TIPO"
-
-            # 🧹 Limpiar mensajes anteriores
-            await limpiar_mensaje_anterior(context, chat_id, registro)
-
-            msg = await context.bot.send_message(
-                chat_id=chat_id,
-                text="📋 Usa el menú para elegir el tipo de observación:",
-                parse_mode="Markdown"
-            )
-            registro["ULTIMO_MENSAJE_MENU"] = msg.message_id
-
-            await mostrar_menu_obs(chat_id, context, tipo=registro.get("OBS_TIPO") or None)
-            return "OBS_TIPO"
-
-    # ✏️ Si es texto o ubicación
-    elif tipo in ("texto", "ubicacion"):
-        if siguiente:
-            registro["PASO_ACTUAL"] = siguiente
-            instruccion = PASOS.get(siguiente, {}).get(
-                "instruccion",
-                PASOS.get(siguiente, {}).get("mensaje", f"➡️ Continúa con *{siguiente.replace('_',' ')}*")
-            )
-            await context.bot.send_message(chat_id=chat_id, text=instruccion, parse_mode="Markdown")
-            return siguiente
+            await salida.enviar(context.bot, chat_id, paso_c.confirmado, parse_mode="Markdown")
 
-    # ============================================================
-    # 🔚 Si no hay más pasos, ir al menú de observaciones
-    # ============================================================
-    registro["PASO_ACTUAL"] = "OBS_TIPO"
-    await limpiar_mensaje_anterior(context, chat_id, registro)
-    msg = await context.bot.send_message(chat_id=chat_id, text="📋 Usa el menú para elegir el tipo de observación:", parse_mode="Markdown")
-    registro["ULTIMO_MENSAJE_MENU"] = msg.message_id
-    await mostrar_menu_obs(chat_id, context, tipo=None)
-    return "OBS_TIPO"
+    return await motor_pasos.ir_a(motor_pasos.siguiente(paso_c, registro), update, context, registro)
 
 
 # ============================================================
@@ -1261,29 +3296,12 @@ async def manejar_corregir_callback(update: Update, context: ContextTypes.DEFAUL
     registro["PASO_ACTUAL"] = paso
 
 
-    # 👇 CASOS ESPECIALES PARA DESPLEGAR BOTONERAS AL CORREGIR
-    if paso == "TIPO_CUADRILLA":
-        await mostrar_menu_tipo_cuadrilla(chat_id, context, query)
-        return "TIPO_CUADRILLA"
-        
-    if paso == "PUERTO_REPORTADO":
-        registro["PUERTOS_SELECCIONADOS"] = [] # Limpiamos el historial
-        registro["PASO_ACTUAL"] = "CANTIDAD_PUERTOS"
-        await mostrar_menu_cantidad_puertos(chat_id, context, query if 'query' in locals() else None)
-        return "CANTIDAD_PUERTOS"
-
-    # caso especial: OBS → abre menú
-    if paso == "OBS":
-        registro["PASO_ACTUAL"] = "OBS_TIPO"
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="🧭 Corrige la *observación* seleccionando nuevamente el tipo de elemento:",
-            parse_mode="Markdown",
-        )
-        await mostrar_menu_obs(chat_id, context, tipo=None)
-        return "OBS_TIPO"
+    # 👇 Pasos de menú (o que se corrigen desde un menú) → desplegar la botonera
+    paso_c = motor_pasos.a_corregir(paso)
+    if paso_c is not None and motor_pasos[paso_c.corregir].menu:
+        return await motor_pasos.abrir_menu(paso_c.corregir, chat_id, context, registro, query=query, correccion=True)
 
-    tipo = PASOS.get(paso, {}).get("tipo", "texto")
+    tipo = paso_c.tipo if paso_c else "texto"
     # mensajes por tipo
     mensajes = {
         "texto": f"✏️ Ingresa nuevamente el *{paso.replace('_', ' ')}*: ",
@@ -1295,9 +3313,10 @@ async def manejar_corregir_callback(update: Update, context: ContextTypes.DEFAUL
     mensaje_default = f"✏️ Ingresa nuevamente *{paso.replace('_', ' ')}*:"
     texto = f"{mensajes.get(tipo, mensaje_default)}\n\n🔁 Después confirma para continuar."
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=texto,
+    await salida.enviar(
+        context.bot,
+        chat_id,
+        texto,
         parse_mode="Markdown",
     )
     return paso
@@ -1327,7 +3346,7 @@ async def manejar_edicion_desde_resumen_callback(update: Update, context: Contex
     else:
         paso = registro.get("PASO_ACTUAL", "")
 
-    logger.info(f"✏️ [RESUMEN_FINAL] Iniciando corrección del campo: {paso}")
+    logger.info("✏️ [RESUMEN_FINAL] Iniciando corrección del campo: %s", paso)
 
     # 🧭 Marcar banderas de corrección
     registro["CORRECCION_ORIGEN"] = "RESUMEN"
@@ -1335,78 +3354,21 @@ async def manejar_edicion_desde_resumen_callback(update: Update, context: Contex
     registro["EN_CORRECCION"] = True
     registro["PASO_ACTUAL"] = paso
 
-    if paso == "TIPO_CUADRILLA":
-        await mostrar_menu_tipo_cuadrilla(chat_id, context)
-        return "TIPO_CUADRILLA"
-
-    if paso == "PUERTO_REPORTADO":
-        registro["PUERTOS_SELECCIONADOS"] = [] # Limpiamos el historial
-        registro["PASO_ACTUAL"] = "CANTIDAD_PUERTOS"
-        await mostrar_menu_cantidad_puertos(chat_id, context, query if 'query' in locals() else None)
-        return "CANTIDAD_PUERTOS"
-
-    if paso in ("OBS", "OBS_TIPO", "OBS_SELECCION"):
-        registro["PASO_ACTUAL"] = "OBS_TIPO"
-        await context.bot.send_message(chat_id=chat_id, text="📋 Usa el menú para elegir el tipo de observación:", parse_mode="Markdown")
-        await mostrar_menu_obs(chat_id, context, tipo=None)
-        return "OBS_TIPO"
-
-    # ============================================================
-    # 🟡 CASO ESPECIAL: Observación → mostrar menú automático
-    # ============================================================
-    if paso in ("OBS", "OBS_TIPO", "OBS_SELECCION"):
-        registro["PASO_ACTUAL"] = "OBS_TIPO"
-        registro["CORRECCION_ORIGEN"] = "RESUMEN"
-        registro["VOLVER_A_RESUMEN"] = True
-        registro["EN_CORRECCION"] = True
-
-        # 💬 Mostrar inmediatamente el menú CTO/NAP/FAT
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="📋 Usa el menú para elegir el tipo de observación:",
-            parse_mode="Markdown"
-        )
-        await mostrar_menu_obs(chat_id, context, tipo=None)
-        logger.info("🟢 [RESUMEN_FINAL] Menú de observaciones desplegado automáticamente")
-        registro["PASO_ACTUAL"] = "OBS_TIPO"
-        return "OBS_TIPO"
-
-    # ============================================================
-    # 🔹 Otros campos → pedir nuevo valor normalmente
-    # ============================================================
-
-    # 🖼️ Si el paso es una de las nuevas fotos, mostrar mensaje específico
-    if paso in ("FOTO_CAJA_ABIERTA", "FOTO_MEDICION"):
-        texto = f"📸 Envía nuevamente la *{paso.replace('_',' ').title()}*."
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=texto, parse_mode="Markdown")
-        except Exception as e:
-            logger.error(f"❌ Error mostrando instrucción de corrección ({paso}): {e}")
-        return paso
-
-
-    tipo = PASOS.get(paso, {}).get("tipo", "texto")
-    instruccion = PASOS.get(paso, {}).get(
-        "instruccion", f"✏️ Envía el nuevo valor para *{paso.replace('_',' ')}*:"
-    )
-
-    if tipo == "foto":
-        texto = f"📸 Envía nuevamente la *foto de {paso.replace('_',' ')}*."
-    elif tipo == "ubicacion":
-        texto = "📍 Envía la *nueva ubicación (GPS)* de la CTO/NAP/FAT."
-    elif tipo == "texto":
-        texto = f"✏️ Envía el nuevo *{paso.replace('_',' ')}*."
-    else:
-        texto = instruccion
+    # 👇 Pasos de menú (o que se corrigen desde un menú) → desplegar la botonera
+    paso_c = motor_pasos.a_corregir(paso)
+    if paso_c is not None and motor_pasos[paso_c.corregir].menu:
+        return await motor_pasos.abrir_menu(paso_c.corregir, chat_id, context, registro, correccion=True)
 
+    # 🔹 Otros campos → pedir nuevo valor con la instrucción de corrección del paso
+    texto = paso_c.instruccion_correccion if paso_c else f"✏️ Envía el nuevo *{paso.replace('_',' ')}*."
     try:
-        await context.bot.send_message(chat_id=chat_id, text=texto, parse_mode="Markdown")
+        await salida.enviar(context.bot, chat_id, texto, parse_mode="Markdown")
     except Exception as e:
-        logger.error(f"❌ Error mostrando instrucción de corrección ({paso}): {e}")
-        await context.bot.send_message(chat_id=chat_id, text=f"✏️ Envía el nuevo valor para {paso}.")
+        logger.error("❌ Error mostrando instrucción de corrección (%s): %s", paso, e)
+        await salida.enviar(context.bot, chat_id, f"✏️ Envía el nuevo valor para {paso}.")
 
     # 🔁 Retornar el mismo estado que se corrige
-    logger.info(f"✏️ [RESUMEN_FINAL] Esperando nueva entrada para el paso: {paso}")
+    logger.info("✏️ [RESUMEN_FINAL] Esperando nueva entrada para el paso: %s", paso)
     return paso
 
 
@@ -1419,24 +3381,14 @@ async def mostrar_menu_obs(chat_id, context, tipo: str | None = None, query=None
 
     # 🔹 Menú principal
     if not tipo or tipo in ("None", "", None):
-        keyboard = [
-            [InlineKeyboardButton("🟧 CTO", callback_data="OBS_TIPO_CTO")],
-            [InlineKeyboardButton("🟦 NAP", callback_data="OBS_TIPO_NAP")],
-            [InlineKeyboardButton("🟩 FAT", callback_data="OBS_TIPO_FAT")],
-        ]
         texto = "🧩 *Selecciona el tipo de elemento* para registrar la observación:"
-        markup = InlineKeyboardMarkup(keyboard)
+        markup = TECLADOS["OBS_TIPO"]
 
-        old_msg_id = registro.pop("ULTIMO_MENSAJE_OBS", None)
-        if old_msg_id:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=old_msg_id)
-            except Exception:
-                pass
+        salida.borrar(context.bot, chat_id, registro.pop("ULTIMO_MENSAJE_OBS", None))
 
         msg = (await query.edit_message_text(texto, reply_markup=markup, parse_mode="Markdown")
                if es_flotante else
-               await context.bot.send_message(chat_id=chat_id, text=texto, reply_markup=markup, parse_mode="Markdown"))
+               await salida.enviar(context.bot, chat_id, texto, reply_markup=markup, parse_mode="Markdown"))
 
         registro["ULTIMO_MENSAJE_OBS"] = msg.message_id
         registro["PASO_ACTUAL"] = "OBS_TIPO"
@@ -1448,36 +3400,29 @@ async def mostrar_menu_obs(chat_id, context, tipo: str | None = None, query=None
         texto = f"⚠️ No hay observaciones definidas para *{tipo}*."
         try:
         # ✅ Enviamos siempre un nuevo mensaje (ya no editamos el anterior)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=texto,
+            await salida.enviar(
+                context.bot,
+                chat_id,
+                texto,
                 reply_markup=markup,
                 parse_mode="Markdown",
                 disable_web_page_preview=True
             )
         except Exception as e:
-            logger.error(f"❌ Error mostrando submenú {tipo}: {e}")
+            logger.error("❌ Error mostrando submenú %s: %s", tipo, e)
 
         return "OBS_TIPO"
 
-    keyboard = [[InlineKeyboardButton(obs, callback_data=f"OBS_SET_{idx}")]
-                for idx, obs in enumerate(opciones)]
-    keyboard.append([InlineKeyboardButton("🔙 Volver", callback_data="OBS_BACK")])
-
     texto = f"📝 *Selecciona la observación correspondiente a {tipo}:*"
-    markup = InlineKeyboardMarkup(keyboard)
+    markup = TECLADOS[f"OBS_{tipo}"]
 
-    old_msg_id = registro.pop("ULTIMO_MENSAJE_OBS", None)
-    if old_msg_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=old_msg_id)
-        except Exception:
-            pass
+    salida.borrar(context.bot, chat_id, registro.pop("ULTIMO_MENSAJE_OBS", None))
 
     # ✅ Enviamos siempre un nuevo mensaje (ya no editamos el anterior)
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=texto,
+    msg = await salida.enviar(
+        context.bot,
+        chat_id,
+        texto,
         reply_markup=markup,
         parse_mode="Markdown",
         disable_web_page_preview=True
@@ -1495,10 +3440,7 @@ async def mostrar_resumen_final(update: Update, context: ContextTypes.DEFAULT_TY
         chat_id = update.effective_chat.id
         bot = context.bot
 
-        old_msg_id = reg.pop("ULTIMO_MENSAJE_RESUMEN", None)
-        if old_msg_id:
-            try: await bot.delete_message(chat_id=chat_id, message_id=old_msg_id)
-            except: pass
+        salida.borrar(bot, chat_id, reg.pop("ULTIMO_MENSAJE_RESUMEN", None))
 
         ticket       = reg.get("TICKET", "-")
         dni          = reg.get("DNI", "-")
@@ -1527,9 +3469,13 @@ async def mostrar_resumen_final(update: Update, context: ContextTypes.DEFAULT_TY
         )
         if link_mapa: resumen += f"[🌐 Ver ubicación CTO/NAP/FAT]({link_mapa})\n"
 
-        foto_ok = "✅" if reg.get("FOTO_CAJA") else "❌"
-        foto_open_ok = "✅" if reg.get("FOTO_CAJA_ABIERTA") else "❌"
-        foto_med_ok = "✅" if reg.get("FOTO_MEDICION") else "❌"
+        def _estado_foto(valor):
+            if valor == FOTO_PENDIENTE: return "⏳"
+            return "✅" if valor else "❌"
+
+        foto_ok = _estado_foto(reg.get("FOTO_CAJA"))
+        foto_open_ok = _estado_foto(reg.get("FOTO_CAJA_ABIERTA"))
+        foto_med_ok = _estado_foto(reg.get("FOTO_MEDICION"))
 
         resumen += f"📸 *Foto CTO/NAP/FAT (Exterior):* {foto_ok}\n"
         resumen += f"📸 *Foto CTO/NAP/FAT (Interior):* {foto_open_ok}\n"
@@ -1538,26 +3484,25 @@ async def mostrar_resumen_final(update: Update, context: ContextTypes.DEFAULT_TY
 
         if puerto_rep:
             resumen += f"🔌 *Puerto Reportado:* {puerto_rep}\n"
-            foto_pto_ok = "✅" if reg.get("FOTO_PUERTO") else "❌"
+            foto_pto_ok = _estado_foto(reg.get("FOTO_PUERTO"))
             resumen += f"📸 *Foto Puerto (Sin potencia):* {foto_pto_ok}\n"
 
         resumen += "\n¿Deseas confirmar tu registro?"
 
-        keyboard = [[InlineKeyboardButton("✅ Guardar", callback_data="FINAL_GUARDAR")], [InlineKeyboardButton("✏️ Corregir", callback_data="FINAL_CORREGIR")], [InlineKeyboardButton("❌ Cancelar", callback_data="FINAL_CANCELAR")]]
-        markup = InlineKeyboardMarkup(keyboard)
+        markup = TECLADOS["RESUMEN_FINAL"]
 
         if getattr(update, "callback_query", None):
             try: msg = await update.callback_query.edit_message_text(resumen, parse_mode="Markdown", reply_markup=markup, disable_web_page_preview=True)
-            except: msg = await bot.send_message(chat_id=chat_id, text=resumen, parse_mode="Markdown", reply_markup=markup, disable_web_page_preview=True)
+            except: msg = await salida.enviar(bot, chat_id, resumen, parse_mode="Markdown", reply_markup=markup, disable_web_page_preview=True)
         else:
-            msg = await update.message.reply_text(resumen, parse_mode="Markdown", reply_markup=markup, disable_web_page_preview=True)
+            msg = await salida.enviar(bot, chat_id, resumen, parse_mode="Markdown", reply_markup=markup, disable_web_page_preview=True)
 
         reg["ULTIMO_MENSAJE_RESUMEN"] = msg.message_id
         reg["PASO_ACTUAL"] = "RESUMEN_FINAL"
         return "RESUMEN_FINAL"
 
     except Exception as e:
-        logger.error(f"❌ Error en mostrar_resumen_final: {e}")
+        logger.error("❌ Error en mostrar_resumen_final: %s", e)
         return ConversationHandler.END
 
 
@@ -1591,23 +3536,14 @@ async def resumen_final_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer("✏️ Elige un campo a corregir")
 
         texto = "✏️ *Selecciona el campo que deseas corregir:*"
-        keyboard = [
-            [InlineKeyboardButton("🎫 Ticket", callback_data="EDITAR_TICKET")],
-            [InlineKeyboardButton("👥 Tipo Cuadrilla", callback_data="EDITAR_TIPO_CUADRILLA")],
-            [InlineKeyboardButton("🏷 Código CTO/NAP/FAT", callback_data="EDITAR_CODIGO_CAJA")],
-            [InlineKeyboardButton("📍 Ubicación CTO/NAP/FAT", callback_data="EDITAR_UBICACION_CTO")],
-            [InlineKeyboardButton("📸 Foto (Exterior)", callback_data="EDITAR_FOTO_CAJA"), InlineKeyboardButton("📸 Foto (Interior)", callback_data="EDITAR_FOTO_CAJA_ABIERTA")],
-            [InlineKeyboardButton("📸 Foto (Medición)", callback_data="EDITAR_FOTO_MEDICION"), InlineKeyboardButton("📝 Observación", callback_data="EDITAR_OBS")],
-        ]
-
-        if registro.get("PUERTO_REPORTADO"):
-            keyboard.append([InlineKeyboardButton("🔌 Puerto", callback_data="EDITAR_PUERTO_REPORTADO"), InlineKeyboardButton("📸 Foto Puerto", callback_data="EDITAR_FOTO_PUERTO")])
+        markup = TECLADOS["FINAL_CORREGIR_PUERTO" if registro.get("PUERTO_REPORTADO") else "FINAL_CORREGIR"]
 
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=texto,
+        await salida.enviar(
+            context.bot,
+            chat_id,
+            texto,
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=markup
         )
 
         registro["VOLVER_A_RESUMEN"] = True
@@ -1623,15 +3559,15 @@ async def resumen_final_callback(update: Update, context: ContextTypes.DEFAULT_T
         try:
             await query.edit_message_text("❌ Registro cancelado por el usuario.")
         except Exception:
-            await context.bot.send_message(chat_id=chat_id, text="❌ Registro cancelado por el usuario.")
-        context.user_data.pop("registro", None)
+            await salida.enviar(context.bot, chat_id, "❌ Registro cancelado por el usuario.")
+        descartar_subidas_pendientes(context.user_data.pop("registro", None))
         return ConversationHandler.END
 
     # ============================================================
     # 🚫 Cualquier otra acción desconocida
     # ============================================================
     await query.answer("⚠️ Acción no reconocida.")
-    logger.warning(f"⚠️ Acción desconocida en resumen_final_callback: {accion}")
+    logger.warning("⚠️ Acción desconocida en resumen_final_callback: %s", accion)
     return "RESUMEN_FINAL"
 
 # ============================================================
@@ -1659,8 +3595,8 @@ async def manejar_volver_desde_resumen_callback(update: Update, context: Context
     try:
         await mostrar_resumen_final(update, context)
     except Exception as e:
-        logger.error(f"❌ Error mostrando resumen: {e}")
-        await context.bot.send_message(chat_id, "⚠️ No se pudo mostrar el resumen final, intenta nuevamente.")
+        logger.error("❌ Error mostrando resumen: %s", e)
+        await salida.enviar(context.bot, chat_id, "⚠️ No se pudo mostrar el resumen final, intenta nuevamente.")
 
     return "RESUMEN_FINAL"
 
@@ -1674,7 +3610,7 @@ async def manejar_tipo_obs_callback(update: Update, context: ContextTypes.DEFAUL
     chat_id = query.message.chat_id
     registro = context.user_data.setdefault("registro", {})
 
-    logger.info(f"🟢 [OBS_TIPO] Callback recibido: {data}")
+    logger.info("🟢 [OBS_TIPO] Callback recibido: %s", data)
 
     # 🔙 Volver al menú principal CTO/NAP/FAT
     if data in ("OBS_TIPO_BACK", "OBS_BACK"):
@@ -1693,8 +3629,8 @@ async def manejar_tipo_obs_callback(update: Update, context: ContextTypes.DEFAUL
             await mostrar_menu_obs(chat_id, context, tipo=None)
             logger.info("📋 Menú principal CTO/NAP/FAT mostrado correctamente.")
         except Exception as e:
-            logger.error(f"❌ Error al volver al menú principal: {e}")
-            await context.bot.send_message(chat_id=chat_id, text="⚠️ No se pudo mostrar el menú principal de observaciones. Intenta nuevamente.", parse_mode="Markdown",)
+            logger.error("❌ Error al volver al menú principal: %s", e)
+            await salida.enviar(context.bot, chat_id, "⚠️ No se pudo mostrar el menú principal de observaciones. Intenta nuevamente.", parse_mode="Markdown")
 
         registro["PASO_ACTUAL"] = "OBS_TIPO"
         return "OBS_TIPO"
@@ -1704,7 +3640,7 @@ async def manejar_tipo_obs_callback(update: Update, context: ContextTypes.DEFAUL
     if data.startswith("OBS_TIPO_"):
         tipo = data.replace("OBS_TIPO_", "")
         registro["OBS_TIPO"] = tipo
-        logger.info(f"✅ [OBS_TIPO] Tipo de observación seleccionado: {tipo}")
+        logger.info("✅ [OBS_TIPO] Tipo de observación seleccionado: %s", tipo)
         await mostrar_menu_obs(chat_id, context, tipo=tipo, query=query)
         registro["PASO_ACTUAL"] = "OBS_SELECCION"
         return "OBS_SELECCION"
@@ -1723,18 +3659,13 @@ async def manejar_observacion_callback(update: Update, context: ContextTypes.DEF
     # 🧹 Eliminar mensaje del menú anterior (para que no quede flotando)
     chat_id = query.message.chat_id
     registro = context.user_data.setdefault("registro", {})
-    old_menu_id = registro.pop("ULTIMO_MENSAJE_MENU", None)
-    if old_menu_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=old_menu_id)
-        except Exception:
-            pass
+    salida.borrar(context.bot, chat_id, registro.pop("ULTIMO_MENSAJE_MENU", None))
 
     data = query.data
     chat_id = query.message.chat_id
     registro = context.user_data.setdefault("registro", {})
 
-    logger.info(f"🟢 [OBS_SET] Callback recibido: {data}")
+    logger.info("🟢 [OBS_SET] Callback recibido: %s", data)
 
     tipo_actual = registro.get("OBS_TIPO", "CTO")
     opciones = OBS_OPCIONES.get(tipo_actual, [])
@@ -1745,9 +3676,10 @@ async def manejar_observacion_callback(update: Update, context: ContextTypes.DEF
         observacion = None
 
     if not observacion:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="⚠️ No se pudo identificar la observación seleccionada. Intenta nuevamente.",
+        await salida.enviar(
+            context.bot,
+            chat_id,
+            "⚠️ No se pudo identificar la observación seleccionada. Intenta nuevamente.",
             parse_mode="Markdown",
         )
         return "OBS_TIPO"
@@ -1758,18 +3690,13 @@ async def manejar_observacion_callback(update: Update, context: ContextTypes.DEF
 
     # ✅ Mostrar confirmación y botones
     texto = f"✅ *Observación registrada:* {observacion}\n\n¿Deseas confirmar o corregir?"
-    markup = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Confirmar", callback_data="CONFIRMAR_OBS"),
-            InlineKeyboardButton("✏️ Corregir", callback_data="CORREGIR_OBS")
-        ]
-    ])
+    markup = TECLADOS["CONFIRMAR_OBS"]
 
     try:
         await query.edit_message_text(text=texto, parse_mode="Markdown", reply_markup=markup)
     except Exception as e:
-        logger.error(f"❌ Error mostrando botones de confirmación OBS: {e}")
-        await context.bot.send_message(chat_id=chat_id, text=texto, parse_mode="Markdown", reply_markup=markup)
+        logger.error("❌ Error mostrando botones de confirmación OBS: %s", e)
+        await salida.enviar(context.bot, chat_id, texto, parse_mode="Markdown", reply_markup=markup)
 
     return "CONFIRMAR"
 
@@ -1790,13 +3717,14 @@ async def manejar_ir_resumen_final_callback(update: Update, context: ContextType
     try:
         await mostrar_resumen_final(update, context)
     except Exception as e:
-        logger.error(f"❌ Error mostrando resumen desde OBS: {e}")
-        await context.bot.send_message(chat_id, "⚠️ No se pudo mostrar el resumen final.")
+        logger.error("❌ Error mostrando resumen desde OBS: %s", e)
+        await salida.enviar(context.bot, chat_id, "⚠️ No se pudo mostrar el resumen final.")
 
     return "RESUMEN_FINAL"
 
 
 # ============= GUARDAR REGISTRO ====================
+@instrumentar("handler", estado="RESUMEN_FINAL", handler="guardar_registro")
 async def guardar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Guarda el registro del técnico en OneDrive (Excel) y refleja el resultado en Google Sheets.
@@ -1807,7 +3735,7 @@ async def guardar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
 
         if not registro:
-            await context.bot.send_message(update.effective_chat.id, "⚠️ No hay datos de registro activos.")
+            await salida.enviar(context.bot, update.effective_chat.id, "⚠️ No hay datos de registro activos.")
             return ConversationHandler.END
 
         # 🧹 Eliminar mensaje del resumen anterior (para que no quede duplicado)
@@ -1817,7 +3745,7 @@ async def guardar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await context.bot.delete_message(chat_id=chat_id, message_id=old_msg_id)
                 logger.info("🧹 Resumen de incidencia eliminado antes de mostrar el mensaje final.")
             except Exception as e:
-                logger.warning(f"⚠️ No se pudo eliminar el mensaje del resumen final: {e}")
+                logger.warning("⚠️ No se pudo eliminar el mensaje del resumen final: %s", e)
 
         # 🧑‍💻 Datos del usuario
         user = update.effective_user
@@ -1834,12 +3762,25 @@ async def guardar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not registro.get("DEPARTAMENTO") or not registro.get("PROVINCIA") or not registro.get("DISTRITO"):
             lat, lng = registro.get("LAT_CAJA"), registro.get("LNG_CAJA")
             if lat and lng:
-                dep, prov, dist = geocodificar(lat, lng)
+                dep, prov, dist = await geocodificar(lat, lng)
                 if dep != "-" or prov != "-" or dist != "-":
                     registro["DEPARTAMENTO"] = dep
                     registro["PROVINCIA"] = prov
                     registro["DISTRITO"] = dist
 
+        # 📤 Esperar fotos que sigan subiéndose en segundo plano
+        fallidos = await esperar_subidas_pendientes(registro)
+        if fallidos:
+            nombres = "\n".join(f"• {ETIQUETAS.get(p, p)}" for p in fallidos)
+            await salida.enviar(
+                context.bot,
+                chat_id,
+                f"⚠️ Estas fotos no se pudieron subir:\n{nombres}\n\nCorrígelas desde el resumen y vuelve a guardar.",
+                parse_mode="Markdown"
+            )
+            await mostrar_resumen_final(update, context)
+            return "RESUMEN_FINAL"
+
         # 🔹 Normalización de datos
         nodo_val = registro.get("NODO", "-")
         foto_val = registro.get("FOTO_CAJA", "")
@@ -1871,22 +3812,31 @@ async def guardar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
             registro.get("DISTRITO", ""),
             registro.get("OBS", "-"),
             registro.get("PUERTO_REPORTADO", ""),
-            registro.get("FOTO_PUERTO", "")
+            registro.get("FOTO_PUERTO", ""),
+            registro.get("ID_REGISTRO", ""),
         ]
         # ==========================================
         # ☁️ Guardar registro solo en Google Sheets
         # ==========================================
-        msg_guardando = await context.bot.send_message(
+        msg_guardando = await salida.enviar(
+            context.bot,
             update.effective_chat.id,
             "💾 Guardando registro..."
         )
 
 
         try:
-            gs_append_row(fila)
-            logger.info("✅ Registro guardado correctamente en Google Sheets.")
+            await gs_registrar_fila(fila)
+            logger.info("✅ Registro anotado en el outbox y encolado para Google Sheets.")
         except Exception as e:
-            logger.error(f"❌ Error guardando en Google Sheets: {e}")
+            logger.error("❌ Error registrando la fila en el outbox: %s", e)
+            try:
+                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg_guardando.message_id)
+            except Exception:
+                pass
+            await salida.enviar(context.bot, chat_id, "⚠️ No se pudo guardar el registro. Intenta nuevamente.")
+            await mostrar_resumen_final(update, context)
+            return "RESUMEN_FINAL"
 
         # 🧹 Eliminar mensaje de “Guardando...”
         try:
@@ -1925,19 +3875,12 @@ async def guardar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
             resumen_final += f"📸 *Foto Puerto:* ✅\n"
     
         # 📲 Enviar al técnico
-        msg_final = await context.bot.send_message(chat_id, resumen_final, parse_mode="Markdown")
+        msg_final = await salida.enviar(context.bot, chat_id, resumen_final, parse_mode="Markdown")
         registro["ULTIMO_MENSAJE_RESUMEN"] = msg_final.message_id  # opcional, por si se usa luego
 
-        # 🚨 AQUÍ ESTÁ EL PROBLEMA
-        gs_append_row(fila)
-        logger.info("✅ Registro guardado correctamente en Google Sheets.")
         
-        # 📢 Enviar al grupo de supervisión (con foto)
-        for grupo_id in GRUPO_SUPERVISION_ID:
-            try:
-                await context.bot.send_message(chat_id=grupo_id, text=resumen_final, parse_mode="Markdown")
-            except Exception as e:
-                logger.error(f"❌ Error enviando al grupo {grupo_id}: {e}")
+        # 📢 Enviar a los grupos de supervisión (en segundo plano, con rate limit)
+        difusor.difundir(context.bot, GRUPO_SUPERVISION_ID, resumen_final, parse_mode="Markdown")
 
         # ==========================================
         # 🧹 LIMPIEZA DE MEMORIA TRAS REGISTRO EXITOSO
@@ -1958,14 +3901,15 @@ async def guardar_registro(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             logger.info("🧠 Memoria liberada tras registro exitoso en Render.")
         except Exception as e:
-            logger.warning(f"⚠️ Error al limpiar memoria tras registro: {e}")
+            logger.warning("⚠️ Error al limpiar memoria tras registro: %s", e)
 
         # 🚀 Finalizar conversación
         return ConversationHandler.END
 
     except Exception as e:
-        logger.error(f"❌ Error general en guardar_registro: {e}")
-        await context.bot.send_message(
+        logger.error("❌ Error general en guardar_registro: %s", e)
+        await salida.enviar(
+            context.bot,
             update.effective_chat.id,
             "⚠️ Ocurrió un error al guardar. Contacta a soporte."
         )
@@ -1977,8 +3921,8 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat_id in GRUPO_SUPERVISION_ID:
         return ConversationHandler.END
 
-    context.user_data.pop("registro", None)
-    await update.message.reply_text("❌ Registro cancelado.", reply_markup=ReplyKeyboardRemove())
+    descartar_subidas_pendientes(context.user_data.pop("registro", None))
+    await salida.enviar(context.bot, chat_id, "❌ Registro cancelado.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
@@ -1986,14 +3930,9 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def limpiar_mensaje_anterior(context, chat_id, registro, clave="ULTIMO_MENSAJE_MENU"):
     """
     Elimina el último mensaje auxiliar (como menús o instrucciones repetidas)
-    guardado en registro[clave].
+    guardado en registro[clave]. El borrado se agrupa en el planificador de salida.
     """
-    old_id = registro.pop(clave, None)
-    if old_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=old_id)
-        except Exception:
-            pass
+    salida.borrar(context.bot, chat_id, registro.pop(clave, None))
 
 
 # ============================
@@ -2010,11 +3949,11 @@ async def safe_polling(app):
             await app.run_polling(allowed_updates=Update.ALL_TYPES)
         except NetworkError as e:
             espera = min(60, 15 * intento)
-            logger.warning(f"🌐 Error de red: {e}. Reintentando en {espera}s...")
+            logger.warning("🌐 Error de red: %s. Reintentando en %ss...", e, espera)
             await asyncio.sleep(espera)
             intento += 1
         except Exception as e:
-            logger.error(f"💥 Error inesperado en safe_polling: {e}")
+            logger.error("💥 Error inesperado en safe_polling: %s", e)
             await asyncio.sleep(10)
 
 
@@ -2022,36 +3961,626 @@ def escape_markdown(text: str) -> str:
     """Evita errores de formato en MarkdownV2."""
     return re.sub(r'([_\*\[\]\(\)~`>\#\+\-=|{}\.!])', r'\\\1', str(text))
 
+# ============================
+# 💽 PERSISTENCIA DE CONVERSACIONES (SQLITE / WAL)
+# ============================
+PERSISTENCIA_PATH = os.path.join(DATA_DIR, "conversaciones.sqlite3")
+PERSISTENCIA_INTERVALO = float(os.getenv("PERSISTENCIA_INTERVALO", "10"))  # segundos entre volcados
+
+
+class PersistenciaSQLite(BasePersistence):
+    """
+    Guarda user_data y el estado del ConversationHandler en SQLite (modo WAL).
+    La aplicación solo entrega los usuarios/conversaciones modificados en cada intervalo;
+    aquí se acumulan y se escriben juntos en una única transacción fuera del event loop.
+    """
+
+    def __init__(self, ruta: str, update_interval: float = PERSISTENCIA_INTERVALO):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ruta = ruta
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, datos BLOB)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversaciones (nombre TEXT, clave TEXT, estado TEXT, PRIMARY KEY (nombre, clave))"
+        )
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        self._usuarios_sucios: dict[int, bytes | None] = {}          # None → borrar
+        self._conversaciones_sucias: dict[tuple, str | None] = {}    # (nombre, clave) → estado
+        self._escritura: asyncio.Task | None = None
+
+    # ---------- lectura (solo al iniciar) ----------
+    async def get_user_data(self):
+        with self._db_lock:
+            filas = self._db.execute("SELECT user_id, datos FROM user_data").fetchall()
+        datos = {}
+        for user_id, blob in filas:
+            try:
+                datos[user_id] = pickle.loads(blob)
+            except Exception as e:
+                logger.warning("⚠️ user_data ilegible para %s: %s", user_id, e)
+        logger.info("💽 %s usuario(s) restaurado(s) desde la persistencia.", len(datos))
+        return datos
+
+    async def get_conversations(self, name: str):
+        with self._db_lock:
+            filas = self._db.execute("SELECT clave, estado FROM conversaciones WHERE nombre = ?", (name,)).fetchall()
+        return {tuple(json.loads(clave)): json.loads(estado) for clave, estado in filas}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ---------- escritura (agrupada) ----------
+    def _programar_escritura(self):
+        if self._escritura is None or self._escritura.done():
+            self._escritura = asyncio.create_task(self._escribir_pendientes())
+
+    async def _escribir_pendientes(self):
+        await asyncio.sleep(0)  # deja que el resto del lote de la aplicación se acumule
+        # Lo que llegue mientras el hilo escribe queda para la vuelta siguiente
+        while self._usuarios_sucios or self._conversaciones_sucias:
+            await asyncio.to_thread(self._volcar, *self._tomar_sucios())
+
+    def _tomar_sucios(self) -> tuple[dict, dict]:
+        """Intercambia los pendientes por dicts vacíos (en el event loop, que es quien los modifica)."""
+        usuarios, self._usuarios_sucios = self._usuarios_sucios, {}
+        conversaciones, self._conversaciones_sucias = self._conversaciones_sucias, {}
+        return usuarios, conversaciones
+
+    def _volcar(self, usuarios: dict, conversaciones: dict):
+        if not usuarios and not conversaciones:
+            return
+        with self._db_lock, self._db:
+            for user_id, blob in usuarios.items():
+                if blob is None:
+                    self._db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+                else:
+                    self._db.execute("INSERT OR REPLACE INTO user_data (user_id, datos) VALUES (?, ?)", (user_id, blob))
+            for (nombre, clave), estado in conversaciones.items():
+                if estado is None:
+                    self._db.execute("DELETE FROM conversaciones WHERE nombre = ? AND clave = ?", (nombre, clave))
+                else:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO conversaciones (nombre, clave, estado) VALUES (?, ?, ?)",
+                        (nombre, clave, estado)
+                    )
+        logger.debug("💽 Persistencia: %s usuario(s), %s conversación(es).", len(usuarios), len(conversaciones))
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        self._usuarios_sucios[user_id] = pickle.dumps(data)
+        self._programar_escritura()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._usuarios_sucios[user_id] = None
+        self._programar_escritura()
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        estado = None if new_state is None else json.dumps(new_state)
+        self._conversaciones_sucias[(name, json.dumps(list(key)))] = estado
+        self._programar_escritura()
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._escritura is not None:
+            await asyncio.gather(self._escritura, return_exceptions=True)
+        self._volcar(*self._tomar_sucios())
+        logger.info("💽 Persistencia volcada a disco.")
+
+
+# ============================
+# 🚦 PROCESAMIENTO CONCURRENTE DE UPDATES (ORDEN ESTRICTO POR USUARIO)
+# ============================
+# Updates de técnicos distintos se procesan en paralelo (hasta UPDATES_CONCURRENTES);
+# los de un mismo usuario pasan de a uno y en orden de llegada, así el
+# ConversationHandler y los flags del registro (EN_CORRECCION, VOLVER_A_RESUMEN,
+# CORRECCION_ORIGEN) nunca ven dos updates del mismo técnico a la vez.
+UPDATES_CONCURRENTES = int(os.getenv("UPDATES_CONCURRENTES", "16"))
+UPDATES_ALERTA_COLA = int(os.getenv("UPDATES_ALERTA_COLA", "50"))   # aviso si la espera supera esto
+
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    """
+    Serializa por usuario y limita la concurrencia global.
+    El semáforo propio se toma *después* del lock del usuario: updates en espera de su
+    turno no ocupan cupos globales (el de la clase base solo acota tareas en memoria).
+    """
+
+    def __init__(self, concurrencia: int):
+        super().__init__(max_concurrent_updates=max(2, concurrencia * 64))
+        self.concurrencia = concurrencia
+        self._limite: asyncio.Semaphore | None = None
+        self._locks: dict[int, list] = {}   # clave → [asyncio.Lock, usuarios esperando/en curso]
+        self.en_proceso = 0
+        self.en_espera = 0
+        self.max_espera = 0
+        self.procesados = 0
+
+    @staticmethod
+    def _clave(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        arranque.marcar("primer_update")
+        clave = self._clave(update)
+        entrada = None
+        if clave is not None:
+            entrada = self._locks.setdefault(clave, [asyncio.Lock(), 0])
+            entrada[1] += 1
+
+        self.en_espera += 1
+        self.max_espera = max(self.max_espera, self.en_espera)
+        if self.en_espera == UPDATES_ALERTA_COLA:
+            logger.warning("🚦 %s updates en espera de procesamiento.", self.en_espera)
+        esperando = True
+        try:
+            if entrada is not None:
+                await entrada[0].acquire()
+            try:
+                async with self._limite:
+                    self.en_espera -= 1
+                    esperando = False
+                    self.en_proceso += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.en_proceso -= 1
+                        self.procesados += 1
+            finally:
+                if entrada is not None:
+                    entrada[0].release()
+        finally:
+            if esperando:  # cancelado antes de su turno
+                self.en_espera -= 1
+                coroutine.close()
+            if entrada is not None:
+                entrada[1] -= 1
+                if entrada[1] == 0:
+                    self._locks.pop(clave, None)
+
+    async def initialize(self) -> None:
+        self._limite = asyncio.Semaphore(self.concurrencia)
+
+    async def shutdown(self) -> None:
+        pass
+
+    def estadisticas(self) -> dict:
+        return {
+            "en_proceso": self.en_proceso,
+            "en_espera": self.en_espera,
+            "max_espera": self.max_espera,
+            "procesados": self.procesados,
+            "usuarios_activos": len(self._locks),
+        }
+
+
+# ==============================
+# 🔎 CARGAS INICIALES
+# ==============================
+# Con ARRANQUE_RAPIDO (por defecto) el bot empieza a recibir updates sin esperar a Google:
+# la carpeta IMAGENES, CAJAS_NODOS, la hoja principal y los límites administrativos se
+# cargan en paralelo en segundo plano. Mientras tanto CAJAS_NODOS responde desde el snapshot
+# local y, si aún no hay ninguno, la búsqueda de código espera a la primera carga.
+ARRANQUE_RAPIDO = os.getenv("ARRANQUE_RAPIDO", "1") == "1"
+CAJAS_ESPERA_ARRANQUE = float(os.getenv("CAJAS_ESPERA_ARRANQUE", "15"))  # segundos máximos
+
+_cargas_en_curso: dict[str, asyncio.Task] = {}
+
+
+def _abrir_hoja_principal():
+    clientes_google.hoja()
+
+
+def lanzar_cargas_iniciales():
+    """Lanza las cargas de arranque en paralelo, cada una en su hilo; devuelve la corrutina que las espera."""
+    cargas = {
+        "carpeta_imagenes": verificar_carpeta_imagenes_inicial,
+        "cajas_nodos": cargar_cajas_nodos,
+        "hoja_principal": _abrir_hoja_principal,
+        "limites_geo": obtener_geocodificador_local,
+        "pool_fotos": calentar_pool_procesos,
+    }
+    for nombre, funcion in cargas.items():
+        _cargas_en_curso[nombre] = asyncio.ensure_future(asyncio.to_thread(funcion))
+    return _esperar_cargas_iniciales()
+
+
+async def _esperar_cargas_iniciales():
+    """Un fallo no frena a las demás cargas; al terminar se registra en el reporte de arranque."""
+    try:
+        resultados = await asyncio.gather(*_cargas_en_curso.values(), return_exceptions=True)
+        for nombre, resultado in zip(list(_cargas_en_curso), resultados):
+            if isinstance(resultado, Exception):
+                logger.error("❌ Carga inicial '%s' falló: %s", nombre, resultado)
+    finally:
+        _cargas_en_curso.clear()
+    arranque.marcar("calentamiento")
+    logger.info("🔥 Cargas iniciales completas. ⏱️ %s", arranque.reporte())
+
+
+async def esperar_cajas_nodos():
+    """Si no hay snapshot de CAJAS_NODOS y su primera carga sigue en curso, la espera (con tope)."""
+    carga = _cargas_en_curso.get("cajas_nodos")
+    if len(servicio_cajas) or carga is None or carga.done():
+        return
+    try:
+        await asyncio.wait_for(asyncio.shield(carga), timeout=CAJAS_ESPERA_ARRANQUE)
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ CAJAS_NODOS aún cargando; se continúa sin índice.")
+
+
+# ================== MÉTRICAS DE HANDLERS ==================
+def _envolver_callback(callback, estado: str):
+    """Mide el callback y fija el contexto de logs (user_id, ID_REGISTRO, paso) mientras corre."""
+    nombre = getattr(callback, "__name__", "handler")
+
+    @functools.wraps(callback)
+    async def envoltura(update, context):
+        registro = (context.user_data or {}).get("registro") or {}
+        token = contexto_log.set({
+            "user_id": update.effective_user.id if update.effective_user else None,
+            "id_registro": registro.get("ID_REGISTRO"),
+            "paso": registro.get("PASO_ACTUAL") or estado,
+        })
+        try:
+            with metricas.medir("handler", estado=estado, handler=nombre):
+                return await callback(update, context)
+        finally:
+            contexto_log.reset(token)
+    return envoltura
+
+
+def _instrumentar_conversacion(conv_handler: ConversationHandler):
+    """Envuelve cada callback del ConversationHandler para medirlo por estado."""
+    grupos = {"inicio": conv_handler.entry_points, "fallback": conv_handler.fallbacks, **conv_handler.states}
+    for estado, handlers in grupos.items():
+        for handler in handlers:
+            handler.callback = _envolver_callback(handler.callback, estado)
+
+
+async def comando_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats → latencias, errores y colas del proceso (solo USUARIOS_DEV)."""
+    if update.effective_user.id not in USUARIOS_DEV:
+        return
+    texto = f"📈 Métricas (desde el arranque)\n\n{metricas.resumen()}"
+    for i in range(0, len(texto), TELEGRAM_MAX_TEXTO):
+        await update.message.reply_text(texto[i:i + TELEGRAM_MAX_TEXTO])
+
+
+# ==============================
+# 📤 EXPORTACIÓN MASIVA (/exportar)
+# ==============================
+# Lee la hoja principal por páginas de EXPORTAR_PAGINA filas y escribe cada fila al vuelo
+# (XlsxWriter en modo constant_memory o csv.writer): en memoria solo vive una página.
+#   /exportar desde=2024-01-01 hasta=2024-01-31 partner="MI PARTNER" nodo=N01 distrito=SURCO csv
+#   (el formato va suelto, xlsx por defecto, o como formato=csv)
+EXPORTAR_PAGINA = int(os.getenv("EXPORTAR_PAGINA", "5000"))
+EXPORTAR_USUARIOS = {int(x) for x in os.getenv("EXPORTAR_USUARIOS", "").split(",") if x.strip()}
+EXPORTAR_MAX_BYTES = 50 * 1024 * 1024   # límite de archivos enviados por la Bot API
+EXPORTAR_FILTROS = {"partner": "PARTNER", "nodo": "NODO", "distrito": "DISTRITO"}
+EXPORTAR_COLUMNAS_OCULTAS = {"ID_REGISTRO"}
+
+_exportacion_lock = asyncio.Lock()  # una exportación a la vez por proceso (cuota de Sheets y disco)
+
+
+_EPOCA_SHEETS = date(1899, 12, 30)  # día 0 de los números de serie de fecha de Sheets
+
+
+def _fecha_celda(valor):
+    """
+    FECHA sin formato (UNFORMATTED_VALUE) → date. Con USER_ENTERED Sheets la guarda como número
+    de serie y solo su formato visible depende del locale; si quedó como texto, se acepta ISO.
+    None si no se entiende.
+    """
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return _EPOCA_SHEETS + timedelta(days=int(valor))
+    try:
+        return datetime.strptime(str(valor).strip(), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def parsear_filtros_exportar(args: list) -> tuple[dict, str]:
+    """Argumentos clave=valor de /exportar → (filtros, formato). ValueError si algo no es válido."""
+    filtros, formato = {}, "xlsx"
+    for token in shlex.split(" ".join(args)):
+        if token.lower() in ("xlsx", "csv"):
+            formato = token.lower()
+            continue
+        clave, sep, valor = token.partition("=")
+        clave = clave.lower()
+        if not sep or not valor:
+            raise ValueError(f"Argumento sin valor: {token}")
+        if clave in ("desde", "hasta"):
+            fecha = _fecha_celda(valor.strip())
+            if fecha is None:
+                raise ValueError(f"Fecha inválida en {clave}: {valor} (usa AAAA-MM-DD)")
+            filtros[clave] = fecha
+        elif clave in EXPORTAR_FILTROS:
+            filtros[clave] = valor.strip().upper()
+        elif clave == "formato" and valor.lower() in ("xlsx", "csv"):
+            formato = valor.lower()
+        else:
+            raise ValueError(f"Argumento no reconocido: {token}")
+    return filtros, formato
+
+
+def _filtro_filas(encabezado: list, filtros: dict):
+    """
+    Predicado sobre una fila de la hoja y su FECHA sin formato (o None si no hay filtro de fechas);
+    partner busca por contenido, nodo y distrito por igualdad.
+    """
+    por_fecha = "desde" in filtros or "hasta" in filtros
+    indices = {clave: encabezado.index(col) for clave, col in EXPORTAR_FILTROS.items() if clave in filtros and col in encabezado}
+
+    def celda(fila, i):
+        return str(fila[i]).strip().upper() if i < len(fila) else ""
+
+    def coincide(fila, fecha_cruda=None) -> bool:
+        if por_fecha:
+            fecha = _fecha_celda(fecha_cruda)
+            if fecha is None or fecha < filtros.get("desde", fecha) or fecha > filtros.get("hasta", fecha):
+                return False
+        for clave, i in indices.items():
+            valor = celda(fila, i)
+            if (filtros[clave] not in valor) if clave == "partner" else (valor != filtros[clave]):
+                return False
+        return True
+    return coincide
+
+
+def _columna_a1(columna: int) -> str:
+    return gspread.utils.rowcol_to_a1(1, columna).rstrip("1")
+
+
+def paginas_hoja(sheet, columnas: int, tam: int, col_fecha: int | None = None):
+    """
+    Genera (filas, fechas) por rangos de `tam` filas de datos (desde la 2) hasta el final de la grilla.
+    Sheets recorta las filas vacías del final de cada rango, así que una página corta o vacía no
+    indica el final de la hoja. Con `col_fecha` (1-based) también trae esa columna sin formato.
+    """
+    total = sheet.spreadsheet.get_worksheet_by_id(sheet.id).row_count  # grilla actual, no la cacheada
+    ultima_col = _columna_a1(columnas)
+    for inicio in range(2, total + 1, tam):
+        fin = min(inicio + tam - 1, total)
+        filas = sheet.get(f"A{inicio}:{ultima_col}{fin}")
+        fechas = []
+        if col_fecha is not None and filas:
+            letra = _columna_a1(col_fecha)
+            fechas = [f[0] if f else None for f in sheet.get(
+                f"{letra}{inicio}:{letra}{fin}", value_render_option=gspread.utils.ValueRenderOption.unformatted)]
+        yield filas, fechas
+
+
+class _EscritorXlsx:
+    def __init__(self, ruta):
+        self._libro = xlsxwriter.Workbook(ruta, {
+            "constant_memory": True,     # cada fila se escribe a disco al pasar a la siguiente
+            "strings_to_numbers": False,
+            "strings_to_formulas": False,  # texto de usuarios que empiece con "=" no se evalúa
+            "strings_to_urls": False,      # enlaces de fotos como texto (Excel admite ~65k URLs por hoja)
+        })
+        self._hoja = self._libro.add_worksheet("REGISTROS")
+        self._negrita = self._libro.add_format({"bold": True})
+        self._fila = 0
+
+    def escribir(self, fila, encabezado=False):
+        self._hoja.write_row(self._fila, 0, fila, self._negrita if encabezado else None)
+        self._fila += 1
+
+    def cerrar(self):
+        self._libro.close()
+
+
+class _EscritorCsv:
+    def __init__(self, ruta):
+        self._archivo = open(ruta, "w", newline="", encoding="utf-8-sig")  # BOM: Excel abre bien las tildes
+        self._csv = csv.writer(self._archivo)
+
+    def escribir(self, fila, encabezado=False):
+        self._csv.writerow(fila)
+
+    def cerrar(self):
+        self._archivo.close()
+
+
+def exportar_registros(filtros: dict, formato: str, ruta: str, tam_pagina: int = EXPORTAR_PAGINA) -> int:
+    """Escribe en `ruta` las filas que pasan los filtros (bloqueante: llamar desde un hilo). Devuelve cuántas."""
+    with metricas.medir("exportar", formato=formato):
+        return _exportar_registros(filtros, formato, ruta, tam_pagina)
+
+
+def _exportar_registros(filtros: dict, formato: str, ruta: str, tam_pagina: int) -> int:
+    sheet = clientes_google.hoja()
+    encabezado = sheet.row_values(1) or ENCABEZADOS
+    visibles = [i for i, col in enumerate(encabezado) if col not in EXPORTAR_COLUMNAS_OCULTAS]
+    coincide = _filtro_filas(encabezado, filtros)
+    # FECHA se muestra en el formato del locale de la hoja: para filtrar se lee como número de serie
+    col_fecha = None
+    if ("desde" in filtros or "hasta" in filtros) and "FECHA" in encabezado:
+        col_fecha = encabezado.index("FECHA") + 1
+
+    escritor = _EscritorXlsx(ruta) if formato == "xlsx" else _EscritorCsv(ruta)
+    escritas = 0
+    try:
+        escritor.escribir([encabezado[i] for i in visibles], encabezado=True)
+        for pagina, fechas in paginas_hoja(sheet, len(encabezado), tam_pagina, col_fecha):
+            for n, fila in enumerate(pagina):
+                if fila and coincide(fila, fechas[n] if n < len(fechas) else None):
+                    escritor.escribir([fila[i] if i < len(fila) else "" for i in visibles])
+                    escritas += 1
+    finally:
+        escritor.cerrar()
+    logger.info("📤 Exportación %s: %s fila(s) con filtros %s.", formato, escritas, filtros or 'ninguno')
+    return escritas
+
+
+def puede_exportar(update: Update) -> bool:
+    return (update.effective_user.id in USUARIOS_DEV or update.effective_user.id in EXPORTAR_USUARIOS
+            or update.effective_chat.id in GRUPO_SUPERVISION_ID)
+
+
+async def comando_exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/exportar [desde=] [hasta=] [partner=] [nodo=] [distrito=] [xlsx|csv] → archivo con los registros."""
+    if not puede_exportar(update):
+        return
+    try:
+        filtros, formato = parsear_filtros_exportar(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"⚠️ {e}\n\nUso: /exportar desde=AAAA-MM-DD hasta=AAAA-MM-DD partner=... nodo=... distrito=... xlsx|csv"
+        )
+        return
+    if _exportacion_lock.locked():
+        await update.message.reply_text("⏳ Ya hay una exportación en curso. Intenta en unos minutos.")
+        return
+
+    async with _exportacion_lock:
+        await update.message.reply_text("⏳ Exportando registros desde Google Sheets...")
+        fd, ruta = tempfile.mkstemp(prefix="exportar-", suffix=f".{formato}", dir=DATA_DIR)
+        os.close(fd)
+        try:
+            filas = await asyncio.to_thread(exportar_registros, filtros, formato, ruta)
+            if not filas:
+                await update.message.reply_text("📭 No hay registros con esos filtros.")
+                return
+            if os.path.getsize(ruta) > EXPORTAR_MAX_BYTES:
+                await update.message.reply_text(
+                    f"⚠️ El archivo ({filas} registros) supera los 50 MB que permite Telegram. Acota las fechas o los filtros."
+                )
+                return
+            fecha, _ = get_fecha_hora()
+            with open(ruta, "rb") as archivo:
+                await context.bot.send_document(
+                    chat_id=update.effective_chat.id,
+                    document=archivo,
+                    filename=f"registros_{fecha}.{formato}",
+                    caption=f"📊 {filas} registro(s) exportado(s).",
+                    write_timeout=120,
+                )
+        except Exception as e:
+            logger.error("❌ Error exportando registros: %s", e)
+            await update.message.reply_text("❌ No se pudo generar la exportación. Intenta nuevamente.")
+        finally:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+
+# ================== CICLO DE VIDA ==================
+_tareas_fondo: set = set()
+
+
+def lanzar_tarea_fondo(coro):
+    """Tarea de larga duración (bucles de refresco); se cancela en al_apagar."""
+    tarea = asyncio.create_task(coro)
+    _tareas_fondo.add(tarea)
+    tarea.add_done_callback(_tareas_fondo.discard)
+    return tarea
+
+
+async def al_iniciar(app):
+    """post_init: tareas de fondo que viven con la aplicación."""
+    await gs_iniciar_cola(app)           # ⏳ worker de escritura diferida a Sheets
+    cargas = lanzar_cargas_iniciales()
+    if ARRANQUE_RAPIDO:
+        lanzar_tarea_fondo(cargas)       # 🔥 Drive/Sheets se calientan mientras ya se atienden updates
+    else:
+        await cargas
+    lanzar_tarea_fondo(servicio_cajas.bucle_refresco())  # 🗃️ refresco periódico de CAJAS_NODOS
+    arranque.marcar("bot_listo")
+    logger.info("⏱️ Arranque: %s", arranque.reporte())
+
+
+async def al_detener(app):
+    """post_stop: el bot sigue inicializado; se terminan los envíos pendientes."""
+    await difusor.drenar()
+
+
+async def al_apagar(app):
+    """post_shutdown: vacía colas y cierra sesiones compartidas."""
+    for tarea in list(_tareas_fondo):
+        tarea.cancel()
+    await asyncio.gather(*_tareas_fondo, return_exceptions=True)
+    await gs_detener_cola(app)           # 💾 envía lo pendiente antes de apagar
+    await cerrar_sesion_geocodificacion()
+
+
 # ================== MAIN ==================
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def crear_aplicacion(webhook: bool = False, request=None):
+    """
+    Construye la Application con todos los handlers (polling o webhook sin Updater).
+    `request` reemplaza el cliente de la Bot API (p. ej. un Telegram falso en benchmarks).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(request or RequestInstrumentado(connection_pool_size=256))  # 📈 latencia por método de la Bot API
+        .persistence(PersistenciaSQLite(PERSISTENCIA_PATH))  # 💽 registros en curso sobreviven reinicios
+        .concurrent_updates(ProcesadorPorUsuario(UPDATES_CONCURRENTES))  # 🚦 paralelo entre usuarios, en orden por usuario
+        .post_init(al_iniciar)
+        .post_stop(al_detener)
+        .post_shutdown(al_apagar)
+    )
+    if webhook:
+        builder = builder.updater(None)  # 🌐 los updates llegan por el servidor ASGI
+    app = builder.build()
+    arranque.marcar("aplicacion")
 
     # ==========================
     # 🔁 CONVERSATION HANDLER
     # ==========================
+    estados_pasos = motor_pasos.estados_conversacion()
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("start", start),
             CommandHandler("registro", comando_registro),
         ],
         states={
-            "TICKET": [MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "TICKET"))],
-            "DNI": [MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "DNI"))],
-            "NOMBRE_CLIENTE": [MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "NOMBRE_CLIENTE"))],
-            "PARTNER": [MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "PARTNER"))],
-            
-            # 👇 NUEVOS MENÚS (TIPO_CUADRILLA Y PUERTO_REPORTADO)
+            # 📝 Pasos de PASOS que aceptan texto / ubicación / foto (generados por el motor de pasos)
+            **estados_pasos,
+
+            # 👇 Botoneras (TIPO_CUADRILLA también acepta texto → vuelve a mostrar el menú)
             "TIPO_CUADRILLA": [
                 CallbackQueryHandler(manejar_seleccion_cuadrilla, pattern=r"^SET_TC_.*$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "TIPO_CUADRILLA")),
+                *estados_pasos["TIPO_CUADRILLA"],
             ],
-            "CUADRILLA": [MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "CUADRILLA"))],
-            "CODIGO_CAJA": [MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "CODIGO_CAJA"))],
-            "UBICACION_CTO": [MessageHandler(filters.LOCATION, lambda u, c: manejar_paso(u, c, "UBICACION_CTO"))],
-            "FOTO_CAJA": [MessageHandler(filters.PHOTO | filters.Document.IMAGE, lambda u, c: manejar_paso(u, c, "FOTO_CAJA"))],
-            "FOTO_CAJA_ABIERTA": [MessageHandler(filters.PHOTO | filters.Document.IMAGE, lambda u, c: manejar_paso(u, c, "FOTO_CAJA_ABIERTA"))],
-            "FOTO_MEDICION": [MessageHandler(filters.PHOTO | filters.Document.IMAGE, lambda u, c: manejar_paso(u, c, "FOTO_MEDICION"))],
-            "OBS": [MessageHandler(filters.TEXT & ~filters.COMMAND, lambda u, c: manejar_paso(u, c, "OBS"))],
             "CANTIDAD_PUERTOS": [
                 CallbackQueryHandler(manejar_seleccion_cantidad_puertos, pattern=r"^SET_CANT_PTO_.*$"),
             ],
@@ -2059,7 +4588,6 @@ def main():
             "PUERTO_REPORTADO": [
                 CallbackQueryHandler(manejar_seleccion_puerto, pattern=r"^SET_PTO_.*$"),
             ],
-            "FOTO_PUERTO": [MessageHandler(filters.PHOTO | filters.Document.IMAGE, lambda u, c: manejar_paso(u, c, "FOTO_PUERTO"))],
 
             "OBS_TIPO": [
                 CallbackQueryHandler(manejar_tipo_obs_callback, pattern=r"^OBS_TIPO_.*$"),
@@ -2071,13 +4599,14 @@ def main():
             ],
             "CONFIRMAR": [
                 CallbackQueryHandler(manejar_confirmar_callback, pattern=r"^CONFIRMAR_.*$"),
+                CallbackQueryHandler(manejar_sugerencia_caja_callback, pattern=r"^USAR_CAJA_.*$"),
                 CallbackQueryHandler(manejar_corregir_callback, pattern=r"^CORREGIR_.*$"),
                 CallbackQueryHandler(manejar_ir_resumen_final_callback, pattern=r"^IR_RESUMEN_FINAL$"),
                 CallbackQueryHandler(manejar_edicion_desde_resumen_callback, pattern=r"^EDITAR_.*$"),
             ],
             "CORREGIR": [
                 CallbackQueryHandler(manejar_edicion_desde_resumen_callback, pattern=r"^EDITAR_.*$"),
-                MessageHandler(filters.ALL, lambda u, c: manejar_paso(u, c, c.user_data.get("registro", {}).get("PASO_ACTUAL", ""))),
+                MessageHandler(filters.ALL, manejar_paso_actual),
             ],
             "RESUMEN_FINAL": [
                 CallbackQueryHandler(resumen_final_callback, pattern=r"^FINAL_.*$"),
@@ -2085,12 +4614,31 @@ def main():
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="incidencias",
+        persistent=True,
     )
 
+    _instrumentar_conversacion(conv_handler)
+
     # ==========================
     # 🔁 JOBS Y HANDLERS EXTRA
     # ==========================
     app.add_handler(conv_handler)
+    app.add_handler(CommandHandler("recargar_cajas", comando_recargar_cajas))
+    app.add_handler(CommandHandler("stats", comando_stats))
+    app.add_handler(CommandHandler("exportar", comando_exportar))
+
+    # 📈 Gauges de colas y cachés, leídos al exportar
+    metricas.registrar_fuente("procesador", app.update_processor.estadisticas)
+    metricas.registrar_fuente("salida", salida.estadisticas)
+    metricas.registrar_fuente("difusion", difusor.estadisticas)
+    metricas.registrar_fuente("geocache", cache_geo.estadisticas)
+    metricas.registrar_fuente("sheets", lambda: {"cola": _gs_cola.qsize() if _gs_cola else 0})
+    return app
+
+
+def main():
+    app = crear_aplicacion()
 
     # ==========================
     # 🚀 INICIO DEL BOT
@@ -2105,12 +4653,244 @@ def main():
     except KeyboardInterrupt:
         logger.warning("🛑 Bot detenido manualmente.")
     except Exception as e:
-        logger.error(f"❌ Error crítico en main(): {e}")
+        logger.error("❌ Error crítico en main(): %s", e)
 
 # ==============================
-# 🔎 CARGAS INICIALES
+# 🌐 MODO WEBHOOK (ASGI, VARIOS WORKERS)
 # ==============================
+#   gunicorn main:asgi_app -k uvicorn.workers.UvicornWorker -w $WEBHOOK_SHARDS --bind 0.0.0.0:$PORT
+# Cada worker reclama un índice de shard (lock en DATA_DIR) y es dueño de los usuarios con
+# user_id % WEBHOOK_SHARDS == índice: cada usuario lo atiende un único proceso, en orden.
+# Un update que llega al worker equivocado se reenvía al dueño por un socket Unix local.
+# El estado de conversación y user_data se carga de SQLite solo al iniciar cada worker: nadie
+# más que el dueño puede atender a sus usuarios. Si el dueño no responde se devuelve 503 y
+# Telegram reintenta la entrega; el dueño descarta update_id ya vistos (reenvíos duplicados).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")            # URL pública base (https://...)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")      # cabecera X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SHARDS = int(os.getenv("WEBHOOK_SHARDS", os.getenv("WEB_CONCURRENCY", "1")))
+# GET /metrics (formato Prometheus) responde con las métricas del worker que atiende la petición
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN", "")      # si se define, exige "Authorization: Bearer <token>"
+WEBHOOK_DEDUP = int(os.getenv("WEBHOOK_DEDUP", "10000"))  # update_id recientes recordados por worker
+
+
+class EnrutadorUsuarios:
+    """Asigna a este proceso un shard fijo y reenvía updates ajenos al worker dueño."""
+
+    def __init__(self, shards: int, directorio: str):
+        self.shards = max(1, shards)
+        self.directorio = directorio
+        self.indice: int | None = None
+        self.reenviados = 0
+        self._lock_fd = None
+        self._servidor = None
+        self._conexiones: dict[int, tuple] = {}
+        self._conexion_locks: dict[int, asyncio.Lock] = {}
+
+    def reclamar(self) -> int:
+        """Toma el primer índice libre (flock no bloqueante); se libera si el proceso muere."""
+        import fcntl  # solo Unix (el modo webhook corre en Linux)
+        for i in range(self.shards):
+            fd = os.open(os.path.join(self.directorio, f"shard-{i}.lock"), os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            self.indice, self._lock_fd = i, fd
+            return i
+        raise RuntimeError(f"Hay más workers que WEBHOOK_SHARDS ({self.shards}).")
+
+    def duenio(self, user_id: int | None) -> int:
+        return 0 if user_id is None else user_id % self.shards
+
+    def _socket(self, indice: int) -> str:
+        return os.path.join(self.directorio, f"shard-{indice}.sock")
+
+    async def escuchar(self, entregar):
+        """Recibe updates reenviados por otros workers (longitud de 4 bytes + JSON, acuse de 1 byte)."""
+        ruta = self._socket(self.indice)
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+        async def atender(reader, writer):
+            try:
+                while True:
+                    largo = int.from_bytes(await reader.readexactly(4), "big")
+                    await entregar(await reader.readexactly(largo))
+                    writer.write(b"\x01")
+                    await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        self._servidor = await asyncio.start_unix_server(atender, path=ruta)
+
+    async def reenviar(self, indice: int, cuerpo: bytes) -> bool:
+        """Envía el update al worker dueño; False si no está disponible."""
+        async with self._conexion_locks.setdefault(indice, asyncio.Lock()):
+            for _ in range(2):  # reconecta una vez si la conexión guardada se cayó
+                conexion = self._conexiones.get(indice)
+                try:
+                    if conexion is None:
+                        conexion = await asyncio.open_unix_connection(self._socket(indice))
+                        self._conexiones[indice] = conexion
+                    conexion[1].write(len(cuerpo).to_bytes(4, "big") + cuerpo)
+                    await conexion[1].drain()
+                    await asyncio.wait_for(conexion[0].readexactly(1), timeout=5)
+                    self.reenviados += 1
+                    return True
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    self._conexiones.pop(indice, None)
+        return False
+
+    async def cerrar(self):
+        for _, writer in self._conexiones.values():
+            writer.close()
+        self._conexiones.clear()
+        if self._servidor is not None:
+            self._servidor.close()
+            await self._servidor.wait_closed()
+            try:
+                os.remove(self._socket(self.indice))
+            except OSError:
+                pass
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+class AppWebhook:
+    """Aplicación ASGI: recibe el webhook de Telegram y alimenta la Application de este worker."""
+
+    def __init__(self):
+        self.app = None
+        self.enrutador = EnrutadorUsuarios(WEBHOOK_SHARDS, DATA_DIR)
+        self._vistos: OrderedDict[int, None] = OrderedDict()  # update_id ya encolados (LRU)
+        self.duplicados = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        if scope["method"] == "GET" and scope["path"] == "/salud":
+            return await self._responder(send, 200, b"ok")
+        if scope["method"] == "GET" and scope["path"] == "/metrics":
+            if METRICAS_TOKEN:
+                recibido = dict(scope.get("headers", [])).get(b"authorization", b"")
+                if recibido.decode() != f"Bearer {METRICAS_TOKEN}":
+                    return await self._responder(send, 403, b"")
+            return await self._responder(send, 200, metricas.prometheus().encode())
+        if scope["method"] != "POST" or scope["path"] != WEBHOOK_PATH:
+            return await self._responder(send, 404, b"")
+        if WEBHOOK_SECRET:
+            recibido = dict(scope.get("headers", [])).get(b"x-telegram-bot-api-secret-token", b"")
+            if recibido.decode() != WEBHOOK_SECRET:
+                return await self._responder(send, 403, b"")
+
+        cuerpo = b""
+        while True:
+            mensaje = await receive()
+            cuerpo += mensaje.get("body", b"")
+            if not mensaje.get("more_body"):
+                break
+        try:
+            atendido = await self._enrutar(cuerpo)
+        except Exception as e:
+            logger.error("❌ Update de webhook inválido: %s", e)
+            return await self._responder(send, 400, b"")
+        if not atendido:
+            return await self._responder(send, 503, b"")
+        await self._responder(send, 200, b"ok")
+
+    @staticmethod
+    async def _responder(send, estado: int, cuerpo: bytes):
+        await send({"type": "http.response.start", "status": estado,
+                    "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(cuerpo)).encode())]})
+        await send({"type": "http.response.body", "body": cuerpo})
+
+    async def _enrutar(self, cuerpo: bytes) -> bool:
+        """Encola el update si este worker es el dueño o lo reenvía; False si el dueño no está disponible."""
+        update = Update.de_json(json.loads(cuerpo), self.app.bot)
+        usuario = update.effective_user
+        duenio = self.enrutador.duenio(usuario.id if usuario else None)
+        if duenio == self.enrutador.indice:
+            await self._encolar(update)
+            return True
+        if await self.enrutador.reenviar(duenio, cuerpo):
+            return True
+        # Atenderlo aquí usaría un user_data/estado desactualizado y desordenaría al usuario:
+        # se rechaza para que Telegram lo reintente cuando el dueño vuelva.
+        logger.warning("⚠️ Worker del shard %s no disponible; se responde 503 para reintento.", duenio)
+        return False
+
+    async def _entregar(self, cuerpo: bytes):
+        await self._encolar(Update.de_json(json.loads(cuerpo), self.app.bot))
+
+    async def _encolar(self, update: Update):
+        """Encola una sola vez cada update_id (un reenvío cuyo acuse se perdió llega dos veces)."""
+        if update.update_id in self._vistos:
+            self.duplicados += 1
+            logger.info("♻️ Update %s duplicado; se descarta.", update.update_id)
+            return
+        self._vistos[update.update_id] = None
+        if len(self._vistos) > WEBHOOK_DEDUP:
+            self._vistos.popitem(last=False)
+        await self.app.update_queue.put(update)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje["type"] == "lifespan.startup":
+                try:
+                    await self._iniciar()
+                except Exception as e:
+                    logger.error("❌ No se pudo iniciar el worker webhook: %s", e)
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif mensaje["type"] == "lifespan.shutdown":
+                await self._detener()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _iniciar(self):
+        indice = self.enrutador.reclamar()
+        # 📒 un journal por shard, abierto recién ahora que se conoce el índice
+        abrir_outbox(os.path.join(DATA_DIR, f"outbox-{indice}.jsonl") if indice else OUTBOX_PATH)
+        self.app = crear_aplicacion(webhook=True)
+        await self.app.initialize()
+        await self.app.post_init(self.app)
+        await self.app.start()
+        await self.enrutador.escuchar(self._entregar)
+        metricas.registrar_fuente("webhook", lambda: {"reenviados": self.enrutador.reenviados,
+                                                      "duplicados": self.duplicados})
+
+        if indice == 0 and WEBHOOK_URL:
+            await self.app.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info("🌐 Webhook registrado en %s%s", WEBHOOK_URL.rstrip('/'), WEBHOOK_PATH)
+        logger.info("🤖 Worker webhook listo (shard %s/%s).", indice + 1, self.enrutador.shards)
+
+    async def _detener(self):
+        await self.enrutador.cerrar()
+        await self.app.stop()
+        await self.app.post_stop(self.app)
+        await self.app.shutdown()
+        await self.app.post_shutdown(self.app)
+
+
+asgi_app = AppWebhook()
+
+
+arranque.marcar("modulo")
+
+
 if __name__ == "__main__":
-    verificar_carpeta_imagenes_inicial()
-    cargar_cajas_nodos()
     main()